@@ -95,12 +95,10 @@ class ManualAxialCalibrator(AxialCalibratorBase):
       
         # For every frame fit every molecule
         calibrationPoints = []
-        for frameNr in range(len(axialFseries)):
+        for frame in axialFseries.IterPreprocessedFrames():
+            frameNr = frame.nr
             self.logger.debug("Processing frame %d" % (frameNr))
             
-            # Load frame
-            frame = axialFseries.GetPreprocessedFrame(frameNr)
-            
             if frame.z < self._calibFrom or frame.z > self._calibTo:
                 self.logger.debug("Outside calibration reqion")
                 continue
@@ -128,7 +126,8 @@ class ManualAxialCalibrator(AxialCalibratorBase):
             # Add fitter results from this frame to calibration points
             calibrationPoints.append((frame, fitResThisFrame))
        
-        psf.SetAxialCalibPoints(calibrationPoints, useStds = True)
+        psf.SetAxialCalibPoints(calibrationPoints, useStds = True, \
+                                zRange = (self._calibFrom, self._calibTo))
                 
         # profile.disable()
         # pstats.Stats(profile).sort_stats("cumulative").print_stats(15) 
@@ -2,13 +2,25 @@
 
 """
 
+import os
+import sys
+import copy
+import math
+import glob
+import time
 import logging
+import tempfile
+import threading
+import multiprocessing
 import yaml
 import numpy as np
 from os import path
 from PIL import Image
+from scipy.ndimage import filters
 from BaseClasses import ParamsBaseClass, Param
-from collections import defaultdict
+from _TiffStack import TiffStack
+from contextlib import closing
+from collections import defaultdict, OrderedDict
 
 __all__ = ["Frame", "FrameSeries"]
 
@@ -22,17 +34,35 @@ class FrameSeries(ParamsBaseClass):
         
     Args:
         pixelSize (float): single pixel width (square pixels are assumed)
-        frameFiles (list of str): the list of the files of frames
+        frameFiles (list of str or str): the list of the files of frames or a
+            glob pattern of the files (sorted by filename)
         stackFile (str): the filename of the TIFF stack  
         params (list of Params): unused, needed if inherited
+        lazyLoad (bool, optional = True): if True, frames are read from disk
+            and converted only when requested, otherwise all frames are loaded
+            during init
+        preprocessedCacheSize (int, optional): maximum size of the cache of
+            preprocessed frames in bytes, 0 disables the cache
+        frameDtype (numpy dtype, optional = float64): dtype for storing frame
+            data, float32 halves the memory usage
+        sidecarCacheFile (str, optional): filename prefix of the binary cache
+            of converted frames and ground-truth, None disables the cache
+        live (bool, optional = False): live acquisition mode, the stack (or
+            the frame files matching the pattern) may still grow, see Refresh()
+            and IterLiveFrames()
         kwargs: used to set the values of the parameters
         
     """
+    
+    # Number of frame shapes (e.g. tiles) in the cache of coordinate matrices
+    COORDS_CACHE_SHAPES = 8
         
     def __init__(self, pixelSize, series = "", frameFiles = None, stackFile = None, \
                  params = [], maxFramesToLoad = None, \
                  activationsFile = None, preprocessors = [], \
-                 excludedBorderWidth = 300e-9, **kwargs):
+                 excludedBorderWidth = 300e-9, lazyLoad = True, \
+                 preprocessedCacheSize = 256 * 1024 ** 2, frameDtype = np.float64, \
+                 sidecarCacheFile = None, live = False, **kwargs):
         
         self.logger = logging.getLogger("SMolPhot.FrameSeries")
         self.logger.debug("%s: __init__" % (series))
@@ -45,18 +75,40 @@ class FrameSeries(ParamsBaseClass):
         self._activationsFile = activationsFile
         self._preprocessors = preprocessors
         self._excludedBorderWidth = excludedBorderWidth
+        self._lazyLoad = lazyLoad
+        self._frameDtype = np.dtype(frameDtype)
+        self._sidecarCacheFile = sidecarCacheFile
+        self._live = live
+        self._frameFilesPattern = None
+        self._frameFilesPending = {}
+        self._liveStats = LiveStats()
         
         self._metadatafile = ""
-        self._origninalFrames = []
-        self._preprocessedFrames = []
+        self._stack = None
+        self._nrOfFrames = 0
+        self._origninalFrames = None
+        self._preprocessedCache = FrameCache(preprocessedCacheSize)
+        self._preprocessorsFingerprint = None
         self._zs = None
-        self._precalcPixelShape = (0, 0)
-        self._precalcCoords = None
+        self._precalcCoords = OrderedDict()
+        self._precalcCoordsLock = threading.Lock()
+        self._sidecarKey = None
+        self._sidecarFrames = None
+        self._sidecarGroundTruth = None
         
 
         if self._frameFiles is not None and self._stackFile is not None:
             raise ValueError("Only one, frameFiles or stackFile must be given.")
         
+        if isinstance(self._frameFiles, basestring):
+            self._frameFilesPattern = self._frameFiles
+            self._frameFiles = [] if live else sorted(glob.glob(self._frameFilesPattern))
+            
+        if live and (not lazyLoad or sidecarCacheFile is not None):
+            self.logger.warn("Live mode: frames are always lazy loaded, sidecar cache disabled")
+            self._lazyLoad = True
+            self._sidecarCacheFile = None
+        
         paramsThis = [Param("name", "test dataset"),
                       Param("cameraQE", None, required = False),
                       Param("wl", 660e-9),
@@ -78,127 +130,258 @@ class FrameSeries(ParamsBaseClass):
         # Check if, we have all we need
         self.AssertRequiredParamsSet()
         
+        self._OpenSidecarCache()
         self._LoadFrames()
         self._LoadGroundTruth()
+        self._SaveSidecarCache()
         
         self.logger.debug("%s: __init__ done" % (self._series))
         
          
     def _LoadFrames(self):
-        
-        def ConvertADU2Photons(data):
-            res = data - self.adcBaseline
-            res /= self.totalGain
-            return res
-        
         self.logger.info("LoadFrames from series '%s'" % (self._series))
-        self._origninalFrames = []
-        self._preprocessedFrames = []
+        self._origninalFrames = None
         
-        if self._frameFiles is not None:
+        if self._sidecarFrames is not None:
+            # From sidecar cache, already converted to photons
+            self._nrOfFrames = len(self._sidecarFrames)
+        elif self._frameFiles is not None:
             # From list of files
-            for frameNr in len(self._frameFiles):
-                filename = self._frameFiles[frameNr]
-                data = ConvertADU2Photons(np.array(Image.open(filename), dtype = np.float).T)
-                self._origninalFrames.append(Frame(self, frameNr, data))
-                
+            self._RefreshFrameFiles()
+            self._nrOfFrames = min(len(self._frameFiles), self._maxFramesToLoad)
         elif self._stackFile is not None:
-            # Froms TIFF stack
-            self._stackPIL = Image.open(self._stackFile)
-            frameNr = 0
-            try:
-                while frameNr < self._maxFramesToLoad:
-                    self._stackPIL.seek(frameNr)
-                    data = ConvertADU2Photons(np.array(self._stackPIL, dtype = np.float).T)
-                    self._origninalFrames.append(Frame(self, frameNr, data))
-                    frameNr += 1
-            except EOFError:
-                pass
+            # From TIFF stack, only page index is built, data is memory-mapped
+            self._stack = TiffStack(self._stackFile, maxPages = self._maxFramesToLoad, \
+                                    live = self._live)
+            self._nrOfFrames = len(self._stack)
         else:
             raise ValueError("frameFiles or stackFile must be given.")
-            
-            
-        # Progressed frames
-        self._preprocessedFrames = [None] * len(self)
+        
+        if not self._lazyLoad:
+            self._origninalFrames = self.GetOriginalFrames()
+        self._preprocessedCache.Clear()
             
         # Update zs-values
         if self.zRangeMin is not None:
             self._zs = np.arange(self.zRangeMin, self.zRangeMax + 1e-14, self.zStep)
         
+        self._liveStats.FramesArrived(len(self))
         self.logger.info("LoadFrames series '%s' done (frame count %d)" % (self._series, len(self)))
+        self.logger.info("Frames stored as %s, %.1f MB saved compared to float64" % \
+                         (self._frameDtype.name, self.GetMemoryUsage()["savedBytes"] / 1024.0 ** 2))
+        
+    def _RefreshFrameFiles(self):
+        # Live mode: new files matching the pattern are taken when their size
+        # has not changed since the previous refresh (writing has finished)
+        if not self._live or self._frameFilesPattern is None:
+            return
+        
+        knownFiles = set(self._frameFiles)
+        for filename in sorted(glob.glob(self._frameFilesPattern)):
+            if filename in knownFiles:
+                continue
+            try:
+                size = path.getsize(filename)
+            except OSError:
+                break
+            if size == 0 or self._frameFilesPending.get(filename) != size:
+                self._frameFilesPending[filename] = size
+                break
+            del self._frameFilesPending[filename]
+            self._frameFiles.append(filename)
+    
+    def _ReadOriginalFrame(self, frameNr):
+        if frameNr < 0:
+            frameNr += len(self)
+        if frameNr < 0 or frameNr >= len(self):
+            raise IndexError("Frame %d out of range (%d frames)" % (frameNr, len(self)))
+        
+        if self._sidecarFrames is not None:
+            return Frame(self, frameNr, np.array(self._sidecarFrames[frameNr]))
+        elif self._stack is not None:
+            rawData = self._stack.GetPageData(frameNr)
+        else:
+            rawData = Image.open(self._frameFiles[frameNr])
+        return self._MakeFrame(frameNr, rawData)
+    
+    def _MakeFrame(self, frameNr, rawData):
+        data = np.array(rawData, dtype = self._frameDtype).T
+        return Frame(self, frameNr, self._ConvertADU2Photons(data))
+    
+    def _ConvertADU2Photons(self, data):
+        res = data - self.adcBaseline
+        res /= self.totalGain
+        return res
         
     def _LoadGroundTruth(self):    
         self.logger.info("LoadGroundTruth series '%s'" % (self._series))
         
-        # Activations
-        if self._activationsFile is not None:
-            #profile = cProfile.Profile()
-            #profile.enable()
-            
-            nrs, frameNrs, xs, ys, zs, indensities = \
-                np.loadtxt(self._activationsFile, \
-                           delimiter = ",", \
-                           unpack = True, \
-                           skiprows = 1)
+        # Activations from sidecar cache
+        if self._activationsFile is not None and self._sidecarGroundTruth is not None:
+            gt = self._sidecarGroundTruth
+            self._actNr = np.ascontiguousarray(gt["actNr"])
+            self._actFrameNr = np.ascontiguousarray(gt["actFrameNr"])
+            self._actCoords = tuple(np.ascontiguousarray(c) for c in gt["actCoords"])
+            self._actCoordsArray = np.ascontiguousarray(np.array(self._actCoords).T)
+            self._actIs = np.ascontiguousarray(gt["actIs"])
+            self._actMolId = np.ascontiguousarray(gt["actMolId"])
+            self._BuildActFrameMap()
             
-            # Discard ground-truth near the border
-            groundTruthToKeep = []
-            frame = self.GetOriginalFrame(0)
-            sizeX, sizeY = frame.sizeX, frame.sizeY
-            for i in range(len(frameNrs)):
-                x, y = 1e-9 * xs[i], 1e-9 * ys[i]
-                if min(x, y) < self._excludedBorderWidth or \
-                    x + self._excludedBorderWidth > sizeX or \
-                    y + self._excludedBorderWidth > sizeY:
-                    continue
-                groundTruthToKeep.append(i)
-            groundTruthToKeep = np.array(groundTruthToKeep)
+        # Activations
+        elif self._activationsFile is not None:
+            activations = np.loadtxt(self._activationsFile, \
+                                     delimiter = ",", \
+                                     unpack = True, \
+                                     skiprows = 1, \
+                                     ndmin = 2)
+            self._SetGroundTruth(*activations)
+
+        self.logger.info("LoadGroundTruth done series '%s'" % (self._series))
+        
+    def _SetGroundTruth(self, nrs, frameNrs, xs, ys, zs, indensities):
+        # Discard ground-truth near the border
+        pixelsX, pixelsY = self._GetFrameShape()
+        sizeX, sizeY = pixelsX * self.pixelSize, pixelsY * self.pixelSize
+        x, y = 1e-9 * xs, 1e-9 * ys
+        groundTruthToKeep = ~((np.minimum(x, y) < self._excludedBorderWidth) | \
+                              (x + self._excludedBorderWidth > sizeX) | \
+                              (y + self._excludedBorderWidth > sizeY))
+        
+        # Save ground-truth variables
+        self._actNr = np.ascontiguousarray(nrs[groundTruthToKeep].astype(int))
+        self._actFrameNr = np.ascontiguousarray(frameNrs[groundTruthToKeep].astype(int) - 1)
+        self._actCoords = np.ascontiguousarray(1e-9 * xs[groundTruthToKeep]), \
+                          np.ascontiguousarray(1e-9 * ys[groundTruthToKeep]), \
+                          np.ascontiguousarray(1e-9 * zs[groundTruthToKeep])
+        self._actCoordsArray = np.ascontiguousarray(np.array(self._actCoords).T)
+        self._actIs = np.ascontiguousarray(indensities[groundTruthToKeep])
+        
+        discardedPoints = len(nrs) - len(self._actNr)
+        if discardedPoints > 0:
+            self.logger.warn("Discarded %d ground-truth points, because of excluded boundary width %.1f nm" % \
+                             (discardedPoints, 1e9 * self._excludedBorderWidth))
             
-            # Save ground-truth variables
-            self._actNr = np.ascontiguousarray(nrs[groundTruthToKeep].astype(int))
-            self._actFrameNr = np.ascontiguousarray(frameNrs[groundTruthToKeep].astype(int) - 1)
-            self._actCoords = np.ascontiguousarray(1e-9 * xs[groundTruthToKeep]), \
-                              np.ascontiguousarray(1e-9 * ys[groundTruthToKeep]), \
-                              np.ascontiguousarray(1e-9 * zs[groundTruthToKeep])
-            self._actCoordsArray = np.ascontiguousarray(np.array(self._actCoords).T)
-            self._actIs = np.ascontiguousarray(indensities[groundTruthToKeep])
+        self._BuildActFrameMap()
+        
+        # Number molecules by unique coordinate triples in order of first appearance
+        coords = np.column_stack((xs[groundTruthToKeep], ys[groundTruthToKeep], \
+                                  zs[groundTruthToKeep])) + 0.0  # -0.0 -> 0.0
+        _, firstIndices, inverse = np.unique(coords, axis = 0, return_index = True, \
+                                             return_inverse = True)
+        molIdByUnique = np.empty(len(firstIndices), dtype = int)
+        molIdByUnique[np.argsort(firstIndices)] = np.arange(len(firstIndices))
+        self._actMolId = np.ascontiguousarray(molIdByUnique[inverse.ravel()])
+    
+    def _BuildActFrameMap(self):
+        # CSR-style frame offset table: activations sorted by frame (stable,
+        # indices stay ascending within frame), frame map holds views of it
+        order = np.argsort(self._actFrameNr, kind = "mergesort")
+        self._actSortedFrameNrs = np.ascontiguousarray(self._actFrameNr[order])
+        frameNrs, offsets = np.unique(self._actSortedFrameNrs, return_index = True)
+        offsets = np.append(offsets, len(order))
+        
+        self._actFrameMap = defaultdict(list)
+        for i, frameNr in enumerate(frameNrs):
+            self._actFrameMap[frameNr] = order[offsets[i]:offsets[i + 1]]
+    
+    def _GetSidecarKey(self):
+        # Cache is valid only for the same source files and conversion params
+        sources = [self._stackFile] if self._stackFile is not None else list(self._frameFiles)
+        if self._activationsFile is not None:
+            sources.append(self._activationsFile)
+        
+        key = []
+        for filename in sources:
+            st = os.stat(filename)
+            key.append((path.abspath(filename), st.st_size, int(st.st_mtime * 1e6)))
+        key.append(("adcBaseline", float(self.adcBaseline)))
+        key.append(("totalGain", float(self.totalGain)))
+        key.append(("frameDtype", self._frameDtype.name))
+        key.append(("maxFramesToLoad", self._maxFramesToLoad))
+        key.append(("excludedBorderWidth", float(self._excludedBorderWidth)))
+        return repr(key)
+    
+    def _OpenSidecarCache(self):
+        if self._sidecarCacheFile is None:
+            return
+        
+        self._sidecarKey = self._GetSidecarKey()
+        framesFile, groundTruthFile = SidecarCacheFilenames(self._sidecarCacheFile)
+        if not path.isfile(framesFile) or not path.isfile(groundTruthFile):
+            return
+        
+        try:
+            with np.load(groundTruthFile) as data:
+                if str(data["key"]) != self._sidecarKey:
+                    self.logger.info("Sidecar cache %s is outdated" % (groundTruthFile))
+                    return
+                groundTruth = {k: data[k] for k in data.files if k != "key"}
+            frames = np.load(framesFile, mmap_mode = "r")
+        except (IOError, OSError, ValueError, KeyError) as ex:
+            self.logger.warn("Unable to read sidecar cache %s: %s" % (self._sidecarCacheFile, ex))
+            return
+        
+        if frames.dtype != self._frameDtype or frames.ndim != 3:
+            return
+        
+        self.logger.info("Using sidecar cache %s" % (framesFile))
+        self._sidecarFrames = frames
+        self._sidecarGroundTruth = groundTruth if len(groundTruth) > 0 else None
+        
+    def _SaveSidecarCache(self, chunkSize = 256):
+        if self._sidecarCacheFile is None or self._sidecarFrames is not None:
+            return
+        
+        framesFile, groundTruthFile = SidecarCacheFilenames(self._sidecarCacheFile)
+        self.logger.info("Writing sidecar cache %s" % (framesFile))
+        
+        # Unique temporary files in the same directory, other processes may
+        # write the same cache concurrently
+        tmpFiles = []
+        try:
+            # Frames, written to temporary file first
+            framesTmpFile = _MakeTempFile(framesFile)
+            tmpFiles.append(framesTmpFile)
+            shape = (len(self),) + tuple(self._GetFrameShape())
+            frames = np.lib.format.open_memmap(framesTmpFile, mode = "w+", \
+                                               dtype = self._frameDtype, shape = shape)
+            for frameFrom in range(0, len(self), chunkSize):
+                for frame in self.GetOriginalFrames(frameFrom, frameFrom + chunkSize):
+                    frames[frame.nr] = frame.data
+            frames.flush()
+            del frames
             
-            discardedPoints = len(nrs) - len(self._actNr)
-            if discardedPoints > 0:
-                self.logger.warn("Discarded %d ground-truth points, because of excluded boundary width %.1f nm" % \
-                                 (discardedPoints, 1e9 * self._excludedBorderWidth))
-                
-            # Build frame map
-            self._actFrameMap = defaultdict(list)
-            for i in np.arange(len(self._actFrameNr)):
-                self._actFrameMap[self._actFrameNr[i]].append(i)
+            # Ground-truth and cache key, its presence marks the cache complete
+            groundTruth = {}
+            if self._activationsFile is not None:
+                groundTruth = {"actNr": self._actNr,
+                               "actFrameNr": self._actFrameNr,
+                               "actCoords": np.array(self._actCoords),
+                               "actIs": self._actIs,
+                               "actMolId": self._actMolId}
             
-            # Convert to numpy arrays
-            for k, v in self._actFrameMap.iteritems():
-                self._actFrameMap[k] = np.ascontiguousarray(np.array(v, dtype = int))
-    
-            # Number molecules
-            dictActMolIdsTmp = dict()
-            curMolIdTmp = 0
-            self._actMolId = np.zeros_like(self._actFrameNr, dtype = int)
+            groundTruthTmpFile = _MakeTempFile(groundTruthFile)
+            tmpFiles.append(groundTruthTmpFile)
+            with open(groundTruthTmpFile, "wb") as stream:
+                np.savez(stream, key = np.array(self._sidecarKey), **groundTruth)
             
-            for i in np.arange(len(self._actFrameNr)):
-                coord = (xs[i], ys[i], zs[i])
-                if coord in dictActMolIdsTmp:
-                    self._actMolId[i] = dictActMolIdsTmp[coord]
-                else:
-                    self._actMolId[i] = curMolIdTmp
-                    dictActMolIdsTmp[coord] = curMolIdTmp
-                    curMolIdTmp += 1
-
-            #profile.disable()
-            #pstats.Stats(profile).sort_stats("cumulative").print_stats(15)
-
-        self.logger.info("LoadGroundTruth done series '%s'" % (self._series))
+            # Ground-truth last, outdated key of old file marks the cache invalid
+            _ReplaceFile(framesTmpFile, framesFile)
+            _ReplaceFile(groundTruthTmpFile, groundTruthFile)
+        except (IOError, OSError) as ex:
+            self.logger.warn("Unable to write sidecar cache %s: %s" % (self._sidecarCacheFile, ex))
+        finally:
+            for filename in tmpFiles:
+                if path.isfile(filename):
+                    os.remove(filename)
         
     @staticmethod
-    def FromMetafile(filename, preprocessors, series = "sequence", maxFrameOverRide = None):
+    def FromMetafile(filename, preprocessors, series = "sequence", maxFrameOverRide = None, \
+                     sidecarCache = False, **kwargs):
         # series: sequence or axial calibration
+        # sidecarCache: if True, converted frames and ground-truth are cached
+        #   next to the metafile (see SidecarCacheFilenames)
+        # kwargs: passed to FrameSeries constructor (lazyLoad, frameDtype, ...)
         with open(filename, "r") as stream:
             metadata = yaml.safe_load(stream)
 
@@ -208,6 +391,7 @@ class FrameSeries(ParamsBaseClass):
         dataDir = path.dirname(path.abspath(filename))
         pixelSize = metadata["pixel size"]
         paramValues = metadata["frame params"]
+        paramValues.update(kwargs)
         seriesMetadata = metadata["series"][series]
         
         if "max frames" in seriesMetadata and maxFrameOverRide is None:
@@ -225,12 +409,20 @@ class FrameSeries(ParamsBaseClass):
 
         if "params" in seriesMetadata:
             paramValues.update(seriesMetadata["params"])
+            
+        if sidecarCache:
+            paramValues["sidecarCacheFile"] = "%s.%s" % (path.splitext(path.abspath(filename))[0], \
+                                                         series.replace(" ", ""))
 
         # Init FrameSeries
         if "qfiles" in seriesMetadata:
             frameFiles = [path.join(dataDir, f) for f in seriesMetadata["qfiles"]]
             res = FrameSeries(pixelSize, series = series, frameFiles = frameFiles, \
                               preprocessors = preprocessors, **paramValues)
+        elif "qfiles pattern" in seriesMetadata:
+            frameFilesPattern = path.join(dataDir, seriesMetadata["qfiles pattern"])
+            res = FrameSeries(pixelSize, series = series, frameFiles = frameFilesPattern, \
+                              preprocessors = preprocessors, **paramValues)
         elif "stack file" in seriesMetadata:
             stackFile = path.join(dataDir, seriesMetadata["stack file"])
             res = FrameSeries(pixelSize, series = series, stackFile = stackFile, \
@@ -258,13 +450,21 @@ class FrameSeries(ParamsBaseClass):
         return indicesX, indicesY
     
     def GetCoordsMatrix(self, pixelShape):
-        if self._precalcPixelShape != pixelShape:
+        # Few last shapes are kept (frame and tiles), OrderedDict is not
+        # thread-safe in Python 2
+        pixelShape = tuple(pixelShape)
+        with self._precalcCoordsLock:
+            res = self._precalcCoords.get(pixelShape)
+        if res is None:
             self.logger.debug("GetCoordsMatrix(%s) updated" % (str(pixelShape)))
             pixelsX, pixelsY = np.meshgrid(np.arange(pixelShape[0]), \
                                      np.arange(pixelShape[1]), indexing = "ij")
-            self._precalcCoords = self.GetPixelCoords((pixelsX, pixelsY))
-            self._precalcPixelShape = pixelShape
-        return self._precalcCoords
+            res = self.GetPixelCoords((pixelsX, pixelsY))
+            with self._precalcCoordsLock:
+                self._precalcCoords[pixelShape] = res
+                while len(self._precalcCoords) > self.COORDS_CACHE_SHAPES:
+                    self._precalcCoords.popitem(last = False)
+        return res
     
     def SaveMetadata(self, filename):
         metadata = {}
@@ -281,7 +481,30 @@ class FrameSeries(ParamsBaseClass):
     
     def GetOriginalFrame(self, nr):
         self.logger.debug("%s: GetOriginalFrame(%d)" % (self._series, nr))
-        return self._origninalFrames[nr]
+        if self._origninalFrames is not None:
+            return self._origninalFrames[nr]
+        return self._ReadOriginalFrame(nr)
+    
+    def GetOriginalFrames(self, frameFrom = 0, frameTo = None):
+        """Returns a range of original frames. Pages of TIFF stack are decoded
+        concurrently by the thread pool of the stack.
+        
+        Args:
+            frameFrom (int, optional = 0): first frame number
+            frameTo (int, optional): frame number after the last frame
+            
+        Returns:
+            list of Frame
+        
+        """
+        frameTo = len(self) if frameTo is None else min(frameTo, len(self))
+        self.logger.debug("%s: GetOriginalFrames(%d, %d)" % (self._series, frameFrom, frameTo))
+        
+        if self._origninalFrames is not None:
+            return self._origninalFrames[frameFrom:frameTo]
+        if self._stack is not None:
+            return self._stack.MapPages(self._MakeFrame, range(frameFrom, frameTo))
+        return [self._ReadOriginalFrame(frameNr) for frameNr in range(frameFrom, frameTo)]
     
     def OptimizePreprocessors(self):
         self.logger.debug("%s: OptimizePreprocessors" % (self._series))
@@ -290,16 +513,180 @@ class FrameSeries(ParamsBaseClass):
         self.logger.debug("%s: OptimizePreprocessors done" % (self._series))
         
     def GetPreprocessedFrame(self, nr, roi = None):
-        # TODO: performance issue, avoid recalculation if possible
         self.logger.debug("%s: GetPreprocessedFrame(%d)" % (self._series, nr))
-        newFrame = self._origninalFrames[nr].CopyFrame()
+        if nr < 0:
+            nr += len(self)
         
-        for preprocessor in self._preprocessors:
-            preprocessor.Apply(newFrame)
+        # Entries made by different preprocessor params are useless
+        fingerprint = self.GetPreprocessorsFingerprint()
+        if fingerprint != self._preprocessorsFingerprint:
+            self._preprocessedCache.Clear()
+            self._preprocessorsFingerprint = fingerprint
         
+        cacheKey = (nr, fingerprint)
+        preprocessedFrame = self._preprocessedCache.Get(cacheKey)
+        if preprocessedFrame is None:
+            if self._origninalFrames is not None:
+                preprocessedFrame = self._origninalFrames[nr].CopyFrame()
+            else:
+                # Freshly read frame, no need to copy
+                preprocessedFrame = self._ReadOriginalFrame(nr)
+            
+            for preprocessor in self._preprocessors:
+                preprocessor.Apply(preprocessedFrame)
+            self._preprocessedCache.Put(cacheKey, preprocessedFrame)
+            
+        # Cached frame must stay untouched, return a copy
+        newFrame = copy.copy(preprocessedFrame)
+        newFrame.data = preprocessedFrame.data.copy()
         newFrame.Crop(roi)
         return newFrame
     
+    def IterPreprocessedFrames(self, start = 0, stop = None, prefetch = 4, roi = None):
+        """Generator of preprocessed frames. Upcoming frames are read and
+        preprocessed on worker threads while the caller processes the current
+        frame. Closing the generator (or breaking out of the loop) cancels
+        the prefetching.
+        
+        Args:
+            start (int, optional = 0): first frame number
+            stop (int, optional): frame number after the last frame
+            prefetch (int, optional = 4): maximum number of frames prepared
+                ahead, 0 disables prefetching
+            roi (optional): region of interest passed to GetPreprocessedFrame
+            
+        Yields:
+            Frame
+        
+        """
+        stop = len(self) if stop is None else min(stop, len(self))
+        if prefetch <= 0:
+            for frameNr in range(start, stop):
+                yield self.GetPreprocessedFrame(frameNr, roi)
+            return
+        
+        prefetcher = FramePrefetcher(self, range(start, stop), prefetch, roi = roi)
+        try:
+            for frame in prefetcher:
+                yield frame
+        finally:
+            prefetcher.Cancel()
+    
+    def Refresh(self):
+        """Live mode: checks for newly written frames.
+        
+        Returns:
+            int: number of new frames
+        
+        """
+        if not self._live:
+            return 0
+        
+        nrOfFramesBefore = len(self)
+        if self._stack is not None:
+            self._stack.Refresh()
+            self._nrOfFrames = len(self._stack)
+        else:
+            self._RefreshFrameFiles()
+            self._nrOfFrames = min(len(self._frameFiles), self._maxFramesToLoad)
+            
+        if len(self) > nrOfFramesBefore:
+            self._liveStats.FramesArrived(len(self))
+        return len(self) - nrOfFramesBefore
+    
+    def IterLiveFrames(self, start = 0, prefetch = 4, pollInterval = 0.05, idleTimeout = None, \
+                       roi = None):
+        """Generator of preprocessed frames in live mode. New frames are
+        yielded as soon as they are written, the generator waits for them
+        until no new frames have arrived within idleTimeout or it is closed.
+        Throughput and lag (time from the discovery of the frame to the end
+        of its processing by the caller) are collected to liveStats.
+        
+        Args:
+            start (int, optional = 0): first frame number
+            prefetch (int, optional = 4): see IterPreprocessedFrames
+            pollInterval (float, optional = 0.05): time between checks for
+                new frames in seconds
+            idleTimeout (float, optional): stop after this many seconds
+                without new frames, None waits forever
+            roi (optional): region of interest passed to GetPreprocessedFrame
+            
+        Yields:
+            Frame
+        
+        """
+        frameNr = start
+        lastNewFrameTime = time.time()
+        while True:
+            if self.Refresh() > 0:
+                lastNewFrameTime = time.time()
+            
+            if frameNr < len(self):
+                stop = len(self)
+                with closing(self.IterPreprocessedFrames(frameNr, stop, prefetch, roi)) as frames:
+                    for frame in frames:
+                        yield frame
+                        self._liveStats.FrameProcessed(frame.nr)
+                        if self.Refresh() > 0:
+                            lastNewFrameTime = time.time()
+                frameNr = stop
+                continue
+                
+            if not self._live:
+                return
+            if idleTimeout is not None and time.time() - lastNewFrameTime > idleTimeout:
+                return
+            time.sleep(pollInterval)
+    
+    def GetPreprocessorsFingerprint(self):
+        res = []
+        for preprocessor in self._preprocessors:
+            if not preprocessor.enabled:
+                continue
+            res.append((type(preprocessor).__name__, repr(sorted(preprocessor.GetParams().items()))))
+        return tuple(res)
+    
+    def ClearPreprocessedCache(self):
+        self._preprocessedCache.Clear()
+        
+    def GetMemoryUsage(self):
+        """Returns the memory used by the frames kept in memory (original frames
+        if not lazy loaded and the cache of preprocessed frames) and the memory
+        saved by the frame dtype compared to float64 storage.
+        
+        Returns:
+            dict: memory usage in bytes
+        
+        """
+        itemsize = self._frameDtype.itemsize
+        originalFramesBytes = 0
+        if self._origninalFrames is not None:
+            originalFramesBytes = sum(frame.data.nbytes for frame in self._origninalFrames)
+        preprocessedCacheBytes = self._preprocessedCache.GetStats()["bytes"]
+        
+        bytesPerFrame = 0
+        if len(self) > 0:
+            bytesPerFrame = itemsize * np.prod(self._GetFrameShape())
+        
+        usedBytes = originalFramesBytes + preprocessedCacheBytes
+        savedBytes = usedBytes * (np.dtype(np.float64).itemsize - itemsize) / itemsize
+        res = {"dtype": self._frameDtype.name,
+               "bytesPerFrame": bytesPerFrame,
+               "savedBytesPerFrame": bytesPerFrame * (np.dtype(np.float64).itemsize - itemsize) / itemsize,
+               "originalFramesBytes": originalFramesBytes,
+               "preprocessedCacheBytes": preprocessedCacheBytes,
+               "savedBytes": savedBytes}
+        return res
+    
+    def _GetFrameShape(self):
+        if self._sidecarFrames is not None:
+            return self._sidecarFrames.shape[1:]
+        if self._origninalFrames is not None:
+            return self._origninalFrames[0].data.shape
+        if self._stack is not None:
+            return self._stack.GetPageData(0).shape[::-1]
+        return self.GetOriginalFrame(0).data.shape
+    
     def HasGroundTruth(self):
         return self._activationsFile is not None
     
@@ -310,14 +697,12 @@ class FrameSeries(ParamsBaseClass):
         if frameTo is None:
             frameTo = len(self)
         
-        res = 0
-        for frameNr in range(frameFrom, frameTo):
-            res += len(self._actFrameMap[frameNr])
-        return res
+        offsetFrom, offsetTo = np.searchsorted(self._actSortedFrameNrs, [frameFrom, frameTo])
+        return int(offsetTo - offsetFrom)
 
             
     def __len__(self):
-            return len(self._origninalFrames)
+            return self._nrOfFrames
     
     @property
     def series(self):
@@ -335,6 +720,234 @@ class FrameSeries(ParamsBaseClass):
     def zs(self):
         return self._zs        
 
+    @property
+    def live(self):
+        return self._live
+    
+    @property
+    def liveStats(self):
+        return self._liveStats
+    
+    @property
+    def preprocessedCacheStats(self):
+        return self._preprocessedCache.GetStats()
+        
+#===============================================================================
+# FrameCache
+#===============================================================================
+
+class FrameCache(object):
+    """Memory-bounded LRU cache of frames. Thread-safe, as frames are
+    requested both from the GUI and from the processing thread.
+    
+    Args:
+        maxBytes (int): maximum total size of the cached frame data, 0 disables
+            caching
+    
+    """
+    
+    def __init__(self, maxBytes):
+        self.maxBytes = maxBytes
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self._nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        
+    def Get(self, key):
+        with self._lock:
+            frame = self._entries.pop(key, None)
+            if frame is None:
+                self.misses += 1
+                return None
+            
+            # Move to the end (most recently used)
+            self._entries[key] = frame
+            self.hits += 1
+            return frame
+    
+    def Put(self, key, frame):
+        frameBytes = FrameCache.FrameNBytes(frame)
+        if frameBytes > self.maxBytes:
+            return
+        
+        with self._lock:
+            if key in self._entries:
+                self._nbytes -= FrameCache.FrameNBytes(self._entries.pop(key))
+            
+            # Evict least recently used
+            while self._entries and self._nbytes + frameBytes > self.maxBytes:
+                _, evicted = self._entries.popitem(last = False)
+                self._nbytes -= FrameCache.FrameNBytes(evicted)
+                
+            self._entries[key] = frame
+            self._nbytes += frameBytes
+    
+    def Clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._nbytes = 0
+    
+    def GetStats(self):
+        with self._lock:
+            return {"hits": self.hits,
+                    "misses": self.misses,
+                    "entries": len(self._entries),
+                    "bytes": self._nbytes,
+                    "maxBytes": self.maxBytes}
+    
+    @staticmethod
+    def FrameNBytes(frame):
+        res = frame.data.nbytes
+        interpolatedBg = getattr(frame, "_interpolatedBg", None)
+        if interpolatedBg is not None:
+            res += interpolatedBg.nbytes
+        return res
+    
+    def __len__(self):
+        return len(self._entries)
+
+#===============================================================================
+# LiveStats
+#===============================================================================
+
+class LiveStats(object):
+    """Throughput and lag statistics of the live acquisition mode. Lag of a
+    frame is the time from its discovery to the end of its processing.
+    
+    """
+    
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._arrivalTimes = []
+        self._startTime = None
+        self.framesProcessed = 0
+        self.lastLag = 0.0
+        self.maxLag = 0.0
+        self._lagSum = 0.0
+        
+    def FramesArrived(self, nrOfFrames):
+        with self._lock:
+            curTime = time.time()
+            if self._startTime is None:
+                self._startTime = curTime
+            newFrames = nrOfFrames - len(self._arrivalTimes)
+            if newFrames > 0:
+                self._arrivalTimes += [curTime] * newFrames
+        
+    def FrameProcessed(self, frameNr):
+        with self._lock:
+            lag = time.time() - self._arrivalTimes[frameNr]
+            self.framesProcessed += 1
+            self.lastLag = lag
+            self.maxLag = max(self.maxLag, lag)
+            self._lagSum += lag
+            
+    def GetStats(self):
+        with self._lock:
+            elapsed = 0.0 if self._startTime is None else time.time() - self._startTime
+            framesArrived = len(self._arrivalTimes)
+            return {"framesArrived": framesArrived,
+                    "framesProcessed": self.framesProcessed,
+                    "backlog": framesArrived - self.framesProcessed,
+                    "acquisitionRate": framesArrived / elapsed if elapsed > 0.0 else 0.0,
+                    "throughput": self.framesProcessed / elapsed if elapsed > 0.0 else 0.0,
+                    "lastLag": self.lastLag,
+                    "meanLag": self._lagSum / max(1, self.framesProcessed),
+                    "maxLag": self.maxLag}
+    
+    def GetStatsStr(self):
+        stats = self.GetStats()
+        res = "frames %d/%d (backlog %d), %.1f fps acquired, %.1f fps processed, " \
+            "lag %.3f s (mean %.3f s, max %.3f s)" % \
+            (stats["framesProcessed"], stats["framesArrived"], stats["backlog"], \
+             stats["acquisitionRate"], stats["throughput"], stats["lastLag"], \
+             stats["meanLag"], stats["maxLag"])
+        return res
+
+#===============================================================================
+# FramePrefetcher
+#===============================================================================
+
+class FramePrefetcher(object):
+    """Preprocesses upcoming frames on worker threads while the caller is
+    busy with the current one. At most `prefetch` frames are in progress or
+    waiting to be consumed (backpressure), frames are returned in order.
+    
+    Args:
+        fseries (FrameSeries): frame series
+        frameNrs (list of int): numbers of frames to preprocess
+        prefetch (int): maximum number of frames prepared ahead
+        roi (optional): region of interest passed to GetPreprocessedFrame
+        workers (int, optional): number of worker threads, by default
+            min(prefetch, cpu_count())
+    
+    """
+    
+    def __init__(self, fseries, frameNrs, prefetch, roi = None, workers = None):
+        self._fseries = fseries
+        self._frameNrs = list(frameNrs)
+        self._prefetch = max(1, prefetch)
+        self._roi = roi
+        
+        self._cond = threading.Condition()
+        self._cancelled = False
+        self._nextIndex = 0
+        self._inProgress = 0
+        self._results = {}
+        
+        workers = min(self._prefetch, multiprocessing.cpu_count()) if workers is None else workers
+        self._threads = [threading.Thread(target = self._Worker) for _ in range(max(1, workers))]
+        for thread in self._threads:
+            thread.daemon = True
+            thread.start()
+        
+    def _Worker(self):
+        while True:
+            # Wait for free slot
+            with self._cond:
+                while not self._cancelled and self._inProgress >= self._prefetch:
+                    self._cond.wait(0.1)
+                if self._cancelled or self._nextIndex >= len(self._frameNrs):
+                    return
+                index = self._nextIndex
+                self._nextIndex += 1
+                self._inProgress += 1
+            
+            try:
+                res = (self._fseries.GetPreprocessedFrame(self._frameNrs[index], self._roi), None)
+            except Exception:
+                res = (None, sys.exc_info())
+                
+            with self._cond:
+                self._results[index] = res
+                self._cond.notify_all()
+                    
+    def Cancel(self):
+        """Stops the workers after the frames currently in progress.
+        
+        """
+        with self._cond:
+            self._cancelled = True
+            self._results.clear()
+            self._cond.notify_all()
+        
+    def __iter__(self):
+        for index in range(len(self._frameNrs)):
+            with self._cond:
+                while index not in self._results:
+                    if self._cancelled:
+                        return
+                    self._cond.wait(0.1)
+                frame, excInfo = self._results.pop(index)
+                self._inProgress -= 1
+                self._cond.notify_all()
+            
+            if excInfo is not None:
+                self.Cancel()
+                raise excInfo[0], excInfo[1], excInfo[2]
+            yield frame
+
 
 #===============================================================================
 # Frame
@@ -403,39 +1016,65 @@ class Frame(ParamsBaseClass):
         res = (max(0, min(self.data.shape[0] - 1, xI)), max(0, min(self.data.shape[1] - 1, yI)))
         return res
         
-    def FindMaximas(self, threshold, bbox = None, localMaxima = True):
-        pixelsX, pixelsY = self.pixelsX, self.pixelsY
+    def FindMaximas(self, threshold, bbox = None, localMaxima = True, areaThreshold = None):
+        """Finds pixels above threshold, optionally only the local maximas of
+        their 3x3 neighbourhood. Pixels on the edge of the frame are dismissed.
         
-        if bbox is None:
-            sl = (slice(0, pixelsX), slice(0, pixelsY)) 
-        else:
-            sl = (slice(bbox[0], bbox[2]), slice(bbox[1], bbox[3]))
+        Args:
+            threshold (float): detection threshold
+            bbox (tuple, optional): (x0, y0, x1, y1) pixel box to search in
+            localMaxima (bool, optional = True): only local maximas are returned
+            areaThreshold (float, optional): if given, also the number of pixels
+                above areaThreshold and the weighted centroid of the 3x3
+                neighbourhood of every maxima (pixel center, if the sum of
+                the neighbourhood is not positive) are returned
                 
-        maxIndicesInitialX, maxIndicesInitialY  = np.where(self.data[sl] > threshold)
-        if bbox is not None:
-            maxIndicesInitialX += bbox[0]
-            maxIndicesInitialY += bbox[1]
+        Returns:
+            list of coords or, if areaThreshold is given, tuple (coords,
+            areas, weightedCentroids)
         
-        res = []
-        for xI, yI in zip(maxIndicesInitialX, maxIndicesInitialY):
-            if min(xI, yI) < 1 or xI + 1 >= pixelsX or yI + 1 >= pixelsY:
-                #self.logger.debug("Dismissed, pixel on edge")
-                continue
+        """
+        pixelsX, pixelsY = self.pixelsX, self.pixelsY
+        x0, y0, x1, y1 = (0, 0, pixelsX, pixelsY) if bbox is None else bbox
+        
+        # Dismiss pixels on edge
+        x0, y0 = max(x0, 1), max(y0, 1)
+        x1, y1 = min(x1, pixelsX - 1), min(y1, pixelsY - 1)
+        if x1 <= x0 or y1 <= y0:
+            return [] if areaThreshold is None else ([], [], [])
+        
+        region = self._data[x0:x1, y0:y1]
+        maximas = region > threshold
+        if localMaxima:
+            # Neighbourhood of the region always fits inside the frame
+            maxAround = filters.maximum_filter(self._data[(x0 - 1):(x1 + 1), (y0 - 1):(y1 + 1)], \
+                                               size = 3)[1:-1, 1:-1]
+            maximas &= region >= maxAround
             
-            if localMaxima:
-                # Local maxima is required
-                pixelValue = self._data[xI, yI]
-                directlyAroundData = self._data[(xI - 1):(xI + 2), (yI - 1):(yI + 2)]
-                maxAround = np.max(directlyAroundData)
-                
-                if maxAround > pixelValue:
-                    # Not local maxima
-                    continue
-                
-            coord = self.GetPixelCoords((xI, yI))
-            res.append(coord)
-                
-        return res
+        maxIndicesX, maxIndicesY = np.nonzero(maximas)
+        maxIndicesX += x0
+        maxIndicesY += y0
+        coordsX, coordsY = self.GetPixelCoords((maxIndicesX, maxIndicesY))
+        coords = zip(coordsX, coordsY)
+        if areaThreshold is None:
+            return coords
+        
+        # 3x3 neighbourhoods (row-major) of all maximas at once
+        dX, dY = [d.ravel() for d in np.mgrid[-1:2, -1:2]]
+        around = self._data[maxIndicesX[:, np.newaxis] + dX, maxIndicesY[:, np.newaxis] + dY]
+        areas = (around > areaThreshold).sum(axis = 1)
+        
+        # Zero or negative sum (background subtracted data) falls back to the
+        # pixel center
+        weightsSum = around.sum(axis = 1, dtype = np.float64)
+        valid = weightsSum > 0.0
+        weightsSum[~valid] = 1.0
+        centroidXI = np.multiply(dX + 1, around, dtype = np.float64).sum(axis = 1) / weightsSum - 1.0
+        centroidYI = np.multiply(dY + 1, around, dtype = np.float64).sum(axis = 1) / weightsSum - 1.0
+        centroidXI = np.where(valid, centroidXI, 0.0) + maxIndicesX
+        centroidYI = np.where(valid, centroidYI, 0.0) + maxIndicesY
+        weightedCentroids = zip(*self.GetPixelCoords((centroidXI, centroidYI)))
+        return coords, list(areas), weightedCentroids
     
     def GetBoxAround(self, (xI, yI), (hwX, hwY)):
         #print type(xI), type(hwX)
@@ -452,16 +1091,89 @@ class Frame(ParamsBaseClass):
         dataAround = self._data[x0:x1, y0:y1]
         molCoordAround = (xI - x0, yI - y0)
         
+        # Compact frame storage, upcast only the small window for fitting
+        if dataAround.dtype != np.float64:
+            dataAround = dataAround.astype(np.float64)
+        
         if flatten:
             return molCoordAround, (coordsAround[0].ravel(), coordsAround[1].ravel()), \
                 dataAround.ravel()
         else:
             return molCoordAround, coordsAround, dataAround
+        
+    def GetAroundBatch(self, centersPixels, halfPixelsAround):
+        """Stacks the flattened fit windows (as returned by GetAround) of all
+        centers. Only windows fully inside the frame are stacked, so they are
+        all equally sized.
+        
+        Args:
+            centersPixels (list of tuples): (xI, yI) centers of the windows
+            halfPixelsAround (int): half-width of the windows
+            
+        Returns:
+            tuple (inside, (coordsX, coordsY), data), where inside is boolean
+            array of the centers which windows are stacked and coordsX,
+            coordsY, data are arrays with shape (inside.sum(), nrOfPixels)
+        
+        """
+        hw = halfPixelsAround
+        centersPixels = np.array(centersPixels, dtype = int).reshape((-1, 2))
+        centersX, centersY = centersPixels[:, 0], centersPixels[:, 1]
+        inside = (centersX >= hw) & (centersX + hw < self.pixelsX) & \
+            (centersY >= hw) & (centersY + hw < self.pixelsY)
+        
+        # Row-major window offsets (as ravel in GetAround)
+        dX, dY = [d.ravel() for d in np.mgrid[-hw:hw + 1, -hw:hw + 1]]
+        indicesX = centersX[inside, np.newaxis] + dX
+        indicesY = centersY[inside, np.newaxis] + dY
+        
+        dataAround = self._data[indicesX, indicesY].astype(np.float64)
+        coordsAround = self.GetPixelCoords((indicesX, indicesY))
+        return inside, coordsAround, dataAround
 
-    def SubtractLocs(self, psf, locs):
+    def GetSubtractionBox(self, psf, loc):
+        """Returns the box (x0, y0, x1, y1) in pixels, where the PSF of loc
+        is subtracted by SubtractLocs, None if it is subtracted from the
+        whole frame.
+        
+        """
+        halfWidth = psf.GetSupportHalfWidth(*loc.bestFitParams)
+        if halfWidth is None:
+            return None
+        hw = int(math.ceil(halfWidth / self.pixelSize))
+        centerPixels = self.GetCoordsPixels(loc.bestFitParams[1:3])
+        return self.GetBoxAround(centerPixels, (hw, hw))
+        
+    def SubtractLocs(self, psf, locs, subtractOffset = False):
+        """Subtracts PSFs of the locations from the frame data. The PSF is
+        evaluated only in the window given by psf.GetSupportHalfWidth().
+        
+        Args:
+            psf (PsfBase): PSF used for fitting the locations
+            locs (list of MoleculeLoc): locations to subtract
+            subtractOffset (bool, optional = False): also the fitted offsets are
+                subtracted from the whole frame
+                
+        Returns:
+            self
+        
+        """
+        data = self.data
+        coordsX, coordsY = self.coords
         for loc in locs:
-            # TODO: subraction only near the molecule
-            self.data -= psf.CalcWithoutOffset(self.coords, *loc.bestFitParams) 
+            box = self.GetSubtractionBox(psf, loc)
+            if box is None:
+                data -= psf.CalcWithoutOffset((coordsX, coordsY), *loc.bestFitParams)
+            else:
+                x0, y0, x1, y1 = box
+                data[x0:x1, y0:y1] -= psf.CalcWithoutOffset((coordsX[x0:x1, y0:y1], \
+                    coordsY[x0:x1, y0:y1]), *loc.bestFitParams)
+                
+            if subtractOffset:
+                data -= loc.bestFitParams[-1]
+        
+        # Resets cached statistics
+        self.data = data
         return self
     
     # Getters and setters
@@ -528,5 +1240,32 @@ class Frame(ParamsBaseClass):
     def pixelSize(self):
         return self._fseries.pixelSize
 
+#===============================================================================
+# Methods
+#===============================================================================
+
+def SidecarCacheFilenames(prefix):
+    """Returns the filenames of the sidecar cache: memory-mappable .npy file
+    of converted frames and .npz file of ground-truth arrays and cache key.
+    
+    """
+    return "%s.frames.npy" % (prefix), "%s.cache.npz" % (prefix)
+
+def _MakeTempFile(filename):
+    fd, res = tempfile.mkstemp(suffix = ".tmp", prefix = path.basename(filename) + ".", \
+                               dir = path.dirname(path.abspath(filename)))
+    os.close(fd)
+    return res
+
+def _ReplaceFile(src, dst):
+    # Atomic on POSIX, Windows can't rename over an existing file
+    try:
+        os.rename(src, dst)
+    except OSError:
+        if not path.isfile(dst):
+            raise
+        os.remove(dst)
+        os.rename(src, dst)
+
 if __name__ == "__main__":
     pass
\ No newline at end of file
@@ -4,10 +4,12 @@ import copy
 import SMolPhot
 import itertools
 import traceback
+import multiprocessing
 import logging.config
 
 from os import path
 from time import time
+from contextlib import closing
 from getpass import getuser
 from datetime import datetime
 from SMolPhot import Postprocessors
@@ -138,7 +140,8 @@ def StatsToStr(stats, header = False):
 
 class CommandLineSMolPhot(object):
 
-    def __init__(self, datasetMetafile, confFileName, maxFrameOverRide = None, confOverride = []):
+    def __init__(self, datasetMetafile, confFileName, maxFrameOverRide = None, confOverride = [], \
+                 frameSeriesKwargs = {}, sidecarCache = False):
         self.logger = logging.getLogger("CommandLineSMolPhot")
         self._datasetMetafile = datasetMetafile
         self._confFileName = confFileName
@@ -173,8 +176,12 @@ class CommandLineSMolPhot(object):
         
         # Load frames
         self.logger.info("Load frames %s" % (datasetMetafile))
-        self._axialFseries = SMolPhot.FrameSeries.FromMetafile(datasetMetafile, self._preprocessors, series = "axial calibration")
-        self._fseries = SMolPhot.FrameSeries.FromMetafile(datasetMetafile, self._preprocessors, maxFrameOverRide = maxFrameOverRide)
+        self._axialFseries = SMolPhot.FrameSeries.FromMetafile(datasetMetafile, self._preprocessors, \
+            series = "axial calibration", sidecarCache = sidecarCache, **frameSeriesKwargs)
+        self._fseriesKwargs = dict(frameSeriesKwargs, maxFrameOverRide = maxFrameOverRide, \
+                                   sidecarCache = sidecarCache)
+        self._fseries = SMolPhot.FrameSeries.FromMetafile(datasetMetafile, self._preprocessors, \
+                                                          **self._fseriesKwargs)
         
         self.logger.info("Init done.")
         
@@ -221,20 +228,121 @@ class CommandLineSMolPhot(object):
         self._curAxialCalibrator.CalibratePsf(self._curPSF, self._axialFseries, roisState)
         self.logger.info("Axial calibration done.")
         
-    def LocalizeMolecules(self):
+    def LocalizeMolecules(self, workers = 1, chunkSize = None, tiling = None):
+        """Localizes molecules in all frames. With several workers, the frame
+        ranges (chunkSize frames) are localized in a pool of processes, or with
+        tiling, the tiles of every frame are localized in the pool.
+        
+        Args:
+            workers (int, optional = 1): number of worker processes, None
+                for the number of CPUs
+            chunkSize (int, optional): frames per task, by default the frames
+                are divided into 4 tasks per worker
+            tiling (dict, optional): if given, frames are localized in tiles,
+                kwargs of LocalizerBase.FindMoleculesTiled (tileSize, halo)
+        
+        """
+        workers = multiprocessing.cpu_count() if workers is None else workers
+        if workers > 1:
+            if not multiprocessing.current_process().daemon:
+                if tiling is not None:
+                    return self._LocalizeMoleculesTiledParallel(workers, tiling)
+                return self._LocalizeMoleculesParallel(workers, chunkSize)
+            self.logger.warn("Daemonic process (e.g. pool worker) can't start workers, localizing sequentially")
+        
         self.logger.info("Localize molecules started...")
         fitMode = "z" if self._curPSF.hasCalibrationData else "sigma"
         
         locs = []
-        for frameNr in range(len(self._fseries)):         
-            frame = self._fseries.GetPreprocessedFrame(frameNr)
-            
+        for frame in self._fseries.IterPreprocessedFrames():
             # Find molecules
-            locs += self._curLocalizer.FindMolecules(frame, self._curPSF, \
-                                                     self._curAxialCalibrator, fitMode = fitMode)
+            locs += _FindMolecules(self._curLocalizer, frame, self._curPSF, \
+                                   self._curAxialCalibrator, fitMode, tiling)
         self.logger.info("Localize molecules done")
         return locs
     
+    def _CreateWorkerPool(self, workers):
+        # Only conf, names and calibration are pickled (works also with spawn),
+        # workers reopen the frame series (memory-mapped or sidecar cached
+        # frames are not copied)
+        moduleNames = {"localizer": self._curLocalizer.name,
+                       "axialCalibrator": self._curAxialCalibrator.name,
+                       "psf": self._curPSF.name}
+        initArgs = (self.GetConf(), moduleNames, self._datasetMetafile, self._fseriesKwargs, \
+                    self._curPSF.GetAxialCalibration())
+        return multiprocessing.Pool(processes = workers, initializer = _InitLocalizeWorker, \
+                                    initargs = initArgs)
+    
+    def _LocalizeMoleculesParallel(self, workers, chunkSize):
+        self.logger.info("Localize molecules in parallel started (%d workers)..." % (workers))
+        startTime = time()
+        nrOfFrames = len(self._fseries)
+        chunkSize = max(1, nrOfFrames // (4 * workers)) if chunkSize is None else chunkSize
+        frameRanges = [(frameFrom, min(frameFrom + chunkSize, nrOfFrames)) \
+                       for frameFrom in range(0, nrOfFrames, chunkSize)]
+        
+        pool = self._CreateWorkerPool(workers)
+        try:
+            # Results are merged in frame order
+            locs, workerTime = [], 0.0
+            for locsRange, rangeTime in pool.imap(_LocalizeFrameRange, frameRanges):
+                locs += locsRange
+                workerTime += rangeTime
+            pool.close()
+        except:
+            pool.terminate()
+            raise
+        finally:
+            pool.join()
+        
+        totalTime = time() - startTime
+        self.logger.info("Localize molecules done: %d frames in %d chunks, %.2f s (worker time %.2f s, %.1f workers busy)" % \
+                         (nrOfFrames, len(frameRanges), totalTime, workerTime, workerTime / totalTime))
+        return locs
+    
+    def _LocalizeMoleculesTiledParallel(self, workers, tiling):
+        # One pool for the whole run, frames are read and merged here
+        self.logger.info("Localize molecules in tiles started (%d workers)..." % (workers))
+        startTime = time()
+        fitMode = "z" if self._curPSF.hasCalibrationData else "sigma"
+        
+        pool = self._CreateWorkerPool(workers)
+        try:
+            locs = []
+            for frame in self._fseries.IterPreprocessedFrames():
+                locs += self._curLocalizer.FindMoleculesTiled(frame, self._curPSF, self._curAxialCalibrator, \
+                                                              fitMode = fitMode, pool = pool, **tiling)
+            pool.close()
+        except:
+            pool.terminate()
+            raise
+        finally:
+            pool.join()
+        
+        self.logger.info("Localize molecules done: %d frames, %.2f s" % (len(self._fseries), time() - startTime))
+        return locs
+    
+    def LocalizeMoleculesLive(self, idleTimeout = 10.0, reportInterval = 5.0, **kwargs):
+        # Live acquisition: localizes frames as they are written, stops after
+        # idleTimeout seconds without new frames (kwargs: see IterLiveFrames)
+        self.logger.info("Localize molecules live started...")
+        fitMode = "z" if self._curPSF.hasCalibrationData else "sigma"
+        liveStats = self._fseries.liveStats
+        
+        locs = []
+        lastReportTime = time()
+        with closing(self._fseries.IterLiveFrames(idleTimeout = idleTimeout, **kwargs)) as frames:
+            for frame in frames:
+                locs += self._curLocalizer.FindMolecules(frame, self._curPSF, \
+                                                         self._curAxialCalibrator, fitMode = fitMode)
+                if time() - lastReportTime > reportInterval:
+                    self.logger.info("Live: %s" % (liveStats.GetStatsStr()))
+                    lastReportTime = time()
+                    
+        self.logger.info("Live: %s" % (liveStats.GetStatsStr()))
+        self.logger.info("Localize molecules live done")
+        return locs
+    
     def DoPostprocessing(self, locs, postprocessingHistory = False):
         statsHistory = []
         self.logger.info("Start postprocessing...")
@@ -383,6 +491,8 @@ class CommandLineSMolPhot(object):
     def RunSmolphot(self, testName = "cmd line run", onlyPostprocessor = False, **kwargs):
         self.logger.info("Run started...")
         postprocessingHistory = kwargs.pop("postprocessingHistory", False)
+        live = kwargs.pop("live", None)  # kwargs of LocalizeMoleculesLive
+        parallel = kwargs.pop("parallel", {})  # kwargs of LocalizeMolecules (workers, chunkSize, tiling)
         
         # Axial calibration
         if not onlyPostprocessor:
@@ -392,8 +502,11 @@ class CommandLineSMolPhot(object):
         
         # Localize
         startTime = time()
-        if not onlyPostprocessor:
-            self._originalLocs = self.LocalizeMolecules()
+        if not onlyPostprocessor and live is not None:
+            self._originalLocs = self.LocalizeMoleculesLive(**live)
+            self._originalStats = self.CompareWithGroundTruth(self._originalLocs)
+        elif not onlyPostprocessor:
+            self._originalLocs = self.LocalizeMolecules(**parallel)
             self._originalStats = self.CompareWithGroundTruth(self._originalLocs)
         else:
             self.logger.info("Run skipped, only postprocessing!")
@@ -420,5 +533,46 @@ class CommandLineSMolPhot(object):
 
         return postprocessedLocs, postprocessedStats, statsHistory, totalLocalizeTime
 
+#===============================================================================
+# Parallel localization workers
+#===============================================================================
+
+_localizeWorkerState = {}
+
+def _FindMolecules(localizer, frame, psf, axialCalibrator, fitMode, tiling):
+    if tiling is None:
+        return localizer.FindMolecules(frame, psf, axialCalibrator, fitMode = fitMode)
+    return localizer.FindMoleculesTiled(frame, psf, axialCalibrator, fitMode = fitMode, **tiling)
+
+def _InitLocalizeWorker(conf, moduleNames, datasetMetafile, fseriesKwargs, axialCalibration):
+    # Modules are rebuilt from conf and the frame series is reopened in every
+    # worker process
+    (preprocessors, localizers, axialCalibrators, psfs, _, _), saveToConfList = SMolPhot.ModuleConf.GetModuleConf()
+    SetConf(saveToConfList, conf, suppressWarnings = True)
+    fseries = SMolPhot.FrameSeries.FromMetafile(datasetMetafile, preprocessors, **fseriesKwargs)
+    
+    psf = CommandLineSMolPhot.GetByName(psfs, moduleNames["psf"])
+    psf.SetAxialCalibration(axialCalibration)
+    localizer = CommandLineSMolPhot.GetByName(localizers, moduleNames["localizer"])
+    axialCalibrator = CommandLineSMolPhot.GetByName(axialCalibrators, moduleNames["axialCalibrator"])
+    localizer.InitTileWorker(psf, axialCalibrator, fseries)
+    _localizeWorkerState.update({"fseries": fseries,
+                                 "localizer": localizer,
+                                 "axialCalibrator": axialCalibrator,
+                                 "psf": psf})
+
+def _LocalizeFrameRange((frameFrom, frameTo)):
+    startTime = time()
+    state = _localizeWorkerState
+    psf = state["psf"]
+    fitMode = "z" if psf.hasCalibrationData else "sigma"
+    
+    locs = []
+    for nr in range(frameFrom, frameTo):
+        frame = state["fseries"].GetPreprocessedFrame(nr)
+        locs += state["localizer"].FindMolecules(frame, psf, state["axialCalibrator"], fitMode = fitMode)
+    logger.debug("Localized frames %d-%d in %.2f s" % (frameFrom, frameTo - 1, time() - startTime))
+    return locs, time() - startTime
+
 if __name__ == '__main__':
     pass
\ No newline at end of file
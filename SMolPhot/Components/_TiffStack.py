@@ -0,0 +1,436 @@
+"""Implements TiffStack class for lazy random access to the pages of a
+multi-page TIFF file.
+
+"""
+
+import io
+import os
+import mmap
+import struct
+import logging
+import multiprocessing
+import numpy as np
+from PIL import Image
+from multiprocessing.pool import ThreadPool
+
+__all__ = ["TiffStack"]
+
+# TIFF tags needed to locate the pixel data of a page
+TAG_IMAGE_WIDTH = 256
+TAG_IMAGE_LENGTH = 257
+TAG_BITS_PER_SAMPLE = 258
+TAG_COMPRESSION = 259
+TAG_STRIP_OFFSETS = 273
+TAG_SAMPLES_PER_PIXEL = 277
+TAG_STRIP_BYTE_COUNTS = 279
+TAG_TILE_WIDTH = 322
+TAG_SAMPLE_FORMAT = 339
+
+_TAGS_NEEDED = set([TAG_IMAGE_WIDTH, TAG_IMAGE_LENGTH, TAG_BITS_PER_SAMPLE,
+                    TAG_COMPRESSION, TAG_STRIP_OFFSETS, TAG_SAMPLES_PER_PIXEL,
+                    TAG_STRIP_BYTE_COUNTS, TAG_TILE_WIDTH, TAG_SAMPLE_FORMAT])
+
+# TIFF field type -> struct format
+_FIELD_FORMATS = {1: "B", 3: "H", 4: "I", 6: "b", 8: "h", 9: "i", 16: "Q", 17: "q"}
+
+# (SampleFormat, BitsPerSample) -> numpy dtype character
+_SAMPLE_DTYPES = {(1, 8): "u1", (1, 16): "u2", (1, 32): "u4",
+                  (2, 8): "i1", (2, 16): "i2", (2, 32): "i4",
+                  (3, 32): "f4", (3, 64): "f8"}
+
+# Version of the persisted page index file format
+_INDEX_VERSION = 1
+
+#===============================================================================
+# TiffStack
+#===============================================================================
+
+class TiffStack(object):
+    """Random access to the pages of a (Big)TIFF stack. The IFD chain is
+    walked only once to build the index of page offsets, the pixel data of
+    uncompressed pages is memory-mapped and nothing is decoded until
+    GetPageData() is called. Pages that can not be memory-mapped (compressed,
+    tiled, ...) are decoded by PIL on demand, directly from their IFD.
+
+    The page index is persisted next to the stack (see IndexFilename()), so
+    that the stack can be reopened without walking the IFD chain again.
+
+    In live mode the stack may still be written by the acquisition software:
+    Refresh() indexes the pages appended since the last call, pages which
+    IFD or pixel data is not completely written yet are left for later.
+
+    Args:
+        filename (str): the filename of the TIFF stack
+        maxPages (int, optional): maximum number of pages to index
+        persistIndex (bool, optional = True): load/save page index file
+        decoderThreads (int, optional): number of threads used by MapPages,
+            defaults to the number of CPUs
+        live (bool, optional = False): the file may still grow, the page index
+            is not persisted
+
+    """
+
+    def __init__(self, filename, maxPages = None, persistIndex = True, decoderThreads = None, \
+                 live = False):
+        self.logger = logging.getLogger("SMolPhot.TiffStack")
+        self._filename = filename
+        self._maxPages = int(1e9) if maxPages is None else maxPages
+        self._persistIndex = persistIndex and not live
+        self._decoderThreads = multiprocessing.cpu_count() if decoderThreads is None else decoderThreads
+        self._decoderPool = None
+        self._live = live
+
+        self._file = open(filename, "rb")
+        self._mmap = None
+        self._oldMmaps = []
+        self._firstIfdOffset = None
+        self._lastIfdOffset = None
+        self._indexComplete = False
+        self._ifdOffsets = np.zeros((0,), dtype = np.int64)
+        self._dataOffsets = np.zeros((0,), dtype = np.int64)
+        self._shapes = np.zeros((0, 2), dtype = np.int64)
+        self._dtypes = []
+
+        if live:
+            self.Refresh()
+            return
+
+        self._mmap = mmap.mmap(self._file.fileno(), 0, access = mmap.ACCESS_READ)
+        self._ReadHeader()
+        if not (self._persistIndex and self._LoadPageIndex()):
+            self._BuildPageIndex()
+            if self._persistIndex:
+                self._SavePageIndex()
+
+    @staticmethod
+    def IndexFilename(filename):
+        return "%s.index.npz" % (filename)
+
+    def GetPageData(self, nr):
+        """Returns raw pixel data of the page (rows, columns) in the file
+        dtype. For memory-mapped pages a read-only view is returned. Can be
+        called concurrently from several threads.
+
+        Args:
+            nr (int): number of the page
+
+        Returns:
+            numpy array: page data
+
+        """
+        if nr < 0:
+            nr += len(self)
+        if nr < 0 or nr >= len(self):
+            raise IndexError("Page %d out of range (%d pages)" % (nr, len(self)))
+
+        dataOffset = self._dataOffsets[nr]
+        if dataOffset >= 0:
+            return np.ndarray(tuple(self._shapes[nr]), dtype = self._dtypes[nr], \
+                              buffer = self._mmap, offset = dataOffset)
+
+        # Not memory-mappable, decode by PIL, every call uses its own file object
+        if self._bigTiff:
+            header = self._mmap[:8] + struct.pack(self._byteOrder + "Q", int(self._ifdOffsets[nr]))
+        else:
+            header = self._mmap[:4] + struct.pack(self._byteOrder + "I", int(self._ifdOffsets[nr]))
+        pageFile = io.BufferedReader(_PageFile(self._mmap, header))
+        return np.array(Image.open(pageFile))
+
+    def MapPages(self, func, nrs):
+        """Decodes pages concurrently by a pool of threads and applies func to
+        the decoded data.
+
+        Args:
+            func (function): called as func(nr, data) for every page
+            nrs (list of int): numbers of the pages
+
+        Returns:
+            list: results of func in the same order as nrs
+
+        """
+        nrs = list(nrs)
+        if self._decoderThreads <= 1 or len(nrs) <= 1:
+            return [func(nr, self.GetPageData(nr)) for nr in nrs]
+
+        if self._decoderPool is None:
+            self._decoderPool = ThreadPool(self._decoderThreads)
+        chunkSize = max(1, len(nrs) // (4 * self._decoderThreads))
+        return self._decoderPool.map(lambda nr: func(nr, self.GetPageData(nr)), nrs, chunkSize)
+
+    def Refresh(self):
+        """Live mode: indexes the pages appended to the stack since the last
+        call. Only completely written pages are indexed.
+
+        Returns:
+            int: number of new pages
+
+        """
+        if not self._live:
+            return 0
+
+        # Map the grown file, old map is kept alive for already returned views
+        fileSize = os.fstat(self._file.fileno()).st_size
+        if fileSize < 8:
+            return 0
+        if self._mmap is None or fileSize > len(self._mmap):
+            if self._mmap is not None:
+                self._oldMmaps.append(self._mmap)
+            self._mmap = mmap.mmap(self._file.fileno(), 0, access = mmap.ACCESS_READ)
+
+        if self._firstIfdOffset is None:
+            try:
+                self._ReadHeader()
+            except struct.error:
+                return 0
+            if self._firstIfdOffset == 0:
+                self._firstIfdOffset = None
+                return 0
+
+        if self._lastIfdOffset is None:
+            ifdOffset = self._firstIfdOffset
+        else:
+            _, ifdOffset = self._ReadIfd(self._lastIfdOffset)
+
+        nrOfPagesBefore = len(self)
+        self._IndexPages(ifdOffset)
+        return len(self) - nrOfPagesBefore
+
+    def Close(self):
+        if self._decoderPool is not None:
+            self._decoderPool.terminate()
+            self._decoderPool = None
+        self._mmap.close()
+        for oldMmap in self._oldMmaps:
+            oldMmap.close()
+        self._oldMmaps = []
+        self._file.close()
+
+    def __len__(self):
+        return len(self._dataOffsets)
+
+    @property
+    def filename(self):
+        return self._filename
+
+    @property
+    def nrOfMappedPages(self):
+        return int((self._dataOffsets >= 0).sum())
+
+    @property
+    def live(self):
+        return self._live
+
+    # Private methods
+
+    def _Unpack(self, fmt, offset):
+        return struct.unpack_from(self._byteOrder + fmt, self._mmap, offset)
+
+    def _ReadHeader(self):
+        byteOrder = self._mmap[:2]
+        if byteOrder == "II":
+            self._byteOrder = "<"
+        elif byteOrder == "MM":
+            self._byteOrder = ">"
+        else:
+            raise ValueError("Not a TIFF file: %s" % (self._filename))
+
+        magic = self._Unpack("H", 2)[0]
+        if magic == 42:
+            self._bigTiff = False
+            self._firstIfdOffset = self._Unpack("I", 4)[0]
+        elif magic == 43:
+            self._bigTiff = True
+            self._firstIfdOffset = self._Unpack("Q", 8)[0]
+        else:
+            raise ValueError("Unknown TIFF version %d: %s" % (magic, self._filename))
+
+    def _ReadIfd(self, ifdOffset):
+        if self._bigTiff:
+            nrOfEntries = self._Unpack("Q", ifdOffset)[0]
+            entriesStart, entrySize, countFmt, pointerFmt = ifdOffset + 8, 20, "Q", "Q"
+        else:
+            nrOfEntries = self._Unpack("H", ifdOffset)[0]
+            entriesStart, entrySize, countFmt, pointerFmt = ifdOffset + 2, 12, "I", "I"
+        valueFieldSize = struct.calcsize(pointerFmt)
+
+        tags = {}
+        for i in range(nrOfEntries):
+            entryOffset = entriesStart + i * entrySize
+            tag, fieldType = self._Unpack("HH", entryOffset)
+            if tag not in _TAGS_NEEDED or fieldType not in _FIELD_FORMATS:
+                continue
+
+            count = self._Unpack(countFmt, entryOffset + 4)[0]
+            valueFmt = "%d%s" % (count, _FIELD_FORMATS[fieldType])
+            valueOffset = entryOffset + 4 + valueFieldSize
+            if struct.calcsize(valueFmt) > valueFieldSize:
+                valueOffset = self._Unpack(pointerFmt, valueOffset)[0]
+            tags[tag] = self._Unpack(valueFmt, valueOffset)
+
+        nextIfdOffset = self._Unpack(pointerFmt, entriesStart + nrOfEntries * entrySize)[0]
+        return tags, nextIfdOffset
+
+    def _GetDataOffset(self, tags, shape, dtype):
+        # Returns offset of the pixel data or -1 if page is not memory-mappable
+        if dtype is None or TAG_STRIP_OFFSETS not in tags or TAG_TILE_WIDTH in tags:
+            return -1
+        if tags.get(TAG_COMPRESSION, (1,))[0] != 1 or \
+            tags.get(TAG_SAMPLES_PER_PIXEL, (1,))[0] != 1:
+            return -1
+
+        # Strips must be contiguous
+        stripOffsets = tags[TAG_STRIP_OFFSETS]
+        stripByteCounts = tags.get(TAG_STRIP_BYTE_COUNTS)
+        if stripByteCounts is None or len(stripByteCounts) != len(stripOffsets):
+            return -1
+        for i in range(1, len(stripOffsets)):
+            if stripOffsets[i] != stripOffsets[i - 1] + stripByteCounts[i - 1]:
+                return -1
+
+        dataSize = shape[0] * shape[1] * np.dtype(dtype).itemsize
+        if sum(stripByteCounts) < dataSize or stripOffsets[0] + dataSize > len(self._mmap):
+            return -1
+        return stripOffsets[0]
+
+    def _IsPageWritten(self, ifdOffset):
+        # Live mode: IFD and all the strips/tiles of the page must be in file
+        try:
+            tags, _ = self._ReadIfd(ifdOffset)
+            shape = (tags[TAG_IMAGE_LENGTH][0], tags[TAG_IMAGE_WIDTH][0])
+        except (struct.error, KeyError):
+            return False
+
+        offsets = tags.get(TAG_STRIP_OFFSETS, ())
+        byteCounts = tags.get(TAG_STRIP_BYTE_COUNTS, ())
+        if len(offsets) == 0 or len(offsets) != len(byteCounts) or min(shape) <= 0:
+            return False
+        return max(o + c for o, c in zip(offsets, byteCounts)) <= len(self._mmap)
+
+    def _IndexPages(self, ifdOffset):
+        # Appends pages starting from ifdOffset to the index
+        ifdOffsets, dataOffsets, shapes, dtypes = [], [], [], []
+
+        while ifdOffset != 0 and len(self._dataOffsets) + len(dataOffsets) < self._maxPages:
+            if self._live and not self._IsPageWritten(ifdOffset):
+                break
+
+            ifdOffsets.append(ifdOffset)
+            self._lastIfdOffset = ifdOffset
+            tags, ifdOffset = self._ReadIfd(ifdOffset)
+
+            shape = (tags[TAG_IMAGE_LENGTH][0], tags[TAG_IMAGE_WIDTH][0])
+            sampleType = (tags.get(TAG_SAMPLE_FORMAT, (1,))[0], tags.get(TAG_BITS_PER_SAMPLE, (1,))[0])
+            dtype = _SAMPLE_DTYPES.get(sampleType)
+            if dtype is not None:
+                dtype = self._byteOrder + dtype
+
+            dataOffsets.append(self._GetDataOffset(tags, shape, dtype))
+            shapes.append(shape)
+            dtypes.append(dtype)
+
+        self._indexComplete = ifdOffset == 0
+        self._ifdOffsets = np.append(self._ifdOffsets, np.array(ifdOffsets, dtype = np.int64))
+        self._dataOffsets = np.append(self._dataOffsets, np.array(dataOffsets, dtype = np.int64))
+        self._shapes = np.append(self._shapes, np.array(shapes, dtype = np.int64).reshape((-1, 2)), axis = 0)
+        self._dtypes = self._dtypes + dtypes
+
+    def _BuildPageIndex(self):
+        self.logger.debug("BuildPageIndex %s" % (self._filename))
+        self._IndexPages(self._firstIfdOffset)
+        self.logger.debug("BuildPageIndex done (pages %d, memory-mapped %d)" % \
+                          (len(self), self.nrOfMappedPages))
+
+    def _GetFileSignature(self):
+        stat = os.stat(self._filename)
+        return np.array([_INDEX_VERSION, stat.st_size, int(1e6 * stat.st_mtime)], dtype = np.int64)
+
+    def _SavePageIndex(self):
+        indexFilename = TiffStack.IndexFilename(self._filename)
+        try:
+            with open(indexFilename, "wb") as stream:
+                np.savez(stream,
+                         signature = self._GetFileSignature(),
+                         complete = self._indexComplete,
+                         ifdOffsets = self._ifdOffsets,
+                         dataOffsets = self._dataOffsets,
+                         shapes = self._shapes,
+                         dtypes = np.array(["" if d is None else d for d in self._dtypes]))
+        except (IOError, OSError):
+            self.logger.warn("Unable to save page index %s" % (indexFilename))
+            return
+        self.logger.debug("Page index saved to %s" % (indexFilename))
+
+    def _LoadPageIndex(self):
+        # Returns True if valid index was loaded
+        indexFilename = TiffStack.IndexFilename(self._filename)
+        if not os.path.isfile(indexFilename):
+            return False
+
+        try:
+            with np.load(indexFilename) as index:
+                if not np.array_equal(index["signature"], self._GetFileSignature()):
+                    self.logger.info("Page index %s is outdated" % (indexFilename))
+                    return False
+
+                complete = bool(index["complete"])
+                if not complete and len(index["ifdOffsets"]) < self._maxPages:
+                    return False
+
+                sl = slice(0, self._maxPages)
+                self._indexComplete = complete and len(index["ifdOffsets"]) <= self._maxPages
+                self._ifdOffsets = index["ifdOffsets"][sl]
+                self._dataOffsets = index["dataOffsets"][sl]
+                self._shapes = index["shapes"][sl]
+                self._dtypes = [None if d == "" else str(d) for d in index["dtypes"][sl]]
+        except Exception:
+            self.logger.warn("Unable to load page index %s" % (indexFilename))
+            return False
+
+        self.logger.debug("Page index loaded from %s (pages %d)" % (indexFilename, len(self)))
+        return True
+
+#===============================================================================
+# _PageFile
+#===============================================================================
+
+class _PageFile(io.RawIOBase):
+    """Read-only file object over the memory-mapped TIFF stack, which header
+    is replaced to point to the IFD of a single page. Allows PIL to open any
+    page without seeking through all the previous pages.
+
+    """
+
+    def __init__(self, fileMmap, header):
+        io.RawIOBase.__init__(self)
+        self._mmap = fileMmap
+        self._header = header
+        self._pos = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def seek(self, offset, whence = io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            offset += self._pos
+        elif whence == io.SEEK_END:
+            offset += len(self._mmap)
+        self._pos = offset
+        return self._pos
+
+    def tell(self):
+        return self._pos
+
+    def readinto(self, buf):
+        start = self._pos
+        data = self._mmap[start:start + len(buf)]
+        if start < len(self._header):
+            data = (self._header[start:] + data[len(self._header) - start:])[:len(data)]
+        buf[:len(data)] = data
+        self._pos += len(data)
+        return len(data)
+
+if __name__ == "__main__":
+    pass
@@ -3,6 +3,7 @@
 """
 
 from _Frames import Frame, FrameSeries
+from _TiffStack import TiffStack
 from _Publishing import PublishToToplist, SaveResultsToFile
 from _GroundTruths import GroundTruthStats
 from _RatingFuncGenerator import RatingFuncGenerator
@@ -1,15 +1,139 @@
 """Implements blob detection localizer.
 
 """
+import math
 import logging
 import numpy as np
+from scipy import ndimage
+from scipy.spatial import cKDTree
 from SMolPhot.Components.BaseClasses import Param
-from _Common import LocalizerBase
-from skimage.feature import blob_log
+from _Common import LocalizerBase, GridHash
+from skimage import img_as_float
+from skimage.feature import peak_local_max
 
 __all__ = ["BlobDetectionLocalizer"]
 
 
+def _PruneBlobs(blobs, overlap):
+    # Same as _prune_blobs of skimage 0.14 (2D), private in skimage and its
+    # signature changed in later versions. Of two blobs overlapping more
+    # than overlap (fraction of the smaller area) the smaller is removed.
+    distance = 2.0 * blobs[:, -1].max() * math.sqrt(2.0)
+    pairs = list(cKDTree(blobs[:, :-1]).query_pairs(distance))
+    if len(pairs) == 0:
+        return blobs
+    for i, j in pairs:
+        blob1, blob2 = blobs[i], blobs[j]
+        if _BlobOverlap(blob1, blob2) > overlap:
+            if blob1[-1] > blob2[-1]:
+                blob2[-1] = 0
+            else:
+                blob1[-1] = 0
+    return np.array([b for b in blobs if b[-1] > 0])
+
+def _BlobOverlap(blob1, blob2):
+    # Overlapping area fraction of two disks of radius sqrt(2) * sigma
+    r1, r2 = blob1[-1] * math.sqrt(2.0), blob2[-1] * math.sqrt(2.0)
+    d = math.sqrt(np.sum((blob1[:-1] - blob2[:-1]) ** 2))
+    if d > r1 + r2:
+        return 0
+    
+    # One blob is inside the other, the smaller must be removed
+    if d <= abs(r1 - r2):
+        return 1
+    
+    acos1 = math.acos(np.clip((d ** 2 + r1 ** 2 - r2 ** 2) / (2 * d * r1), -1, 1))
+    acos2 = math.acos(np.clip((d ** 2 + r2 ** 2 - r1 ** 2) / (2 * d * r2), -1, 1))
+    a, b, c, e = -d + r2 + r1, d - r2 + r1, d + r2 - r1, d + r2 + r1
+    area = r1 ** 2 * acos1 + r2 ** 2 * acos2 - 0.5 * math.sqrt(abs(a * b * c * e))
+    return area / (math.pi * min(r1, r2) ** 2)
+
+
+class LogScaleSpace(object):
+    """Scale-normalized Laplacian of Gaussian stack of the frame data, as
+    computed by skimage.feature.blob_log. After PSFs are subtracted from the
+    data, only the parts of the stack within the kernel radius of the
+    subtracted boxes are recomputed.
+
+    """
+
+    def __init__(self, data, minSigma, maxSigma, numSigma):
+        self.sigmas = np.linspace(minSigma, maxSigma, numSigma)
+        # gaussian_laplace kernel radius (truncate=4.0) and response to a constant image
+        self.radii = [int(4.0 * s + 0.5) for s in self.sigmas]
+        self.constantResponses = np.array([ndimage.gaussian_laplace(np.ones((1, 1)), s)[0, 0] * s ** 2
+                                           for s in self.sigmas])
+
+        # Kernels of gaussian_laplace (0th and 2nd order) from impulse responses,
+        # scipy would recompute them for every call
+        self._kernels = []
+        for s, r in zip(self.sigmas, self.radii):
+            impulse = np.zeros((2 * r + 1,))
+            impulse[r] = 1.0
+            self._kernels.append([ndimage.gaussian_filter1d(impulse, s, order=order, mode="constant")[::-1]
+                                  for order in (0, 2)])
+        self._Compute(img_as_float(data))
+
+    def Update(self, data, boxes, offset=0.0):
+        """Updates the stack after the data was changed inside boxes
+        (x0, y0, x1, y1), box None means a change in the whole frame. The
+        constant offset subtracted from the whole frame is accounted without
+        recomputing.
+
+        """
+        image = img_as_float(data)
+        if any(box is None for box in boxes):
+            self._Compute(image)
+            return
+
+        if offset != 0.0:
+            self.cube += offset * self.constantResponses
+
+        for k, r in enumerate(self.radii):
+            # Merge overlapping areas affected by the kernel
+            mask = np.zeros(image.shape, dtype=bool)
+            for x0, y0, x1, y1 in boxes:
+                mask[max(0, x0 - r):x1 + r, max(0, y0 - r):y1 + r] = True
+            # Input padded by kernel radius gives exact values inside the slices
+            crops = []
+            for sX, sY in ndimage.find_objects(ndimage.label(mask)[0]):
+                x0, y0 = max(0, sX.start - r), max(0, sY.start - r)
+                x1, y1 = min(image.shape[0], sX.stop + r), min(image.shape[1], sY.stop + r)
+                crops.append((sX, sY, x0, y0, x1, y1))
+
+            if sum((x1 - x0) * (y1 - y0) for _, _, x0, y0, x1, y1 in crops) >= image.size:
+                self.cube[:, :, k] = self._Laplace(image, k)
+                continue
+
+            for sX, sY, x0, y0, x1, y1 in crops:
+                res = self._Laplace(image[x0:x1, y0:y1], k)
+                self.cube[sX, sY, k] = res[sX.start - x0:sX.stop - x0, sY.start - y0:sY.stop - y0]
+
+    def FindBlobs(self, threshold, overlap=0.5):
+        """Same as skimage.feature.blob_log, returns array of (xI, yI, sigma).
+
+        """
+        localMaxima = peak_local_max(self.cube, threshold_abs=threshold,
+                                     footprint=np.ones((3, 3, 3)),
+                                     threshold_rel=0.0,
+                                     exclude_border=False)
+        if localMaxima.size == 0:
+            return np.empty((0, 3))
+        lm = localMaxima.astype(np.float64)
+        lm[:, -1] = self.sigmas[localMaxima[:, -1]]
+        return _PruneBlobs(lm, overlap)
+
+    def _Compute(self, image):
+        self.cube = np.stack([self._Laplace(image, k) for k in range(len(self.sigmas))], axis=-1)
+
+    def _Laplace(self, image, k):
+        # Same operations as -gaussian_laplace(image, sigma) * sigma ** 2
+        kernel0, kernel2 = self._kernels[k]
+        res = ndimage.correlate1d(ndimage.correlate1d(image, kernel2, 0), kernel0, 1)
+        res += ndimage.correlate1d(ndimage.correlate1d(image, kernel0, 0), kernel2, 1)
+        return -res * self.sigmas[k] ** 2
+
+
 class BlobDetectionLocalizer(LocalizerBase):
     """Blob detection localizer.
 
@@ -89,19 +213,46 @@ class BlobDetectionLocalizer(LocalizerBase):
         pass
 
     def FindMolecules(self, frame, psf, axialCalibrator, fitMode="z"):
+
+        def _CheckMolecule(locFit):
+            if locFit is None:
+                return None
+
+            if min(locFit.x, locFit.y) < self._borderRegionWidth or \
+                locFit.x + self._borderRegionWidth > frame.sizeX or \
+                locFit.y + self._borderRegionWidth > frame.sizeY:
+                self.logger.debug("Dismissed, in border requion")
+                return None
+
+            x, y = locFit.initial[:2]
+            if np.sqrt((locFit.x - x) ** 2.0 + (locFit.y - y) ** 2.0) > self._initialMaxDist:
+                self.logger.debug("Dismissed, far from origin")
+                return None
+
+            if locFit.photons < self._minPhotons:
+                self.logger.debug("Dismissed, photon flux low %.2f" % (locFit.photons))
+                return None
+
+            if locFit.z is not None:
+                if locFit.z < axialCalibrator._calibFrom or locFit.z > axialCalibrator._calibTo:
+                    self.logger.debug("Dismissed, outside axial calibration range %.2f nm" % (1e9 * locFit.z))
+                    return None
+
+            return locFit
+
         self.logger.info("Find molecules frame #%d, fitmode %s" % (frame.nr, fitMode))
-        frameData = frame.data.copy()
-        locs = []
+        frameResidual = frame.CopyFrame()
+        scaleSpace = LogScaleSpace(frameResidual.data, self.minSigma, self.maxSigma, self.numSigma)
+        locs, locsGrid = [], GridHash(max(self._duplicateMinDist, frame.pixelSize))
 
         for i in range(self.maxIterations):
             locsAdded = []
-            blobs = blob_log(frameData, min_sigma=self.minSigma, max_sigma=self.maxSigma, num_sigma=self.numSigma,
-                             threshold=self.detThreshold)
+            blobs = scaleSpace.FindBlobs(self.detThreshold)
 
             if len(blobs) == 0: # No molecules were found
                 break
 
-            maxIndices = blobs[:,:2].T.astype('uint8')
+            maxIndices = blobs[:,:2].T.astype(int)
             maxCoords = frame.GetPixelCoords(maxIndices)
 
             self.logger.debug("Max Indices %s" % (str(maxIndices)))
@@ -109,6 +260,7 @@ class BlobDetectionLocalizer(LocalizerBase):
 
             pixelsX, pixelsY = frame.pixelsX, frame.pixelsY
 
+            candidates = []
             for x, y, xI, yI in zip(maxCoords[0], maxCoords[1], maxIndices[0], maxIndices[1]):
                 self.logger.debug("Potential local maximum at pixel (%d, %d)" % (xI, yI))
                 if min(xI, yI) < 1 or \
@@ -116,68 +268,47 @@ class BlobDetectionLocalizer(LocalizerBase):
                     yI + 1 >= pixelsY:
                     self.logger.debug("Dismissed, pixel on edge")
                     continue
+                candidates.append((x, y))
 
-                locFit = psf.Fit(frame, (x, y), self.fitPixels, \
-                             fitMode = fitMode, \
-                             initialMaxDist = self._initialMaxDist)
+            # Fit all candidates at once
+            locFits = psf.FitBatch(frame, candidates, self.fitPixels, \
+                                   fitMode = fitMode, \
+                                   initialMaxDist = self._initialMaxDist, \
+                                   acceptFunc = lambda locFit: _CheckMolecule(locFit) is not None)
 
-                if locFit is None:
-                    continue
+            for locFit in locFits:
+                if _CheckMolecule(locFit) is not None:
+                    locsAdded.append(locFit)
 
-                if min(locFit.x, locFit.y) < self._borderRegionWidth or \
-                    locFit.x + self._borderRegionWidth > frame.sizeX or \
-                    locFit.y + self._borderRegionWidth > frame.sizeY:
-                    self.logger.debug("Dismissed, in border requion")
-                    continue
-
-                if np.sqrt((locFit.x - x) ** 2.0 + (locFit.y - y) ** 2.0) > self._initialMaxDist:
-                    self.logger.debug("Dismissed, far from origin")
-                    continue
+            if len(locsAdded) == 0: # No molecules were found
+                break
 
-                if locFit.photons < self._minPhotons:
-                    self.logger.debug("Dismissed, photon flux low %.2f" % (locFit.photons))
+            # Check for duplicates, locs already found have priority
+            for loc in locsAdded:
+                if any(distXY < self._duplicateMinDist for distXY, _ in \
+                       locsGrid.Query(loc.x, loc.y, self._duplicateMinDist)):
+                    # More then one molecule at same location
+                    self.logger.debug("Found duplicate locations, removing one.")
                     continue
+                locsGrid.Add(loc.x, loc.y)
+                locs.append(loc)
 
-                if locFit.z is not None:
-                    if locFit.z < axialCalibrator._calibFrom or locFit.z > axialCalibrator._calibTo:
-                        self.logger.debug("Dismissed, outside axial calibration range %.2f nm" % (1e9 * locFit.z))
-                        continue
-
-                locsAdded.append(locFit)
-
-            if len(locsAdded) == 0: # No molecules were found
+            if i + 1 == self.maxIterations:
                 break
-            locs += locsAdded
-
-
-            # Check for duplicates
-            duplicate = [False] * len(locs)
-            for i in range(len(locs)):
-                for j in range(i + 1, len(locs)):
-                    if duplicate[j] or duplicate[i]:
-                        continue
-                    distXY = np.sqrt((locs[i].x - locs[j].x) ** 2.0 + (locs[i].y - locs[j].y) ** 2.0)
-                    if distXY < self._duplicateMinDist:
-                        # More then one molecule at same locationd
-                        duplicate[j] = True
-                        self.logger.debug("Found duplicate locations, removing one.")
-
-            for i in range(len(locs) - 1, -1, -1):
-                if duplicate[i]:
-                    del locs[i]
-                    self.logger.debug("Deleted loc %d" % (i))
-
-            # Residual
-            for loc in locsAdded:
-                xs, ys = frame.coords
-                fitParams = list(loc.bestFitParams)
-                if self._removeOffset == 1:
-                    fitParams[-1] = 0  # Assumes that offset is the last parameter and sets it to 0
-                psfData = psf.Calc((xs, ys), *fitParams)
-                frameData -= psfData
+
+            # Residual, fitted offsets are kept only if _removeOffset is set
+            subtractOffset = self._removeOffset == 0
+            boxes = [frameResidual.GetSubtractionBox(psf, loc) for loc in locsAdded]
+            frameResidual.SubtractLocs(psf, locsAdded, subtractOffset = subtractOffset)
+            scaleSpace.Update(frameResidual.data, boxes, \
+                              sum(loc.bestFitParams[-1] for loc in locsAdded) if subtractOffset else 0.0)
 
         return locs
 
+    def GetTileHalo(self, pixelSize):
+        # LoG kernel radius of maxSigma (truncate=4.0) and 3x3x3 peak neighbourhood
+        return self._TileHalo(pixelSize, self.fitPixels, int(4.0 * self.maxSigma + 0.5) + 1)
+
     @property
     def name(self):
         return "Blob Detection Localizer"
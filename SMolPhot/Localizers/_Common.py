@@ -2,11 +2,21 @@
 
 """
 
+import os
+import copy
+import math
+import time
+import logging
 import numpy as np
+from collections import defaultdict
+from scipy.spatial import cKDTree
+from SMolPhot.Components import Frame
 from SMolPhot.Components.BaseClasses import ParamsBaseClass
 
 __all__ = []
 
+logger = logging.getLogger("SMolPhot.Localizers")
+
                 
 class SimpleRegion():
     def __init__(self, offset, bbox):
@@ -14,67 +24,203 @@ class SimpleRegion():
         self.bbox = bbox
                 
 #===============================================================================
-# AddLocsWoDuplicates
+# GridHash
 #===============================================================================
 
-def AddLocsWoDuplicates(locs, locsToAdd, minSameIterationDistXY, minDistXY, logger):
-        # Modifies locs
-        # Assumes, that locs contain no duplicates
-        distFunc = lambda loc1, loc2: np.sqrt((loc1.x - loc2.x) ** 2.0 + (loc1.y - loc2.y) ** 2.0)
-    
-        duplicate = [False] * len(locsToAdd)        
-        for i in range(len(locsToAdd) -1, -1, -1):
-            # Check if locsToAdd[i] is duplicate
-              
-            # Check against old locations
-            for j in range(len(locs)):
-                if duplicate[i]:
-                    # if already duplicate
-                    break
-                
-                distXY = distFunc(locsToAdd[i], locs[j])
-                if distXY < minDistXY:
-                    logger.debug("Found duplicate location (cmp with old locs), removing.")
-                    duplicate[i] = True
-                    
-            # Check against new locations
-            for j in range(i):
-                if duplicate[i]:
-                    # if already duplicate
-                    break
-                
-                distXY = distFunc(locsToAdd[i], locsToAdd[j])
-                if distXY < minSameIterationDistXY:
-                    logger.debug("Found duplicate location (cmp with new locs), removing.")
-                    duplicate[i] = True
+class GridHash(object):
+    """Spatial hash of points on a regular grid of square cells. Points
+    closer than cellSize are found by checking only the neighbouring cells.
+    
+    """
+    
+    def __init__(self, cellSize):
+        self.cellSize = float(cellSize)
+        self._cells = defaultdict(list)
+        
+    def Add(self, x, y, item = None):
+        self._cells[self._Cell(x, y)].append((x, y, item))
         
-        locsToAddNew = [loc for i, loc in enumerate(locsToAdd) if not duplicate[i]]
-        locs += locsToAddNew
+    def Query(self, x, y, maxDist):
+        """Returns list of (dist, item) of all points within distance
+        maxDist (inclusive) from (x, y).
         
-        return locs, locsToAddNew
+        """
+        n = max(1, int(math.ceil(maxDist / self.cellSize)))
+        cX, cY = self._Cell(x, y)
+        res = []
+        for i in range(cX - n, cX + n + 1):
+            for j in range(cY - n, cY + n + 1):
+                for pX, pY, item in self._cells.get((i, j), ()):
+                    dist = math.sqrt((pX - x) ** 2.0 + (pY - y) ** 2.0)
+                    if dist <= maxDist:
+                        res.append((dist, item))
+        return res
+        
+    def _Cell(self, x, y):
+        return int(math.floor(x / self.cellSize)), int(math.floor(y / self.cellSize))
+    
+#===============================================================================
+# AddLocsWoDuplicates
+#===============================================================================
+
+def AddLocsWoDuplicates(locs, locsToAdd, minSameIterationDistXY, minDistXY, logger):
+    """Adds locsToAdd to locs (modified), except the locations closer than
+    minDistXY to any of locs or closer than minSameIterationDistXY to any
+    preceding location in locsToAdd. Assumes, that locs contain no
+    duplicates.
+    
+    Returns:
+        (locs, locsToAddNew)
+    
+    """
+    coordsOld, coordsNew = _GetLocsXY(locs), _GetLocsXY(locsToAdd)
+    
+    # Check against old locations
+    duplicate = np.zeros((len(locsToAdd),), dtype = bool)
+    if len(locs) > 0 and len(locsToAdd) > 0:
+        for i, j in _FindPairsCloserThan(coordsNew, coordsOld, minDistXY):
+            if not duplicate[i]:
+                logger.debug("Found duplicate location (cmp with old locs), removing.")
+                duplicate[i] = True
+    
+    # Check against new locations, preceding locations have priority
+    if len(locsToAdd) > 1:
+        for i, j in _FindPairsCloserThan(coordsNew, coordsNew, minSameIterationDistXY):
+            if j < i and not duplicate[i]:
+                logger.debug("Found duplicate location (cmp with new locs), removing.")
+                duplicate[i] = True
+    
+    locsToAddNew = [loc for i, loc in enumerate(locsToAdd) if not duplicate[i]]
+    locs += locsToAddNew
+    
+    return locs, locsToAddNew
         
 
 #===============================================================================
 # CalcMinimumDistance
 #===============================================================================
 
-def CalcMinimumDistance(locs):
-    
-    for i in range(len(locs)):
-        # find minimum distance
-        minDistXY = np.inf
-        for j in range(len(locs)):
-            if i == j:
-                continue
-            distXY = np.sqrt((locs[i].x - locs[j].x) ** 2.0 + (locs[i].y - locs[j].y) ** 2.0)
-            if distXY < minDistXY:
-                minDistXY = distXY
-        # save minimum distance
-        minDistXY = min(10e-6, minDistXY) # TODO: 
-        locs[i].minFitDistXY = minDistXY
+def CalcMinimumDistance(locs, maxDistXY = 10e-6):
+    """Saves the XY distance to the nearest other location (at most
+    maxDistXY) to minFitDistXY of every location.
+    
+    """
+    if len(locs) == 0:
+        return locs
+    
+    coords = _GetLocsXY(locs)
+    minDistXY = np.full((len(locs),), maxDistXY)
+    if len(locs) > 1:
+        # Two nearest (including itself), then distance as in pairwise loop
+        _, indices = cKDTree(coords).query(coords, k = 2)
+        nearest = np.where(indices[:, 0] == np.arange(len(locs)), indices[:, 1], indices[:, 0])
+        minDistXY = np.minimum(minDistXY, _PairwiseDistances(coords, coords[nearest]))
+    
+    for loc, dist in zip(locs, minDistXY):
+        loc.minFitDistXY = float(dist)
     
     return locs
 
+def _GetLocsXY(locs):
+    res = np.zeros((len(locs), 2))
+    for i, loc in enumerate(locs):
+        res[i] = loc.x, loc.y
+    return res
+
+def _PairwiseDistances(coordsA, coordsB):
+    return np.sqrt((coordsA[:, 0] - coordsB[:, 0]) ** 2.0 + (coordsA[:, 1] - coordsB[:, 1]) ** 2.0)
+
+def _FindPairsCloserThan(coordsA, coordsB, maxDist):
+    # Pairs (i, j), where coordsA[i] is strictly closer than maxDist to
+    # coordsB[j], the tree search radius is enlarged to include all rounding
+    # differences of the distances
+    if not maxDist > 0.0:
+        return []
+    neighbours = cKDTree(coordsB).query_ball_point(coordsA, maxDist * (1.0 + 1e-9))
+    indicesA = np.repeat(np.arange(len(coordsA)), [len(n) for n in neighbours])
+    indicesB = np.array([j for n in neighbours for j in n], dtype = int)
+    if len(indicesB) == 0:
+        return []
+    dists = _PairwiseDistances(coordsA[indicesA], coordsB[indicesB])
+    closer = dists < maxDist
+    return zip(indicesA[closer], indicesB[closer])
+
+#===============================================================================
+# Tiles
+#===============================================================================
+
+def GetTiles(shape, tileSize, halo):
+    """Splits frame of given shape into tiles of tileSize (cores) extended
+    by halo pixels on every side (cropped by the frame).
+    
+    Returns:
+        list of (roi, core), both in the form ((x0, x1), (y0, y1))
+    
+    """
+    res = []
+    for x0 in range(0, shape[0], tileSize):
+        for y0 in range(0, shape[1], tileSize):
+            core = ((x0, min(x0 + tileSize, shape[0])), (y0, min(y0 + tileSize, shape[1])))
+            roi = ((max(0, x0 - halo), min(shape[0], x0 + tileSize + halo)), \
+                   (max(0, y0 - halo), min(shape[1], y0 + tileSize + halo)))
+            res.append((roi, core))
+    return res
+
+def _CopyForTile(obj):
+    # Shallow copy with own copies of dict, list and set members (statistics,
+    # caches, fit params), so that the tile does not change the original
+    res = copy.copy(obj)
+    for name, value in obj.__dict__.iteritems():
+        if isinstance(value, (dict, list, set)):
+            setattr(res, name, copy.copy(value))
+    return res
+
+def _AddStats(total, stats):
+    # Sums statistics dicts of tiles
+    for k, v in stats.iteritems():
+        total[k] = total.get(k, 0) + v
+
+def _LocalizeTile(localizer, tileFrame, psf, axialCalibrator, fitMode, (roi, core)):
+    # tileFrame contains the roi of the frame
+    tileStartTime = time.time()
+    (x0, _), (y0, _) = roi
+    
+    tileLocalizer, tilePsf = _CopyForTile(localizer), _CopyForTile(psf)
+    if hasattr(tilePsf, "ResetTwoStageStats"):
+        tilePsf.ResetTwoStageStats()
+    tileLocs = tileLocalizer.FindMolecules(tileFrame, tilePsf, axialCalibrator, fitMode = fitMode)
+    res = []
+    for loc in tileLocs:
+        _ShiftLoc(loc, (x0, y0), tileFrame.pixelSize)
+        xI, yI = loc.x / tileFrame.pixelSize, loc.y / tileFrame.pixelSize
+        if core[0][0] <= xI < core[0][1] and core[1][0] <= yI < core[1][1]:
+            res.append(loc)
+    tileStats = {"roi": roi, "core": core, "time": time.time() - tileStartTime, \
+                 "locs": len(tileLocs), "coreLocs": len(res), "pid": os.getpid()}
+    return res, tileStats, getattr(tilePsf, "twoStageStats", None), \
+        getattr(tileLocalizer, "fitCacheStats", None)
+
+_tileWorkerState = {}
+
+def _LocalizeTileWorker((nr, tileData, fitMode, tile)):
+    # Only the tile data is pickled, modules are set by InitTileWorker
+    state = _tileWorkerState
+    tileFrame = Frame(state["fseries"], nr, tileData)
+    return _LocalizeTile(state["localizer"], tileFrame, state["psf"], state["axialCalibrator"], \
+                         fitMode, tile)
+
+def _ShiftLoc(loc, (x0I, y0I), pixelSize):
+    # Tile coordinates to frame coordinates
+    dX, dY = x0I * pixelSize, y0I * pixelSize
+    loc.coord = (loc.coord[0] + dX, loc.coord[1] + dY) + tuple(loc.coord[2:])
+    if loc.coordPixels is not None:
+        loc.coordPixels = (loc.coordPixels[0] + x0I, loc.coordPixels[1] + y0I)
+    if loc.initial is not None and loc.initial[0] is not None:
+        loc.initial = (loc.initial[0] + dX, loc.initial[1] + dY) + tuple(loc.initial[2:])
+    if loc.bestFitParams is not None:
+        params = tuple(loc.bestFitParams)
+        loc.bestFitParams = params[:1] + (params[1] + dX, params[2] + dY) + params[3:]
+
 #===============================================================================
 # LocalizerBase
 #===============================================================================
@@ -107,6 +253,133 @@ class LocalizerBase(ParamsBaseClass):
         """
         raise NotImplementedError()
     
+    def FindMoleculesTiled(self, frame, psf, axialCalibrator, fitMode = "z", tileSize = 512, \
+                           halo = None, pool = None):
+        """Finds molecules in single frame by splitting it into overlapping
+        tiles, which are localized by FindMolecules, sequentially or
+        concurrently in a pool of processes owned by the caller. Every tile
+        keeps only the locations inside its core (tile without halo), the
+        locations closer than duplicateMinDist to a location of other tile
+        are dismissed. Per-tile timings are saved to tileStats.
+        
+        Every tile is localized by its own copies of the localizer and PSF,
+        their statistics (fitCacheStats, twoStageStats) are summed to the
+        original ones. Iteration limits of the localizer apply per tile, i.e.
+        detection passes of Blob/Region/LocalMaxima localizers are repeated in
+        every tile. For localizers limiting the number of locations of a frame
+        (see GetTileLocsBudget) the results differ from the whole frame: every
+        tile spends its own budget and only the best locations (by
+        goodnessValue) of all tiles are returned, up to the budget.
+        
+        Args:
+            frame (Frame): frame to analyze
+            psf (PSF): PSF to use
+            tileSize (int, optional = 512): core size of tiles in pixels
+            halo (int, optional): halo width in pixels, by default the max fit
+                window plus the detection support and border region (see
+                GetTileHalo)
+            pool (multiprocessing.Pool, optional): pool of workers initialized
+                by InitTileWorker with the same modules, the tiles are localized
+                sequentially if not given (or if there is only one tile)
+        
+        Returns:
+            list of MoleculeLoc 
+        
+        """
+        startTime = time.time()
+        halo = self.GetTileHalo(frame.pixelSize) if halo is None else halo
+        tiles = GetTiles(frame.data.shape, tileSize, halo)
+        
+        if pool is not None and len(tiles) > 1:
+            # Only the tile data is sent to workers
+            tasks = []
+            for roi, core in tiles:
+                (x0, x1), (y0, y1) = roi
+                tasks.append((frame.nr, frame.data[x0:x1, y0:y1], fitMode, (roi, core)))
+            tileResults = pool.map(_LocalizeTileWorker, tasks, chunksize = 1)
+        else:
+            pool = None
+            tileResults = [_LocalizeTile(self, frame.CopyFrame(roi), psf, axialCalibrator, fitMode, \
+                                         (roi, core)) for roi, core in tiles]
+        
+        # Merge, locations on core borders may be found by both tiles
+        duplicateMinDist = getattr(self, "_duplicateMinDist", 0.0)
+        grid = GridHash(max(duplicateMinDist, frame.pixelSize))
+        locs, self.tileStats, fitCacheStats = [], [], {}
+        for tileLocs, tileStats, twoStageStats, tileFitCacheStats in tileResults:
+            if twoStageStats is not None:
+                _AddStats(psf.twoStageStats, twoStageStats)
+            if tileFitCacheStats is not None:
+                _AddStats(fitCacheStats, tileFitCacheStats)
+                self.fitCacheStats = fitCacheStats
+            tileStats["duplicates"] = 0
+            for loc in tileLocs:
+                if duplicateMinDist > 0.0 and len(grid.Query(loc.x, loc.y, duplicateMinDist)) > 0:
+                    tileStats["duplicates"] += 1
+                    continue
+                locs.append(loc)
+            for loc in tileLocs:
+                grid.Add(loc.x, loc.y)
+            self.tileStats.append(tileStats)
+        
+        # Budget of locations of the whole frame, not the same locs as whole
+        # frame localization, as every tile spends its own budget
+        locsBudget = self.GetTileLocsBudget()
+        if locsBudget is not None and len(tiles) > 1:
+            logger.info("Tiled results differ from the whole frame: budget of %d locs applies per tile, keeping %d best of %d locs" % \
+                        (locsBudget, min(locsBudget, len(locs)), len(locs)))
+            if len(locs) > locsBudget:
+                locs = sorted(locs, key = lambda loc: -loc.goodnessValue)[:locsBudget]
+            
+        locs = CalcMinimumDistance(locs)
+        tileTimes = [s["time"] for s in self.tileStats]
+        logger.info("FindMoleculesTiled: %d tiles (halo %d px, %s), %d locs, %d duplicates, tile time %.3f s (max %.3f s), total %.3f s" % \
+                    (len(tiles), halo, "sequential" if pool is None else "pool", len(locs), \
+                     sum(s["duplicates"] for s in self.tileStats), sum(tileTimes), max(tileTimes), \
+                     time.time() - startTime))
+        return locs
+    
+    def GetTileHalo(self, pixelSize):
+        """Returns the halo width of tiles (in pixels) for FindMoleculesTiled.
+        Localizers override it with their largest fit window half-width and
+        the support of candidate detection (see _TileHalo).
+        
+        """
+        fitPixels = max(getattr(self, "fitPixels", 0), getattr(self, "_minFitPixels", 0), \
+                        getattr(self, "_maxFitPixels", 0))
+        return self._TileHalo(pixelSize, fitPixels, 1)
+    
+    def GetTileLocsBudget(self):
+        """Returns the max number of locations of a frame, FindMoleculesTiled
+        keeps only the best ones of all tiles, or None if there is no limit of
+        the whole frame.
+        
+        """
+        return None
+    
+    def InitTileWorker(self, psf, axialCalibrator, fseries):
+        """Sets this localizer and the modules used by FindMoleculesTiled in
+        a pool worker process. Called by the initializer of the pool, the
+        modules can't be pickled, they must be built in the worker (e.g. from
+        conf, see CommandLineSMolPhot.LocalizeMolecules).
+        
+        Args:
+            psf (PSF): PSF to use
+            axialCalibrator: axial calibrator to use
+            fseries (FrameSeries): frame series of the localized frames
+        
+        """
+        _tileWorkerState.update({"localizer": self,
+                                 "psf": psf,
+                                 "axialCalibrator": axialCalibrator,
+                                 "fseries": fseries})
+    
+    def _TileHalo(self, pixelSize, fitPixels, detectionPixels):
+        # Fit window, pixels affecting the detection of a candidate, border
+        # region (locs are dismissed near tile edges) and one pixel for rounding
+        borderPixels = int(math.ceil(getattr(self, "_borderRegionWidth", 0.0) / pixelSize))
+        return fitPixels + detectionPixels + borderPixels + 1
+    
     @property
     def name(self):
         raise NotImplementedError()
@@ -1,10 +1,13 @@
+import math
+import time
+import heapq
 import logging
 import numpy as np
 # import cProfile, pstats
 
-from collections import OrderedDict
+from collections import OrderedDict, defaultdict
 from SMolPhot.Components.BaseClasses import Param
-from _Common import LocalizerBase, CalcMinimumDistance, SimpleRegion
+from _Common import LocalizerBase, CalcMinimumDistance, SimpleRegion, GridHash
 
 __all__ = ["IterativeLocalizer"]
 
@@ -187,8 +190,23 @@ class IterativeLocalizer(LocalizerBase):
         # Calculate minFitDistXY for every loc
         locs = CalcMinimumDistance(potentialLocs.resultLocs)
         
+        # Fit cache statistics of the frame
+        self.fitCacheStats = potentialLocs.fitCacheStats
+        self.logger.info("Fit cache: %d hits of %d lookups (%.1f %%), saved %.1f ms of fitting, %d warm starts" % \
+                         (self.fitCacheStats["hits"], self.fitCacheStats["lookups"], \
+                          100.0 * self.fitCacheStats["hits"] / max(1, self.fitCacheStats["lookups"]), \
+                          1e3 * self.fitCacheStats["savedTime"], self.fitCacheStats["warmStarts"]))
+        
         self.logger.info("FindMolecules done.")
         return locs
+    
+    def GetTileHalo(self, pixelSize):
+        # Largest fit window, potential locs from 3x3 neighbourhood
+        return self._TileHalo(pixelSize, self._maxFitPixels, 1)
+    
+    def GetTileLocsBudget(self):
+        # One location per iteration in the whole frame
+        return self._maxIterations
         
     @property
     def name(self):
@@ -203,6 +221,23 @@ class PotentialLocCollection(object):
     """This class holds all potential fitting locations (insede class PotentalLoc)
     and mainly provides GetBestFitLoc() and AddLocationAndUpdate() functionality.
     
+    Fits are cached by candidate pixel and fitPixels for the whole frame, so
+    potential locs rebuilt by AddLocationAndUpdate reuse the fits of the same
+    pixel. Cached fits are invalidated only if the subtracted PSF overlaps the
+    fit window, the invalidated fits are used as initial guesses (warm start)
+    for refitting the same window. Cache keys are bucketed by pixel blocks,
+    so only the fits of blocks near the subtracted PSF are checked. If the
+    PSF shifts the fit window towards the fitted maximum, the window may be
+    anywhere within initialMaxDist per shift iteration, the cached fits are
+    invalidated by this enlarged window (and not cached at all for unlimited
+    initialMaxDist).
+    
+    The best potential loc is found from a max-heap on goodness. The goodness
+    of a potential loc can only decrease as result locs are added (duplicates
+    are dismissed), therefore outdated heap entries are re-evaluated lazily
+    when they reach the top. Result locs are kept in a spatial hash for the
+    duplicate check.
+    
     """
     def __init__(self, localizer, frame, psf, axialCalibrator, fitMode, saveIterationInfo = False):
         self.logger = localizer.logger
@@ -217,29 +252,54 @@ class PotentialLocCollection(object):
         
         # Init
         self._potentialLocs = []
+        self._heap = None
+        self._heapCounter = 0
         self.resultLocs = []
+        self._resultLocsGrid = GridHash(max(localizer._duplicateMinDist, frame.pixelSize))
+        self._fitCache = {}
+        self._fitCacheBlocks = defaultdict(set)
+        self._fitCacheBlockSize = 2 * localizer._maxFitPixels + 3
+        self._fitCacheMaxFitPixels = 0
+        self._fitCacheShiftPixels = 0
+        self._fitCacheEnabled = True
+        self._warmStarts = {}
+        
+        # Every shift moves the window center by at most initialMaxDist (+1
+        # pixel for rounding) from the initial coord
+        shiftIterations = getattr(psf, "_fitAreaShiftMaxIterations", 0)
+        if shiftIterations > 0:
+            if np.isfinite(localizer._initialMaxDist):
+                self._fitCacheShiftPixels = shiftIterations * \
+                    (int(math.ceil(localizer._initialMaxDist / frame.pixelSize)) + 1)
+            else:
+                self._fitCacheEnabled = False
+        self.fitCacheStats = {"lookups": 0, "hits": 0, "warmStarts": 0, "savedTime": 0.0}
         self.AddPotentialLocs()
         
     def AddPotentialLocs(self, bbox = None):
         self.logger.info("AddPotentialLocs: %s" % (str(bbox)))
         
         if self._localizer._potentialLocMode == "localMaxima":
-            initialCoords = self._frame.FindMaximas(self._localizer._detThreshold, \
-                                                    bbox = bbox, localMaxima = True)
+            localMaxima = True
         elif self._localizer._potentialLocMode == "aboveTreshold":
-            initialCoords = self._frame.FindMaximas(self._localizer._detThreshold, \
-                                                    bbox = bbox, localMaxima = False)
+            localMaxima = False
         else: 
             raise NotImplementedError()
         
+        initialCoords, areas, weightedCentroids = \
+            self._frame.FindMaximas(self._localizer._detThreshold, bbox = bbox, \
+                                    localMaxima = localMaxima, \
+                                    areaThreshold = self._localizer._noiselevel)
+        
         # Add new points that match conditions
         toAdd = []
-        for coord in initialCoords:
-            potentialLoc = PotentialLoc(self, coord)
-            if potentialLoc.area < self._localizer._minArea:
+        for coord, area, weightedCentroid in zip(initialCoords, areas, weightedCentroids):
+            if area < self._localizer._minArea:
                 continue
-            toAdd.append(potentialLoc)
+            toAdd.append(PotentialLoc(self, coord, area, weightedCentroid))
         self._potentialLocs += toAdd
+        for potentialLoc in toAdd:
+            self._PushToHeap(potentialLoc)
         
         # Add iteration info
         if self.saveIterationInfo:
@@ -251,25 +311,63 @@ class PotentialLocCollection(object):
         self.logger.info("SetFitPixelsRange: %d %d" % (minFitPixels, maxFitPixels))
         self._minFitPixels = minFitPixels
         self._maxFitPixels = maxFitPixels
+        self._heap = None
         
     def GetBestLocFit(self):
         self.logger.info("GetBestLocFit")
-        res = None
-        for potentialLoc in self._potentialLocs:
-            locFitTmp = potentialLoc.GetBestLocFit()
-            if locFitTmp is None:
+        if self._heap is None:
+            # Fit pixels range changed, all goodness values must be recalculated
+            self._heap = []
+            for potentialLoc in self._potentialLocs:
+                self._PushToHeap(potentialLoc)
+        
+        # Ties are resolved by the order of adding (as in linear search)
+        while len(self._heap) > 0:
+            negGoodness, order, potentialLoc = self._heap[0]
+            if not potentialLoc.alive:
+                heapq.heappop(self._heap)
                 continue
             
-            if res is None or locFitTmp.goodnessValue > res.goodnessValue:
-                res = locFitTmp
-        return res
+            locFit = potentialLoc.GetBestLocFit()
+            if locFit is not None and locFit.goodnessValue == -negGoodness:
+                return locFit
+            
+            # Goodness decreased (duplicates dismissed), update the entry
+            if locFit is None:
+                heapq.heappop(self._heap)
+            else:
+                heapq.heapreplace(self._heap, (-locFit.goodnessValue, order, potentialLoc))
+        return None
+    
+    def FindDuplicate(self, locFit):
+        """Returns the distance to result loc closer than duplicateMinDist,
+        None if locFit is not a duplicate.
+        
+        """
+        duplicates = self._resultLocsGrid.Query(locFit.x, locFit.y, self._localizer._duplicateMinDist)
+        if len(duplicates) == 0:
+            return None
+        return min(duplicates)[0]
+    
+    def _PushToHeap(self, potentialLoc):
+        if potentialLoc.order is None:
+            potentialLoc.order = self._heapCounter
+            self._heapCounter += 1
+        if self._heap is None:
+            return
+        
+        locFit = potentialLoc.GetBestLocFit()
+        if locFit is not None:
+            heapq.heappush(self._heap, (-locFit.goodnessValue, potentialLoc.order, potentialLoc))
     
     def AddLocationAndUpdate(self, locFit):
         self.logger.info("AddLocationAndUpdate")
         
         # Add to results and remove from image
         self.resultLocs.append(locFit)
+        self._resultLocsGrid.Add(locFit.x, locFit.y, locFit)
         self._frame.SubtractLocs(self._psf, [locFit])
+        self._InvalidateFitCache(locFit)
         
         # Save iteration info
         if self.saveIterationInfo:
@@ -282,11 +380,80 @@ class PotentialLocCollection(object):
         # Discard all potential locs that may be affected
         affectedBox = self._frame.GetBoxAround(locFit.coordPixels, \
             (locFit.bboxHWx + self._maxFitPixels, locFit.bboxHWy + self._maxFitPixels))
-        self._potentialLocs = [potentialLoc for potentialLoc in self._potentialLocs if not potentialLoc.IsAffected(affectedBox)]
+        potentialLocsLeft = []
+        for potentialLoc in self._potentialLocs:
+            if potentialLoc.IsAffected(affectedBox):
+                potentialLoc.alive = False
+            else:
+                potentialLocsLeft.append(potentialLoc)
+        self._potentialLocs = potentialLocsLeft
         
         # Analyze and add points from affected region
         self.AddPotentialLocs(bbox = affectedBox)
         
+    def GetCachedFit(self, coordPixels, fitPixels):
+        self.fitCacheStats["lookups"] += 1
+        key = (coordPixels, fitPixels)
+        if not self._fitCacheEnabled or key not in self._fitCache:
+            return False, None
+        locFit, _, fitTime = self._fitCache[key]
+        self.fitCacheStats["hits"] += 1
+        self.fitCacheStats["savedTime"] += fitTime
+        return True, locFit
+    
+    def SetCachedFit(self, coordPixels, fitPixels, locFit, rawLocFit, fitTime):
+        # rawLocFit - fit before localizer checks, used for warm start
+        if not self._fitCacheEnabled:
+            return
+        key = (coordPixels, fitPixels)
+        self._fitCache[key] = (locFit, rawLocFit, fitTime)
+        self._fitCacheBlocks[self._FitCacheBlock(*coordPixels)].add(key)
+        self._fitCacheMaxFitPixels = max(self._fitCacheMaxFitPixels, fitPixels)
+    
+    def GetWarmStart(self, coordPixels, fitPixels):
+        rawLocFit = self._warmStarts.pop((coordPixels, fitPixels), None)
+        if rawLocFit is None:
+            return None
+        initialGuess = self._psf.GetInitialGuess(rawLocFit, self._fitMode)
+        if initialGuess is not None:
+            self.fitCacheStats["warmStarts"] += 1
+        return initialGuess
+    
+    def _InvalidateFitCache(self, locFit):
+        # Same window as used in Frame.SubtractLocs, None - whole frame
+        halfWidth = self._psf.GetSupportHalfWidth(*locFit.bestFitParams)
+        if halfWidth is None:
+            for key in self._fitCache.keys():
+                self._MoveToWarmStarts(key)
+            return
+        hw = int(math.ceil(halfWidth / self._frame.pixelSize))
+        centerPixels = self._frame.GetCoordsPixels(locFit.bestFitParams[1:3])
+        sx0, sy0, sx1, sy1 = self._frame.GetBoxAround(centerPixels, (hw, hw))
+        
+        # Fit windows (+1 pixel, as fit may be centered to weighted centroid,
+        # and the max shift of the window), only blocks of candidates within
+        # the largest fit window are checked
+        shift = self._fitCacheShiftPixels + 1
+        margin = self._fitCacheMaxFitPixels + shift
+        bx0, by0 = self._FitCacheBlock(sx0 - margin, sy0 - margin)
+        bx1, by1 = self._FitCacheBlock(sx1 + margin, sy1 + margin)
+        for bx in range(bx0, bx1 + 1):
+            for by in range(by0, by1 + 1):
+                for key in list(self._fitCacheBlocks.get((bx, by), ())):
+                    (xI, yI), fitPixels = key
+                    if xI - fitPixels - shift < sx1 and sx0 <= xI + fitPixels + shift and \
+                        yI - fitPixels - shift < sy1 and sy0 <= yI + fitPixels + shift:
+                        self._MoveToWarmStarts(key)
+    
+    def _MoveToWarmStarts(self, key):
+        _, rawLocFit, _ = self._fitCache.pop(key)
+        self._fitCacheBlocks[self._FitCacheBlock(*key[0])].discard(key)
+        if rawLocFit is not None:
+            self._warmStarts[key] = rawLocFit
+    
+    def _FitCacheBlock(self, xI, yI):
+        return xI // self._fitCacheBlockSize, yI // self._fitCacheBlockSize
+    
     @property
     def minFitPixels(self):
         return self._minFitPixels
@@ -301,28 +468,36 @@ class PotentialLocCollection(object):
 
 class PotentialLoc(object):
     
-    def __init__(self, collection, coord):
+    def __init__(self, collection, coord, area = None, weightedCentroid = None):
+        # area and weightedCentroid are usually already calculated by Frame.FindMaximas
         self.logger = collection._localizer.logger
         self._collection = collection
         self.coord = coord
         self.coordPixels = collection._frame.GetCoordsPixels(self.coord)
         
         # Calc
-        xI, yI = self.coordPixels
-        directlyAroundData = collection._frame.data[(xI - 1):(xI + 2), (yI - 1):(yI + 2)]
+        if area is None or weightedCentroid is None:
+            xI, yI = self.coordPixels
+            directlyAroundData = collection._frame.data[(xI - 1):(xI + 2), (yI - 1):(yI + 2)]
         
         # Area
-        self.area = (directlyAroundData > self._collection._localizer._noiselevel).sum()
+        if area is None:
+            area = (directlyAroundData > self._collection._localizer._noiselevel).sum()
+        self.area = area
         
         # Centroid
-        tmpX, tmpY = np.meshgrid(np.arange(directlyAroundData.shape[0]), \
-                         np.arange(directlyAroundData.shape[1]), \
-                         indexing = "ij")
-        centroidXI = np.average(tmpX, weights = directlyAroundData) - 1.0 + xI
-        centroidYI = np.average(tmpY, weights = directlyAroundData) - 1.0 + yI
-        self.weightedCentroid = collection._frame.GetPixelCoords((centroidXI, centroidYI))
+        if weightedCentroid is None:
+            tmpX, tmpY = np.meshgrid(np.arange(directlyAroundData.shape[0]), \
+                             np.arange(directlyAroundData.shape[1]), \
+                             indexing = "ij")
+            centroidXI = np.average(tmpX, weights = directlyAroundData) - 1.0 + xI
+            centroidYI = np.average(tmpY, weights = directlyAroundData) - 1.0 + yI
+            weightedCentroid = collection._frame.GetPixelCoords((centroidXI, centroidYI))
+        self.weightedCentroid = weightedCentroid
             
         self._fitCache = {}
+        self.order = None
+        self.alive = True
         
     def GetBestLocFit(self):
         res = None
@@ -348,18 +523,16 @@ class PotentialLoc(object):
             if locFit is None:
                 return None
             
-            for loc in self._collection.resultLocs:
-                distXY = np.sqrt((loc.x - locFit.x) ** 2.0 + (loc.y - locFit.y) ** 2.0)
-                if distXY <= localizer._duplicateMinDist:
-                    self.logger.debug("Dismissed, duplicate dist %.2f nm" % (1e9 * distXY))
-                    return None
+            distXY = self._collection.FindDuplicate(locFit)
+            if distXY is not None:
+                self.logger.debug("Dismissed, duplicate dist %.2f nm" % (1e9 * distXY))
+                return None
             return locFit
         
         # Init
         localizer = self._collection._localizer
         frame = self._collection._frame
         psf = self._collection._psf
-        axialCalibrator = self._collection._axialCalibrator
         fitMode = self._collection._fitMode
         
         # Check cache
@@ -368,6 +541,13 @@ class PotentialLoc(object):
             self._fitCache[fitPixels] = locFit
             return locFit        
         self._fitCache[fitPixels] = None
+        
+        # Check frame-level cache (fit window not changed since fitting)
+        found, locFit = self._collection.GetCachedFit(self.coordPixels, fitPixels)
+        if found:
+            locFit = CheckForDuplicates(locFit)
+            self._fitCache[fitPixels] = locFit
+            return locFit
 
         # Pick initial fit coord
         initialCoord = None
@@ -378,11 +558,27 @@ class PotentialLoc(object):
         else:
             raise NotImplementedError()
              
-        # Do fitting
-        locFit = psf.Fit(frame, initialCoord, fitPixels, \
-                         fitMode = fitMode, \
-                         initialMaxDist = localizer._initialMaxDist)
+        # Do fitting (warm start from invalidated fit of the same window)
+        initialGuess = self._collection.GetWarmStart(self.coordPixels, fitPixels)
+        t0 = time.time()
+        rawLocFit = psf.Fit(frame, initialCoord, fitPixels, \
+                            fitMode = fitMode, \
+                            initialMaxDist = localizer._initialMaxDist, \
+                            initialGuess = initialGuess)
+        locFit = self._CheckFit(rawLocFit)
+        self._collection.SetCachedFit(self.coordPixels, fitPixels, locFit, rawLocFit, time.time() - t0)
         
+        locFit = CheckForDuplicates(locFit)
+        
+        # Cache
+        self._fitCache[fitPixels] = locFit
+        return locFit
+    
+    def _CheckFit(self, locFit):
+        # Checks independent of other locations
+        localizer = self._collection._localizer
+        frame = self._collection._frame
+        axialCalibrator = self._collection._axialCalibrator
         if locFit is None:
             return None
                 
@@ -398,25 +594,20 @@ class PotentialLoc(object):
                                   (1e9 * locFit.z))
                 return None
 
-        if locFit.goodnessValue < localizer._minGoodness:
+        if not locFit.goodnessValue >= localizer._minGoodness:
+            # Also NaN, not comparable in the heap of PotentialLocCollection
             self.logger.debug("Dismissed, to bad goodness %.2f" % (locFit.goodnessValue))
             return None
         
         if locFit.offset < localizer._minOffset:
             self.logger.debug("Dismissed, to bad offset %.2f" % (locFit.offset))
             return None
-               
-        locFit = CheckForDuplicates(locFit)
         
         # Save additional info
-        if locFit is not None:
-            locFit.area = self.area
-            # TODO:
-            locFit.distFitWeightedCentroid = np.sqrt((self.weightedCentroid[0] - locFit.bestFitParams[1]) ** 2.0 + \
-                                                     (self.weightedCentroid[1] - locFit.bestFitParams[2]) ** 2.0 )
-        
-        # Cache
-        self._fitCache[fitPixels] = locFit
+        locFit.area = self.area
+        # TODO:
+        locFit.distFitWeightedCentroid = np.sqrt((self.weightedCentroid[0] - locFit.bestFitParams[1]) ** 2.0 + \
+                                                 (self.weightedCentroid[1] - locFit.bestFitParams[2]) ** 2.0 )
         return locFit
         
 
@@ -3,12 +3,17 @@
 """
 import logging
 import numpy as np
+from scipy.ndimage import filters
 from collections import OrderedDict
 from SMolPhot.Components.BaseClasses import Param
 from _Common import LocalizerBase, AddLocsWoDuplicates, CalcMinimumDistance
 
 __all__ = ["LocalMaximaLocalizer"]
 
+# 3x3 kernels for neighbourhood sums and weighted centroids
+_KERNEL_SUM = np.ones((3, 3), dtype = np.int32)
+_KERNEL_MOMENT_X, _KERNEL_MOMENT_Y = np.mgrid[0:3, 0:3].astype(float)
+
 class LocalMaximaLocalizer(LocalizerBase):
     """Simple local maxima localizer.
     
@@ -120,12 +125,15 @@ class LocalMaximaLocalizer(LocalizerBase):
     
     def FindMolecules(self, inputFrame, psf, axialCalibrator, fitMode = "z"):
         
-        def _FitMolecule(frame, (x, y), fitPixels):
-            # Fit            
-            locFit = psf.Fit(frame, (x, y), fitPixels, \
-                             fitMode = fitMode, \
-                             initialMaxDist = self._initialMaxDist)
-            
+        def _FitMolecules(frame, coords, fitPixels):
+            # Fit all candidates of the detection pass at once
+            locFits = psf.FitBatch(frame, coords, fitPixels, \
+                                   fitMode = fitMode, \
+                                   initialMaxDist = self._initialMaxDist, \
+                                   acceptFunc = lambda locFit: _CheckMolecule(locFit) is not None)
+            return [_CheckMolecule(locFit) for locFit in locFits]
+        
+        def _CheckMolecule(locFit):
             if locFit is None:
                 return None
                         
@@ -151,50 +159,32 @@ class LocalMaximaLocalizer(LocalizerBase):
             return locFit
         
         def FindLocalMaximas(frame, threshold, mode, noiseLevel = -np.inf, minArea = 1):
-            maxIndicesInitial = np.where(frame.data > threshold)
-            pixelsX, pixelsY = frame.pixelsX, frame.pixelsY
+            # All pixels at once by image filters, pixels on edge are dismissed
+            data = frame.data
+            candidates = data > threshold
+            candidates[[0, -1], :] = False
+            candidates[:, [0, -1]] = False
             
-            maxIndicesX, maxIndicesY = [], []
-            for xI, yI in zip(maxIndicesInitial[0], maxIndicesInitial[1]):
-                #frame.logger.debug("Potential local maxuma at pixel (%d, %d)" % (xI, yI))
-                if min(xI, yI) < 1 or \
-                    xI + 1 >= pixelsX or \
-                    yI + 1 >= pixelsY:
-                    #frame.logger.debug("Dismissed, pixel on edge")
-                    continue
-                
-                pixelValue = frame.data[xI, yI]
-                directlyAroundData = frame.data[(xI - 1):(xI + 2), (yI - 1):(yI + 2)]
-                maxAround = np.max(directlyAroundData)
-                #minAround = np.min(directlyAroundData)
-                area = (directlyAroundData > noiseLevel).sum()
-                
-                if maxAround > pixelValue:
-                    # Not local maxima
-                    #frame.logger.debug("Dismissed, not local maxima")
-                    continue
-                
-                if area < minArea:
-                    # area to small
-                    continue
-                
-                if mode == "localMaxima":
-                    maxIndicesX.append(xI)
-                    maxIndicesY.append(yI)
-                elif mode == "weightedCentroid":
-                    tmpX, tmpY = np.meshgrid(np.arange(directlyAroundData.shape[0]), \
-                                             np.arange(directlyAroundData.shape[1]), \
-                                             indexing = "ij")
-                    centroidXI = np.average(tmpX, weights = directlyAroundData) - 1.0 + xI
-                    centroidYI = np.average(tmpY, weights = directlyAroundData) - 1.0 + yI
-                    maxIndicesX.append(centroidXI)
-                    maxIndicesY.append(centroidYI)
-                    #print "centroid vs local maximum", (xI, yI), (centroidXI, centroidYI)
-                else:
-                    raise NotImplementedError()
-                    
+            # Local maxima of 3x3 neighbourhood
+            candidates &= data >= filters.maximum_filter(data, size = 3, mode = "nearest")
+            
+            # Area above noise level in 3x3 neighbourhood
+            area = filters.correlate((data > noiseLevel).astype(np.int32), _KERNEL_SUM)
+            candidates &= area >= minArea
+            
+            maxIndicesX, maxIndicesY = np.nonzero(candidates)
+            if mode == "localMaxima":
+                maxIndices = (maxIndicesX, maxIndicesY)
+            elif mode == "weightedCentroid":
+                # First moments of 3x3 neighbourhood
+                weightsSum = filters.correlate(data, _KERNEL_SUM, output = np.float64)[candidates]
+                momentX = filters.correlate(data, _KERNEL_MOMENT_X, output = np.float64)[candidates]
+                momentY = filters.correlate(data, _KERNEL_MOMENT_Y, output = np.float64)[candidates]
+                maxIndices = (momentX / weightsSum - 1.0 + maxIndicesX, \
+                              momentY / weightsSum - 1.0 + maxIndicesY)
+            else:
+                raise NotImplementedError()
                     
-            maxIndices = (np.array(maxIndicesX), np.array(maxIndicesY))
             maxCoords = frame.GetPixelCoords(maxIndices)
             return maxIndices, maxCoords
         
@@ -221,14 +211,13 @@ class LocalMaximaLocalizer(LocalizerBase):
             
             regions = []
             locsThis = []
-            for x, y, xI, yI in zip(maxCoords[0], maxCoords[1], maxIndices[0], maxIndices[1]):                
+            locFits = _FitMolecules(frame, zip(maxCoords[0], maxCoords[1]), fitPixels)
+            for xI, yI, locFit in zip(maxIndices[0], maxIndices[1], locFits):                
                 fakeRegion = FakeRegion()
                 fakeRegion.bbox = (-1, -1, 2, 2)
                 fakeRegion.offset = np.array([int(round(xI)), int(round(yI))])
                 regions.append(fakeRegion)
                 
-                locFit = _FitMolecule(frame, (x, y), fitPixels)
-                
                 if locFit is None:
                     continue                    
                 
@@ -265,6 +254,10 @@ class LocalMaximaLocalizer(LocalizerBase):
         locs = RecursiveSearch(0, inputFrame, self.fitPixels)
         locs = CalcMinimumDistance(locs)
         return locs
+    
+    def GetTileHalo(self, pixelSize):
+        # Search starts from fitPixels, local maxima of 3x3 neighbourhood
+        return self._TileHalo(pixelSize, max(self.fitPixels, self._minFitPixels), 1)
         
     @property
     def name(self):
@@ -3,51 +3,114 @@
 """
 import logging
 import numpy as np
+from scipy import ndimage
 from SMolPhot.Components.BaseClasses import Param
-from _Common import LocalizerBase, CalcMinimumDistance, AddLocsWoDuplicates
-from skimage.measure import label, regionprops
+from _Common import LocalizerBase, CalcMinimumDistance, AddLocsWoDuplicates, SimpleRegion
 
 from collections import OrderedDict
 
 __all__ = ["RegionDetectionLocalizer"]
 
-
-def divideRegion(region, maxArea):
-    if region.area <= maxArea:
-        offset = np.array([0, 0])  # coordinate offset in pixels
-        return [region], [offset]
-    else:
-        threshold = region.mean_intensity + 0.01 * (region.max_intensity - region.mean_intensity)
-        mask = region.intensity_image > threshold
-        labelImage = label(mask)
-        subregions = regionprops(labelImage, intensity_image = region.intensity_image)
-        regionList = []
-        offsetList = []
-        for subregion in subregions:
-            newSubregions, newOffsets = divideRegion(subregion, maxArea)
-            for newOffset in newOffsets:
-                newOffset += np.array(region.bbox[:2])
-            regionList += newSubregions
-            offsetList += newOffsets
-        return regionList, offsetList
-
-
-def findHighestSubregion(region, maxArea):
-    if region.area <= maxArea:
-        offset = np.array([0, 0])  # coordinate offset in pixels
-        return region, offset
-    else:
-        threshold = (region.max_intensity + region.mean_intensity) / 2.0
-        mask = region.intensity_image > threshold
-        labelImage = label(mask)
-        subregions = regionprops(labelImage, intensity_image = region.intensity_image)
-        maxI = region.min_intensity
-        for subregion in subregions:
-            if subregion.max_intensity > maxI:
-                maxI = subregion.max_intensity
-                highestSubregion = subregion
-        newRegion, offset = findHighestSubregion(highestSubregion, maxArea)
-        return newRegion, offset + np.array(region.bbox[:2])
+# 8-connectivity, same as skimage.measure.label default in 2D
+_STRUCTURE = np.ones((3, 3), dtype = bool)
+
+#===============================================================================
+# LabeledRegions
+#===============================================================================
+
+class LabeledRegions(object):
+    """Labels 8-connected regions of mask and calculates their area, maximum
+    and mean intensity and weighted centroid (in pixels) with vectorized label
+    statistics. Region i has label i + 1. If parentLabels is given, parent[i]
+    is the index of the parent region of region i.
+    
+    """
+    
+    def __init__(self, data, mask, parentLabels = None):
+        self.labels, self.count = ndimage.label(mask, structure = _STRUCTURE)
+        
+        # Statistics only from labeled pixels
+        rows, cols = np.nonzero(mask)
+        labels, weights = self.labels[rows, cols] - 1, data[rows, cols].astype(float)
+        total = np.bincount(labels, weights, self.count)
+        self.area = np.bincount(labels, minlength = self.count)
+        self.meanIntensity = total / self.area
+        self.weightedCentroid = np.array([np.bincount(labels, rows * weights, self.count), \
+                                          np.bincount(labels, cols * weights, self.count)]).T / \
+                                          total[:, np.newaxis]
+        
+        # Maximum of every label from pixels sorted by label
+        self.maxIntensity = np.zeros((self.count,))
+        if self.count > 0:
+            order = np.argsort(labels, kind = "mergesort")
+            starts = np.concatenate(([0], np.cumsum(self.area)[:-1]))
+            self.maxIntensity = np.maximum.reduceat(weights[order], starts)
+        
+        self.parent = None
+        if parentLabels is not None:
+            self.parent = parentLabels[rows, cols][np.unique(labels, return_index = True)[1]] - 1
+        self._slices = None
+            
+    def GetRegion(self, i):
+        """Returns SimpleRegion with bbox (minRow, minCol, maxRow, maxCol) of
+        region i.
+        
+        """
+        if self._slices is None:
+            self._slices = ndimage.find_objects(self.labels)
+        sliceRow, sliceCol = self._slices[i]
+        return SimpleRegion(np.array([0, 0]), (sliceRow.start, sliceCol.start, sliceRow.stop, sliceCol.stop))
+
+def SplitRegions(data, regions, indices, maxArea, multipeak):
+    """Splits regions larger than maxArea by thresholding them again (all
+    regions of one level in a single labeling pass) until all subregions are
+    small enough. In multipeak mode all subregions are kept (threshold slightly
+    above mean intensity), otherwise only the subregion with the highest
+    maximum (threshold halfway between mean and maximum). Returns list of
+    (LabeledRegions, index) leaves for every region in indices.
+    
+    """
+    levels, children = [regions], {}
+    toSplit = [i for i in indices if regions.area[i] > maxArea]
+    while len(toSplit) > 0:
+        cur, level = levels[-1], len(levels) - 1
+        meanI, maxI = cur.meanIntensity[toSplit], cur.maxIntensity[toSplit]
+        thresholds = np.empty(cur.count + 1)
+        thresholds.fill(np.inf)
+        if multipeak:
+            thresholds[np.array(toSplit) + 1] = meanI + 0.01 * (maxI - meanI)
+        else:
+            thresholds[np.array(toSplit) + 1] = (maxI + meanI) / 2.0
+        mask = data > thresholds[cur.labels]
+        sub = LabeledRegions(data, mask, parentLabels = cur.labels)
+        levels.append(sub)
+        
+        subregionsOf = {}
+        for j, p in enumerate(sub.parent):
+            subregionsOf.setdefault(p, []).append(j)
+        
+        toSplitNext = []
+        for p in toSplit:
+            subregions = subregionsOf.get(p, [])
+            if not multipeak and len(subregions) > 0:
+                subregions = [subregions[np.argmax(sub.maxIntensity[subregions])]]
+            children[(level, p)] = subregions
+            toSplitNext += [j for j in subregions if sub.area[j] > maxArea]
+        toSplit = toSplitNext
+    
+    def Leaves(level, i):
+        if levels[level].area[i] <= maxArea:
+            return [(levels[level], i)]
+        res = []
+        for j in children.get((level, i), []):
+            res += Leaves(level + 1, j)
+        return res
+    
+    return [Leaves(0, i) for i in indices]
+
+#===============================================================================
+# RegionDetectionLocalizer
+#===============================================================================
 
 class RegionDetectionLocalizer(LocalizerBase):
 
@@ -140,12 +203,15 @@ class RegionDetectionLocalizer(LocalizerBase):
 
     def FindMolecules(self, inputFrame, psf, axialCalibrator, fitMode = "z"):
        
-        def _FitMolecule(frame, (x, y), fitPixels):
-            # Fit            
-            locFit = psf.Fit(frame, (x, y), fitPixels, \
-                             fitMode = fitMode, \
-                             initialMaxDist = self._initialMaxDist)
-            
+        def _FitMolecules(frame, coords, fitPixels):
+            # Fit all candidates of the detection pass at once
+            locFits = psf.FitBatch(frame, coords, fitPixels, \
+                                   fitMode = fitMode, \
+                                   initialMaxDist = self._initialMaxDist, \
+                                   acceptFunc = lambda locFit: _CheckMolecule(locFit) is not None)
+            return [_CheckMolecule(locFit) for locFit in locFits]
+        
+        def _CheckMolecule(locFit):
             if locFit is None:
                 return None
                         
@@ -167,62 +233,24 @@ class RegionDetectionLocalizer(LocalizerBase):
             return locFit
         
         def FindPotentialLocations(frame):
-            mask = frame.data > self.maskThreshold
-            labelImg = label(mask)
-            regions = regionprops(labelImg, intensity_image = frame.data)
-            internalRegions = []
-
-
-            maxIndices = []
-            if self._mode == "Single peak":
-                for region in regions:
-                    offset = np.array([0, 0])
-                    region.offset = offset
-                    
-                    if region.area < self.minArea:
-                        self.logger.debug("Region dismissed, small area (%d)" % (region.area))
-                        continue
-                    
-                    if region.max_intensity < self.detThreshold:
-                        self.logger.debug("Region dismissed, low maximum intensity (%f)" % (region.max_intensity))
-                        continue
-                
-                    if region.area > self.maxArea:
-                        region, offset = findHighestSubregion(region, self.maxArea)
-                
-                    maxIndices.append(np.array(region.weighted_centroid) + offset)
-                    region.offset = offset
-                    internalRegions.append(region)
-                    # print "area", region.area, "convex area", region.convex_area, "orientation", region.orientation, "eccentricity", region.eccentricity, "indices", np.array(region.weighted_centroid) - offset
-
-            elif self._mode == "Multipeak":
-                for region in regions:
-                    offset = np.array([0, 0])
-                    region.offset = offset
-                    
-                    if region.area < self.minArea:
-                        self.logger.debug("Region dismissed, small area (%d)" % (region.area))
-                        continue
-                    
-                    if region.max_intensity < self.detThreshold:
-                        self.logger.debug("Region dismissed, low maximum intensity (%f)" % (region.max_intensity))
-                        continue
-      
-                    newRegions, newOffsets = None, None
-                    if region.area > self.maxArea:
-                        newRegions, newOffsets = divideRegion(region, self.maxArea)
-                        for nr, no in zip(newRegions, newOffsets):
-                            nr.offset = no
-                            internalRegions.append(nr)
-                    else:
-                        newRegions, newOffsets = [region], [offset]
-                        maxIndices.append(np.array(region.weighted_centroid) + offset)
-                       
-                    for newRegion, newOffset in zip(newRegions, newOffsets):
-                        maxIndices.append(np.array(newRegion.weighted_centroid) + newOffset)
-                       
-            else:
+            if self._mode not in self._modeComboValues:
                 raise NotImplementedError()
+            multipeak = self._mode == "Multipeak"
+            
+            regions = LabeledRegions(frame.data, frame.data > self.maskThreshold)
+            small = regions.area < self.minArea
+            low = (regions.maxIntensity < self.detThreshold) & ~small
+            self.logger.debug("Regions dismissed, small area: %d, low maximum intensity: %d" % \
+                              (small.sum(), low.sum()))
+            selected = np.nonzero(~(small | low))[0]
+
+            maxIndices, internalRegions = [], []
+            for i, leaves in zip(selected, SplitRegions(frame.data, regions, selected, \
+                                                        self.maxArea, multipeak)):
+                for leafRegions, j in leaves:
+                    maxIndices.append(leafRegions.weightedCentroid[j])
+                    if not multipeak or regions.area[i] > self.maxArea:
+                        internalRegions.append(leafRegions.GetRegion(j))
             
             if len(maxIndices) == 0:
                 maxIndices = np.zeros((0,)), np.zeros((0, ))
@@ -231,7 +259,8 @@ class RegionDetectionLocalizer(LocalizerBase):
                 
             maxCoords = frame.GetPixelCoords(maxIndices)
             
-            return maxIndices, maxCoords, [r for r in regions if r.area > self.minArea], internalRegions
+            return maxIndices, maxCoords, [regions.GetRegion(i) for i in \
+                np.nonzero(regions.area > self.minArea)[0]], internalRegions
 
         def RecursiveSearch(iteration, frame, fitPixels, locsAlreadyFound = []):
             if fitPixels < self._minFitPixels:
@@ -248,9 +277,7 @@ class RegionDetectionLocalizer(LocalizerBase):
             iterationInfo["internalRegions"] = internalRegions
             
             locsThis = []
-            for x, y in zip(maxCoords[0], maxCoords[1]):                
-                locFit = _FitMolecule(frame, (x, y), fitPixels)
-                
+            for locFit in _FitMolecules(frame, zip(maxCoords[0], maxCoords[1]), fitPixels):                
                 if locFit is None:
                     continue
                 
@@ -286,6 +313,11 @@ class RegionDetectionLocalizer(LocalizerBase):
         locs = CalcMinimumDistance(locs)
         return locs
 
+    def GetTileHalo(self, pixelSize):
+        # Search starts from fitPixels, the centroid of a region of maxArea
+        # pixels depends on pixels up to maxArea pixels away
+        return self._TileHalo(pixelSize, max(self.fitPixels, self._minFitPixels), int(self.maxArea))
+
     @property
     def name(self):
         return "Region Detection Localizer"
@@ -1,4 +1,6 @@
 import copy
+import math
+import logging
 import numpy as np
 
 from collections import defaultdict
@@ -7,6 +9,8 @@ from SMolPhot.Components.BaseClasses import ParamsBaseClass
 
 __all__ = []
 
+logger = logging.getLogger("SMolPhot.PSFs")
+
 #===============================================================================
 # MoleculeLocation
 #===============================================================================
@@ -106,9 +110,32 @@ class MoleculeLoc():
 #===============================================================================
 
 class AxialCalibParam(object):
+    """Axial calibration curve of a single value (sigmaX, sigmaY, dx, dy) by
+    fitPixels. The smoothing spline is sampled to uniform lookup tables of the
+    value and its derivatives for fast evaluation in the z-fitting loop.
+    
+    Args:
+        calibPoints (list): list of (frame, locs) tuples
+        valueFunc (function): extracts value from MoleculeLoc
+        smoothing (float): spline smoothing factor
+        useStds (bool, optional = False): stds of values are used as weights
+        zRange (tuple, optional): (zFrom, zTo) range of lookup tables,
+            defaults to the range of calibration points
+        tableStep (float, optional = 1e-9): resolution of lookup tables
+        tableInterpolation (str, optional = "cubic"): "linear", "cubic"
+            (Hermite) or "spline" (tables are not used)
+    
+    """
     
-    def __init__(self, calibPoints, valueFunc, smoothing, useStds = False):
+    # Max error of table lookup (relative to value range) before warning
+    TABLE_MAX_REL_ERROR = 1e-4
+    
+    def __init__(self, calibPoints, valueFunc, smoothing, useStds = False, zRange = None, \
+                 tableStep = 1e-9, tableInterpolation = "cubic"):
+        self.logger = logging.getLogger("SMolPhot.PSFs.AxialCalibParam")
         self._smoothing = None
+        self._tableStep, self._tableInterpolation = None, None
+        self._zRange = zRange
         self.useStds = useStds
         
         # Build temproary datastructure by fitPixels
@@ -134,6 +161,7 @@ class AxialCalibParam(object):
         self._minFitPixels = min(self.fitPixelsList)
         
         self.SetSmoothing(smoothing)
+        self.SetLookupTable(tableStep, tableInterpolation)
         
     def SetSmoothing(self, smoothing):
         if smoothing == self._smoothing:
@@ -145,10 +173,25 @@ class AxialCalibParam(object):
             intCoefs = interpolate.splrep(data["zs"], data["means"], \
                                           w = 1.0 / data["stds"], s = smoothing)
             data["interpCoefs"] = intCoefs
+        self._BuildTables()
+        
+    def SetLookupTable(self, tableStep, tableInterpolation):
+        if tableInterpolation not in ("linear", "cubic", "spline"):
+            raise ValueError("Unknown table interpolation %s" % (tableInterpolation))
+        if tableStep <= 0.0:
+            raise ValueError("Table step must be positive")
+        if (tableStep, tableInterpolation) == (self._tableStep, self._tableInterpolation):
+            return
+        
+        self._tableStep, self._tableInterpolation = tableStep, tableInterpolation
+        self._BuildTables()
             
-    def GetInterpolatedValue(self, z, fitPixels):
+    def GetInterpolatedValue(self, z, fitPixels, der = 0):
         fitPixelsActual = min(self._maxFitPixels, max(self._minFitPixels, fitPixels))
-        res = splevFast(z, self._dataDict[fitPixelsActual]["interpCoefs"])
+        data = self._dataDict[fitPixelsActual]
+        if "table" in data and der < 2:
+            return self._LookupTable(z, data, der)
+        res = splevFast(z, data["interpCoefs"], der = der)
         return res
     
     def GetData(self, fitPixels, error = True):
@@ -159,9 +202,100 @@ class AxialCalibParam(object):
         res = self._dataDict[fitPixelsActual]
         return res
     
+    def GetTableErrors(self, fitPixels):
+        """Returns max absolute errors of the value and of its derivative of
+        table lookup compared to the spline (None if tables are not used).
+        
+        """
+        return self._dataDict[fitPixels].get("tableErrors", None)
+    
     @property
     def fitPixelsList(self):
         return sorted(self._dataDict.keys())
+    
+    def _BuildTables(self):
+        if self._tableInterpolation is None or self._smoothing is None:
+            return
+        
+        for fitPixels, data in self._dataDict.iteritems():
+            data.pop("table", None)
+            data.pop("tableErrors", None)
+            if self._tableInterpolation == "spline":
+                continue
+            
+            # Sample the value and its first two derivatives
+            step = self._tableStep
+            zFrom, zTo = (data["zs"][0], data["zs"][-1]) if self._zRange is None else self._zRange
+            nrOfNodes = max(2, int(math.ceil((zTo - zFrom) / step)) + 1)
+            nodes = zFrom + step * np.arange(nrOfNodes)
+            tck = data["interpCoefs"]
+            samples = [splevFast(nodes, tck, der = der) for der in range(min(3, tck[2] + 1))]
+            samples += [np.zeros_like(nodes)] * (3 - len(samples))
+            
+            # Polynomial coefficients (by powers of t = (z - node) / step) of
+            # every interval, cubic Hermite uses also the next derivative
+            coefs = []
+            for der in range(2):
+                v0, v1 = samples[der][:-1], samples[der][1:]
+                if self._tableInterpolation == "linear":
+                    coefs.append(np.column_stack((v0, v1 - v0)))
+                else:
+                    d0, d1 = step * samples[der + 1][:-1], step * samples[der + 1][1:]
+                    coefs.append(np.column_stack((v0, d0, 3.0 * (v1 - v0) - 2.0 * d0 - d1, \
+                                                  2.0 * (v0 - v1) + d0 + d1)))
+            
+            data["table"] = {"zFrom": zFrom,
+                             "invStep": 1.0 / step,
+                             "last": nrOfNodes - 1,
+                             "coefs": coefs,
+                             "coefsList": [c.tolist() for c in coefs]}
+            
+            # Check against spline in the middle of the nodes
+            midpoints = nodes[:-1] + 0.5 * step
+            tableErrors = tuple(np.abs(self._LookupTable(midpoints, data, der) - \
+                                       splevFast(midpoints, tck, der = der)).max() for der in (0, 1))
+            data["tableErrors"] = tableErrors
+            valueRange = max(np.ptp(samples[0]), np.abs(samples[0]).max())
+            if tableErrors[0] > self.TABLE_MAX_REL_ERROR * valueRange:
+                self.logger.warn("Lookup table (fitPixels %d) error %g exceeds tolerance, decrease table step" % \
+                                 (fitPixels, tableErrors[0]))
+            self.logger.debug("Lookup table fitPixels %d: %d nodes, errors %s" % \
+                              (fitPixels, nrOfNodes, str(tableErrors)))
+    
+    def _LookupTable(self, z, data, der):
+        table = data["table"]
+        zFrom, invStep, last = table["zFrom"], table["invStep"], table["last"]
+        
+        # Single value (the hot loop of scipy fitting) in pure Python
+        try:
+            pos = (float(z) - zFrom) * invStep
+        except TypeError:
+            pass
+        else:
+            if not 0.0 <= pos <= last:
+                return splevFast(np.asarray(z, dtype = float), data["interpCoefs"], der = der)
+            i = min(int(pos), last - 1)
+            t = pos - i
+            c = table["coefsList"][der][i]
+            if len(c) == 2:
+                return np.array([c[0] + c[1] * t])
+            return np.array([c[0] + t * (c[1] + t * (c[2] + t * c[3]))])
+        
+        z = np.asarray(z, dtype = float).ravel()
+        pos = (z - zFrom) * invStep
+        i = np.minimum(np.maximum(pos.astype(np.intp), 0), last - 1)
+        t = pos - i
+        c = table["coefs"][der][i]
+        if c.shape[1] == 2:
+            res = c[:, 0] + c[:, 1] * t
+        else:
+            res = c[:, 0] + t * (c[:, 1] + t * (c[:, 2] + t * c[:, 3]))
+        
+        # Spline outside of the table
+        outside = (pos < 0.0) | (pos > last)
+        if outside.any():
+            res[outside] = splevFast(z[outside], data["interpCoefs"], der = der)
+        return res
 
 #===============================================================================
 # PsfBase
@@ -180,6 +314,34 @@ class PsfBase(ParamsBaseClass):
     @property
     def hasCalibrationData(self):
         return self._hasCalibrationData
+    
+    def GetAxialCalibration(self):
+        """Returns the axial calibration state of the PSF for transferring it
+        to other instance by SetAxialCalibration, None if not calibrated.
+        
+        """
+        raise NotImplementedError()
+    
+    def SetAxialCalibration(self, calibration):
+        """Sets the axial calibration state returned by GetAxialCalibration.
+        
+        """
+        raise NotImplementedError()
+    
+    def GetSupportHalfWidth(self, *bestFitParams):
+        """Returns the half-width of the region (in meters) outside of which
+        the PSF with given params is negligible, None if PSF must be evaluated
+        on the whole frame.
+        
+        """
+        return None
+    
+    def GetInitialGuess(self, loc, fitMode):
+        """Returns the fit params of loc in the form of initialGuess argument
+        of Fit (warm start of the fitting), None if not supported.
+        
+        """
+        return None
   
     @property
     def name(self):
@@ -206,6 +368,17 @@ def Gaussian2DSym((xs, ys), amp, x0, y0, sigma, offset):
                             ((y) ** 2.0) / (2.0 * sigma ** 2.0)) + offset
     return res
 
+def Gaussian2DSymJacobian((xs, ys), amp, x0, y0, sigma, offset):
+    # Partial derivatives by (amp, x0, y0, sigma, offset) along the last axis
+    x, y = xs - x0, ys - y0
+    rSq = x ** 2.0 + y ** 2.0
+    expPart = np.exp(-rSq / (2.0 * sigma ** 2.0))
+    ampExp = amp * expPart
+    dX0 = ampExp * x / sigma ** 2.0
+    dY0 = ampExp * y / sigma ** 2.0
+    dSigma = ampExp * rSq / sigma ** 3.0
+    return np.stack((expPart, dX0, dY0, dSigma, np.ones_like(expPart)), axis = -1)
+
 def LocsToArrays(locs):
     nrs = np.zeros((len(locs),), dtype = int)
     coordsX = np.zeros((len(locs),), dtype = float)
@@ -240,7 +413,74 @@ def Gaussian2D((xs, ys), amp, x0, y0, sigmaX, sigmaY, offset, cosPhi, sinPhi):
                             ((yP) ** 2.0) / (2.0 * sigmaY ** 2.0)) + offset
     return res
 
-def splevFast(x, tck):
+def Gaussian2DJacobian((xs, ys), amp, x0, y0, sigmaX, sigmaY, offset, cosPhi, sinPhi):
+    # Partial derivatives by (amp, x0, y0, sigmaX, sigmaY, offset) along the last axis
+    x, y = xs - x0, ys - y0
+    xP = cosPhi * x - sinPhi * y
+    yP = sinPhi * x + cosPhi * y
+    expPart = np.exp(-((xP) ** 2.0) / (2.0 * sigmaX ** 2.0) - \
+                     ((yP) ** 2.0) / (2.0 * sigmaY ** 2.0))
+    ampExp = amp * expPart
+    xPScaled, yPScaled = xP / sigmaX ** 2.0, yP / sigmaY ** 2.0
+    dX0 = ampExp * (cosPhi * xPScaled + sinPhi * yPScaled)
+    dY0 = ampExp * (cosPhi * yPScaled - sinPhi * xPScaled)
+    dSigmaX = ampExp * xP * xPScaled / sigmaX
+    dSigmaY = ampExp * yP * yPScaled / sigmaY
+    return np.stack((expPart, dX0, dY0, dSigmaX, dSigmaY, np.ones_like(expPart)), axis = -1)
+
+def Gaussian2DSeparable((xAxis, yAxis), amp, x0, y0, sigmaX, sigmaY, offset, flattened = False):
+    # Not rotated Gaussian2D on grid (axes from GetGridAxes) as an outer
+    # product of 1D Gaussians, only W + H exponents instead of W * H
+    ampExpX = amp * np.exp(-((xAxis - x0) ** 2.0) / (2.0 * sigmaX ** 2.0))
+    expY = np.exp(-((yAxis - y0) ** 2.0) / (2.0 * sigmaY ** 2.0))
+    res = ampExpX[..., :, np.newaxis] * expY[..., np.newaxis, :]
+    if flattened:
+        return res.reshape(res.shape[:-2] + (-1,)) + offset
+    if np.ndim(offset) > 0:
+        offset = np.reshape(offset, np.shape(offset) + (1,))
+    return res + offset
+
+def Gaussian2DWindow(coords, grid, amp, x0, y0, sigmaX, sigmaY, offset, cosPhi, sinPhi):
+    # Gaussian2D of flattened fit windows, separable form if grid axes of the
+    # windows are given (only for not rotated Gaussians)
+    if grid is not None:
+        return Gaussian2DSeparable(grid, amp, x0, y0, sigmaX, sigmaY, offset, flattened = True)
+    return Gaussian2D(coords, amp, x0, y0, sigmaX, sigmaY, offset, cosPhi, sinPhi)
+
+def GetGridAxes((xs, ys), flattened = False):
+    """Recovers 1D axes of coordinates sampled on "ij"-indexed grid (as
+    Frame.coords and fit windows from Frame.GetAround).
+    
+    Args:
+        (xs, ys) (arrays): coordinate grids (..., W, H) or, if flattened,
+            raveled grids (..., W * H)
+        flattened (bool, optional = False): coords are flattened
+    
+    Returns:
+        tuple (xAxis (..., W), yAxis (..., H)) or None if coords are not on
+        grid
+    
+    """
+    xs, ys = np.asarray(xs), np.asarray(ys)
+    if xs.shape != ys.shape or xs.ndim < (1 if flattened else 2) or xs.size == 0:
+        return None
+    
+    if flattened:
+        # Grid height from the first run of equal x-coordinates
+        firstXs = xs.reshape((-1, xs.shape[-1]))[0]
+        changes = np.flatnonzero(firstXs != firstXs[0])
+        height = changes[0] if len(changes) > 0 else len(firstXs)
+        if len(firstXs) % height != 0:
+            return None
+        shape = xs.shape[:-1] + (len(firstXs) // height, height)
+        xs, ys = xs.reshape(shape), ys.reshape(shape)
+    
+    xAxis, yAxis = xs[..., :, 0], ys[..., 0, :]
+    if not ((xs == xAxis[..., :, np.newaxis]).all() and (ys == yAxis[..., np.newaxis, :]).all()):
+        return None
+    return xAxis, yAxis
+
+def splevFast(x, tck, der = 0):
     t, c, k = tck
 
     # if ext not in (0, 1, 2, 3):
@@ -248,7 +488,7 @@ def splevFast(x, tck):
 
     # x = np.asarray(x)
     x = x.ravel()
-    y, _ = interpolate._fitpack._spl_(x, 0, t, c, k, 0)
+    y, _ = interpolate._fitpack._spl_(x, der, t, c, k, 0)
 
     # if ier == 10:
     #    raise ValueError("Invalid input data")
@@ -258,12 +498,12 @@ def splevFast(x, tck):
     #    raise TypeError("An error occurred")
     return y
 
-def FitLeastsqScipy(errfunc, p0, **kwargs):
+def FitLeastsqScipy(errfunc, p0, Dfun = None, **kwargs):
     method = kwargs.pop("method", "lm")
     if method != "lm":
         raise ValueError("Only method lm-supported")
     
-    pfit, pcov, _, __, ___ = optimize.leastsq(errfunc, p0, full_output = 1, **kwargs)
+    pfit, pcov, _, __, ___ = optimize.leastsq(errfunc, p0, Dfun = Dfun, full_output = 1, **kwargs)
     residual = errfunc(pfit)
 
     if (len(residual) > len(p0)) and pcov is not None:
@@ -281,3 +521,301 @@ def FitLeastsqScipy(errfunc, p0, **kwargs):
     pfit_leastsq = pfit
     perr_leastsq = np.array(error) 
     return pfit_leastsq, perr_leastsq, residual
+
+def FitLeastsqBatch(errfunc, p0, Dfun = None, **kwargs):
+    """Levenberg-Marquardt least squares fitting of N independent problems
+    with the same number of parameters and residuals at once. All problems
+    are iterated in a vectorized fashion, converged problems are masked out.
+    
+    Args:
+        errfunc (function): errfunc(params, indices) returns residuals (n, M)
+            of problems `indices` (int array) with params (n, k)
+        p0 (array): initial params (N, k)
+        Dfun (function, optional): Dfun(params, indices) returns Jacobians
+            (n, M, k) of the residuals, estimated by forward differences if
+            not given
+        xtol, ftol, gtol (float, optional): tolerances as in scipy leastsq
+        maxIterations (int, optional): maximal number of LM iterations
+        covariance (bool, optional = False): if True, covariance matrices
+            (N, k, k) are returned instead of stds
+        
+    Returns:
+        tuple (params (N, k), stds (N, k), residuals (N, M)), stds are
+        calculated the same way as in FitLeastsqScipy
+    
+    """
+    method = kwargs.pop("method", "lm")
+    if method != "lm":
+        raise ValueError("Only method lm-supported")
+    
+    # Problems are scaled by the norms of the Jacobian columns (as in
+    # leastsq without diag), therefore x_scale is not needed
+    kwargs.pop("x_scale", None)
+    xtol = kwargs.pop("xtol", 1.49012e-08)
+    ftol = kwargs.pop("ftol", 1.49012e-08)
+    gtol = kwargs.pop("gtol", 0.0)
+    
+    p = np.array(p0, dtype = float)
+    if p.ndim != 2:
+        raise ValueError("p0 must be 2D array (N, k)")
+    nrOfProblems, k = p.shape
+    maxIterations = kwargs.pop("maxIterations", 100 * (k + 1))
+    covariance = kwargs.pop("covariance", False)
+    if len(kwargs) > 0:
+        raise TypeError("Unknown arguments %s" % (kwargs.keys()))
+    
+    def NormalEquations(indices):
+        # Scaled normal equations, the diagonal of scaled JtJ is one
+        J = _BatchJacobian(errfunc, Dfun, p[indices], indices, r[indices])
+        JtJ = np.einsum("nmi,nmj->nij", J, J)
+        d = np.sqrt(np.einsum("nii->ni", JtJ))
+        d[d == 0.0] = 1.0
+        A[indices] = JtJ / (d[:, :, np.newaxis] * d[:, np.newaxis, :])
+        g[indices] = np.einsum("nmi,nm->ni", J, r[indices]) / d
+        D[indices] = d
+
+    allIndices = np.arange(nrOfProblems)
+    r = errfunc(p, allIndices)
+    cost = (r ** 2.0).sum(axis = 1)
+    A = np.empty((nrOfProblems, k, k))
+    g = np.empty((nrOfProblems, k))
+    D = np.empty((nrOfProblems, k))
+    damping = np.full(nrOfProblems, 1e-3)
+    active = np.ones(nrOfProblems, dtype = bool)
+    NormalEquations(allIndices)
+    
+    # Trial steps of diverging problems may over/underflow
+    with np.errstate(divide = "ignore", over = "ignore", under = "ignore", invalid = "ignore"):
+        for _ in range(maxIterations):
+            indices = np.flatnonzero(active)
+            if len(indices) == 0:
+                break
+        
+            # Gradient convergence
+            costIndices = cost[indices]
+            gNorm = np.abs(g[indices]).max(axis = 1) / np.sqrt(np.where(costIndices > 0.0, costIndices, 1.0))
+            converged = (gNorm <= gtol) | (costIndices == 0.0)
+            
+            # Diverged problems are stopped
+            Ad = A[indices] + damping[indices, np.newaxis, np.newaxis] * np.eye(k)
+            diverged = ~(np.isfinite(Ad).all(axis = (1, 2)) & np.isfinite(g[indices]).all(axis = 1))
+            converged |= diverged
+            Ad[diverged] = np.eye(k)
+        
+            # Damped step
+            stepsScaled = -np.linalg.solve(Ad, g[indices][:, :, np.newaxis])[:, :, 0]
+            pNew = p[indices] + stepsScaled / D[indices]
+            rNew = errfunc(pNew, indices)
+            costNew = (rNew ** 2.0).sum(axis = 1)
+            costNew[~np.isfinite(costNew)] = np.inf
+        
+            accept = (costNew <= costIndices) & ~converged
+            reject = ~accept & ~converged
+        
+            # Step/cost convergence
+            stepNorm = np.sqrt((stepsScaled ** 2.0).sum(axis = 1))
+            paramsNorm = np.sqrt(((D[indices] * p[indices]) ** 2.0).sum(axis = 1))
+            converged |= accept & ((costIndices - costNew <= ftol * costIndices) | \
+                                   (stepNorm <= xtol * paramsNorm))
+            converged |= reject & (damping[indices] > 1e16)
+        
+            # Update
+            acceptIndices = indices[accept]
+            p[acceptIndices] = pNew[accept]
+            r[acceptIndices] = rNew[accept]
+            cost[acceptIndices] = costNew[accept]
+            damping[acceptIndices] = np.maximum(damping[acceptIndices] * 0.1, 1e-12)
+            damping[indices[reject]] *= 10.0
+            active[indices[converged]] = False
+        
+            acceptIndices = acceptIndices[active[acceptIndices]]
+            if len(acceptIndices) > 0:
+                NormalEquations(acceptIndices)
+    
+        # Covariance from the Jacobian at solution (as leastsq)
+        NormalEquations(allIndices)
+    nrOfResiduals = r.shape[1]
+    if nrOfResiduals <= k:
+        return p, np.zeros((nrOfProblems, k, k) if covariance else (nrOfProblems, k)), r
+    
+    sSq = cost / (nrOfResiduals - k)
+    if covariance:
+        with np.errstate(invalid = "ignore", over = "ignore"):
+            covs = _BatchInverses(A) / (D[:, :, np.newaxis] * D[:, np.newaxis, :])
+            return p, covs * sSq[:, np.newaxis, np.newaxis], r
+    
+    # Singular problems get zero stds (as in FitLeastsqScipy)
+    with np.errstate(invalid = "ignore", over = "ignore"):
+        variances = _BatchInverseDiagonals(A) / D ** 2.0 * sSq[:, np.newaxis]
+    stds = np.where(np.isfinite(variances), np.sqrt(np.abs(variances)), 0.0)
+    return p, stds, r
+
+def FitPoissonMLEBatch(errfunc, p0, data, Dfun = None, **kwargs):
+    """Maximum likelihood fitting of N independent problems with Poisson
+    noise model by Newton-Raphson iterations (Fisher scoring with adaptive
+    damping). All problems are iterated in a vectorized fashion, converged
+    problems are masked out (as in FitLeastsqBatch). The number of problems
+    not converged in `iterations` is logged.
+    
+    The likelihood needs the data in photons including the background, the
+    negative values (e.g. of background subtracted data) are clipped to
+    zero, which biases the fit of such data.
+    
+    Args:
+        errfunc (function): errfunc(params, indices) returns data - model
+            (n, M) of problems `indices` (int array) with params (n, k)
+        p0 (array): initial params (N, k)
+        data (array): data (N, M) in photons
+        Dfun (function, optional): Jacobians (n, M, k) of errfunc, estimated
+            by forward differences if not given
+        xtol, ftol (float, optional): convergence tolerances of the scaled
+            step and of the negative log-likelihood, as in FitLeastsqBatch
+        iterations (int, optional = 100): maximal number of iterations
+        noiseModel (str, optional = "poisson"): "poisson" or "emccdStds".
+            The estimates are the same, only the stds of "emccdStds" include
+            the EM gain excess noise factor 2 (a constant factor of the
+            Poisson likelihood does not change its maximum)
+        
+    Returns:
+        tuple (params (N, k), stds (N, k), residuals (N, M)), stds are
+        Cramer-Rao lower bounds
+    
+    """
+    # Other least squares options are not used
+    for name in ("method", "x_scale", "gtol"):
+        kwargs.pop(name, None)
+    xtol = kwargs.pop("xtol", 1.49012e-08)
+    ftol = kwargs.pop("ftol", 1.49012e-08)
+    iterations = kwargs.pop("iterations", 100)
+    noiseModel = kwargs.pop("noiseModel", "poisson")
+    if len(kwargs) > 0:
+        raise TypeError("Unknown arguments %s" % (kwargs.keys()))
+    if noiseModel == "poisson":
+        excessNoise = 1.0
+    elif noiseModel == "emccdStds":
+        excessNoise = 2.0
+    else:
+        raise ValueError("Unknown noise model %s" % (noiseModel))
+    
+    p = np.array(p0, dtype = float)
+    if p.ndim != 2:
+        raise ValueError("p0 must be 2D array (N, k)")
+    nrOfProblems, k = p.shape
+    data = np.asarray(data, dtype = float)
+    counts = np.maximum(data, 0.0)
+    
+    def Model(r, indices):
+        # Model is kept positive for the likelihood
+        return np.maximum(data[indices] - r, 1e-6)
+    
+    def NegLogLikelihood(r, indices):
+        model = Model(r, indices)
+        return (model - counts[indices] * np.log(model)).sum(axis = 1)
+    
+    def Scoring(indices):
+        # Fisher information and gradient of negative log-likelihood
+        # (excess noise factor cancels out from the step)
+        J = -_BatchJacobian(errfunc, Dfun, p[indices], indices, r[indices])
+        model = Model(r[indices], indices)
+        fisher = np.einsum("nmi,nmj,nm->nij", J, J, 1.0 / model)
+        gradient = np.einsum("nmi,nm->ni", J, 1.0 - counts[indices] / model)
+        d = np.sqrt(np.einsum("nii->ni", fisher))
+        d[(d == 0.0) | ~np.isfinite(d)] = 1.0
+        A[indices] = fisher / (d[:, :, np.newaxis] * d[:, np.newaxis, :])
+        g[indices] = gradient / d
+        D[indices] = d
+    
+    allIndices = np.arange(nrOfProblems)
+    A = np.empty((nrOfProblems, k, k))
+    g = np.empty((nrOfProblems, k))
+    D = np.empty((nrOfProblems, k))
+    damping = np.full(nrOfProblems, 1e-3)
+    active = np.ones(nrOfProblems, dtype = bool)
+    notConverged = np.zeros(nrOfProblems, dtype = bool)
+    
+    with np.errstate(divide = "ignore", over = "ignore", under = "ignore", invalid = "ignore"):
+        r = errfunc(p, allIndices)
+        nll = NegLogLikelihood(r, allIndices)
+        Scoring(allIndices)
+        for _ in range(iterations):
+            indices = np.flatnonzero(active)
+            if len(indices) == 0:
+                break
+            
+            # Diverged problems are stopped (and counted as not converged)
+            Ad = A[indices] + damping[indices, np.newaxis, np.newaxis] * np.eye(k)
+            diverged = ~(np.isfinite(Ad).all(axis = (1, 2)) & np.isfinite(g[indices]).all(axis = 1))
+            notConverged[indices[diverged]] = True
+            converged = diverged.copy()
+            Ad[diverged] = np.eye(k)
+            
+            # Damped step
+            stepsScaled = -np.linalg.solve(Ad, np.where(diverged[:, np.newaxis], 0.0, g[indices])[:, :, np.newaxis])[:, :, 0]
+            pNew = p[indices] + stepsScaled / D[indices]
+            rNew = errfunc(pNew, indices)
+            nllIndices = nll[indices]
+            nllNew = NegLogLikelihood(rNew, indices)
+            nllNew[~np.isfinite(nllNew)] = np.inf
+            
+            accept = (nllNew <= nllIndices) & ~converged
+            reject = ~accept & ~converged
+            
+            # Step/likelihood convergence, the log-likelihood may be negative
+            stepNorm = np.sqrt((stepsScaled ** 2.0).sum(axis = 1))
+            paramsNorm = np.sqrt(((D[indices] * p[indices]) ** 2.0).sum(axis = 1))
+            converged |= accept & ((nllIndices - nllNew <= ftol * np.abs(nllIndices)) | \
+                                   (stepNorm <= xtol * paramsNorm))
+            converged |= reject & (damping[indices] > 1e16)
+            
+            # Accept improved, increase damping of others
+            acceptIndices = indices[accept]
+            p[acceptIndices] = pNew[accept]
+            r[acceptIndices] = rNew[accept]
+            nll[acceptIndices] = nllNew[accept]
+            damping[acceptIndices] = np.maximum(damping[acceptIndices] * 0.1, 1e-12)
+            damping[indices[reject]] *= 10.0
+            active[indices[converged]] = False
+            if len(acceptIndices) > 0:
+                Scoring(acceptIndices)
+    
+    notConverged |= active
+    if notConverged.any():
+        logger.info("MLE: %d of %d fits not converged in %d iterations" % \
+                    (notConverged.sum(), nrOfProblems, iterations))
+    
+    # Cramer-Rao lower bounds from the Fisher information at solution
+    variances = excessNoise * _BatchInverseDiagonals(A) / D ** 2.0
+    stds = np.where(np.isfinite(variances), np.sqrt(np.abs(variances)), 0.0)
+    return p, stds, r
+
+def _BatchJacobian(errfunc, Dfun, params, indices, r):
+    # Jacobians (n, M, k) of batched errfunc
+    if Dfun is not None:
+        return Dfun(params, indices)
+    
+    # Forward differences, step as in MINPACK
+    res = np.empty(r.shape + (params.shape[1],))
+    steps = np.sqrt(np.finfo(float).eps) * np.abs(params)
+    steps[steps == 0.0] = np.sqrt(np.finfo(float).eps)
+    for j in range(params.shape[1]):
+        paramsStep = params.copy()
+        paramsStep[:, j] += steps[:, j]
+        res[:, :, j] = (errfunc(paramsStep, indices) - r) / steps[:, j, np.newaxis]
+    return res
+
+def _BatchInverseDiagonals(A):
+    # Diagonals of inverses of (N, k, k) matrices, NaN for singular ones
+    return np.einsum("nii->ni", _BatchInverses(A))
+
+def _BatchInverses(A):
+    # Inverses of (N, k, k) matrices, NaN for singular ones
+    try:
+        invA = np.linalg.inv(np.where(np.isfinite(A), A, 0.0))
+    except np.linalg.LinAlgError:
+        invA = np.full_like(A, np.nan)
+        for i in range(A.shape[0]):
+            try:
+                invA[i] = np.linalg.inv(A[i])
+            except np.linalg.LinAlgError:
+                pass
+    return invA
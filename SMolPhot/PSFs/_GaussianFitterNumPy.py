@@ -0,0 +1,126 @@
+"""Pure NumPy implementation of the optional GaussianFitter extension. The
+functions have the same call signatures and return values as in the
+extension (params, pcov, residual). In addition to single fit windows (1D
+xs, ys, data and initial), stacked windows (2D arrays, one window per row)
+are fitted simultaneously by the batched Levenberg-Marquardt fitter.
+
+"""
+
+import math
+import numpy as np
+
+from _Common import FitLeastsqBatch, Gaussian2DJacobian, Gaussian2DSymJacobian, \
+    Gaussian2DWindow, GetGridAxes, splevFast
+
+__all__ = ["Fit2dGaussSigma", "Fit2dGaussSigmaSym", "Fit2dGaussZ", "Fit2dGaussZSym"]
+
+#===============================================================================
+# Fitting functions
+#===============================================================================
+
+def Fit2dGaussSigma(xs, ys, data, initial, phi = 0.0, **kwargs):
+    """Fits elliptical Gaussian (amp, x0, y0, sigmaX, sigmaY, offset) rotated
+    by angle phi.
+
+    """
+    cosPhi, sinPhi = math.cos(phi), math.sin(phi)
+    def Func(xs, ys, grid, params):
+        amp, x0, y0, sigmaX, sigmaY, offset = params.T[:, :, np.newaxis]
+        return Gaussian2DWindow((xs, ys), grid, amp, x0, y0, sigmaX, sigmaY, offset, cosPhi, sinPhi)
+
+    def Jacobian(xs, ys, params):
+        amp, x0, y0, sigmaX, sigmaY, offset = params.T[:, :, np.newaxis]
+        return Gaussian2DJacobian((xs, ys), amp, x0, y0, sigmaX, sigmaY, offset, cosPhi, sinPhi)
+
+    return _Fit(Func, Jacobian, xs, ys, data, initial, sinPhi == 0.0, **kwargs)
+
+def Fit2dGaussSigmaSym(xs, ys, data, initial, **kwargs):
+    """Fits symmetric Gaussian (amp, x0, y0, sigma, offset).
+
+    """
+    def Func(xs, ys, grid, params):
+        amp, x0, y0, sigma, offset = params.T[:, :, np.newaxis]
+        return Gaussian2DWindow((xs, ys), grid, amp, x0, y0, sigma, sigma, offset, 1.0, 0.0)
+
+    def Jacobian(xs, ys, params):
+        amp, x0, y0, sigma, offset = params.T[:, :, np.newaxis]
+        return Gaussian2DSymJacobian((xs, ys), amp, x0, y0, sigma, offset)
+
+    return _Fit(Func, Jacobian, xs, ys, data, initial, True, **kwargs)
+
+def Fit2dGaussZ(xs, ys, data, initial, tckSigmaX, tckSigmaY, phi = 0.0, **kwargs):
+    """Fits elliptical Gaussian (amp, x0, y0, z0, offset) rotated by angle phi,
+    sigmas are given by B-spline representations tckSigmaX and tckSigmaY.
+
+    """
+    cosPhi, sinPhi = math.cos(phi), math.sin(phi)
+    def Func(xs, ys, grid, params):
+        amp, x0, y0, z0, offset = params.T[:, :, np.newaxis]
+        sigmaX, sigmaY = _Spline(z0, tckSigmaX), _Spline(z0, tckSigmaY)
+        return Gaussian2DWindow((xs, ys), grid, amp, x0, y0, sigmaX, sigmaY, offset, cosPhi, sinPhi)
+
+    def Jacobian(xs, ys, params):
+        amp, x0, y0, z0, offset = params.T[:, :, np.newaxis]
+        sigmaX, sigmaY = _Spline(z0, tckSigmaX), _Spline(z0, tckSigmaY)
+        jacobianSigma = Gaussian2DJacobian((xs, ys), amp, x0, y0, sigmaX, sigmaY, offset, \
+                                           cosPhi, sinPhi)
+        res = jacobianSigma[..., [0, 1, 2, 3, 5]]
+        res[..., 3] = jacobianSigma[..., 3] * _Spline(z0, tckSigmaX, der = 1) + \
+            jacobianSigma[..., 4] * _Spline(z0, tckSigmaY, der = 1)
+        return res
+
+    return _Fit(Func, Jacobian, xs, ys, data, initial, sinPhi == 0.0, **kwargs)
+
+def Fit2dGaussZSym(xs, ys, data, initial, tckSigma, **kwargs):
+    """Fits symmetric Gaussian (amp, x0, y0, z0, offset), sigma is given by
+    B-spline representation tckSigma.
+
+    """
+    def Func(xs, ys, grid, params):
+        amp, x0, y0, z0, offset = params.T[:, :, np.newaxis]
+        sigma = _Spline(z0, tckSigma)
+        return Gaussian2DWindow((xs, ys), grid, amp, x0, y0, sigma, sigma, offset, 1.0, 0.0)
+
+    def Jacobian(xs, ys, params):
+        amp, x0, y0, z0, offset = params.T[:, :, np.newaxis]
+        jacobianSigma = Gaussian2DSymJacobian((xs, ys), amp, x0, y0, _Spline(z0, tckSigma), offset)
+        jacobianSigma[..., 3] *= _Spline(z0, tckSigma, der = 1)
+        return jacobianSigma
+
+    return _Fit(Func, Jacobian, xs, ys, data, initial, True, **kwargs)
+
+#===============================================================================
+# Helpers
+#===============================================================================
+
+def _Spline(z0, tck, der = 0):
+    # Spline values of z0 (n, 1)
+    return splevFast(z0, tck, der = der)[:, np.newaxis]
+
+def _Fit(Func, Jacobian, xs, ys, data, initial, separable, **kwargs):
+    # Single window is fitted as a batch of one
+    xs, ys, data = np.atleast_2d(xs, ys, data)
+    initials = np.atleast_2d(np.asarray(initial, dtype = float))
+    if xs.shape[0] == 1 and data.shape[0] > 1:
+        xs = np.tile(xs, (data.shape[0], 1))
+        ys = np.tile(ys, (data.shape[0], 1))
+
+    # Not rotated Gaussians on grid are evaluated in separable form
+    grid = GetGridAxes((xs, ys), flattened = True) if separable else None
+
+    def ErrFunc(params, indices):
+        gridIndices = None if grid is None else (grid[0][indices], grid[1][indices])
+        return data[indices] - Func(xs[indices], ys[indices], gridIndices, params)
+
+    def Dfun(params, indices):
+        return -Jacobian(xs[indices], ys[indices], params)
+
+    kwargs.pop("method", None)
+    params, pcov, residuals = FitLeastsqBatch(ErrFunc, initials, Dfun = Dfun, \
+                                              covariance = True, **kwargs)
+    if np.ndim(initial) == 1:
+        return params[0], pcov[0], residuals[0]
+    return params, pcov, residuals
+
+if __name__ == "__main__":
+    pass
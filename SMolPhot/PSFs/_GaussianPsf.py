@@ -1,4 +1,5 @@
 import math
+import time
 import logging
 import traceback
 import numpy as np
@@ -7,17 +8,28 @@ from scipy import optimize
 from collections import OrderedDict
 from SMolPhot.Components.BaseClasses import Param
 from _Common import PsfBase, MoleculeLoc, AxialCalibParam, FitLeastsqScipy, \
-    Gaussian2D, Gaussian2DSym
+    FitLeastsqBatch, FitPoissonMLEBatch, Gaussian2D, Gaussian2DSym, Gaussian2DJacobian, \
+    Gaussian2DSymJacobian, Gaussian2DSeparable, Gaussian2DWindow, GetGridAxes
 
-# Try to import optional libraries
+# Try to import optional libraries, GaussianFitter is replaced by the pure
+# NumPy implementation if the extension is missing
 try:
     import GaussianFitter
-except:
-    print "Importing GaussianFitter failed"
-    traceback.print_exc()
+    gaussianFitterName = "Fortran gaussian fitter"
+except ImportError:
+    print "Importing GaussianFitter failed, using NumPy implementation"
+    import _GaussianFitterNumPy as GaussianFitter
+    gaussianFitterName = "NumPy gaussian fitter"
 
 __all__ = ["GaussianPsf"]
 
+# Fitting libraries fitting many windows at once
+BATCH_LIBRARIES = ("numpyBatchLM", "numpyMLE")
+
+# Smaller grids are evaluated faster directly than by the separable form
+# (overhead of the grid check in Calc)
+SEPARABLE_MIN_PIXELS = 1024
+
 #===============================================================================
 # GaussianPsf
 #===============================================================================
@@ -46,7 +58,19 @@ class GaussianPsf(PsfBase):
         # Fitting libraries
         self._fittingLibrarys = OrderedDict([("SciPy leastsq", "scipyLeastsq"),
                                              ("SciPy curve_fit", "scipyCurveFit"),
-                                             ("Fortran gaussian fitter", "GaussianFitter")])
+                                             (gaussianFitterName, "GaussianFitter"),
+                                             ("NumPy batched LM", "numpyBatchLM"),
+                                             ("NumPy MLE (Poisson)", "numpyMLE")])
+        
+        # Noise models of MLE, EMCCD changes only the stds (excess noise
+        # factor), the estimates are the same as with Poisson
+        self._mleNoiseModels = OrderedDict([("Poisson", "poisson"),
+                                            ("Poisson, EMCCD stds", "emccdStds")])
+        
+        # Lookup of axial calibration curves
+        self._calibLookups = OrderedDict([("Cubic table", "cubic"),
+                                          ("Linear table", "linear"),
+                                          ("Spline", "spline")])
         
         # Fitting methods
         self._fittingMethods = OrderedDict([("Levenberg-Marquardt", "lm"),
@@ -86,6 +110,20 @@ class GaussianPsf(PsfBase):
                   friendlyName = "Smooth wobble y",
                   guiStep = 0.1,
                   guiLimits = (0.0, 1e12)),
+            
+            # Lookup tables of calibration curves
+            
+            Param("_calibLookup", "cubic",
+                  friendlyName = "Calibration lookup",
+                  guiType = "list",
+                  guiValues = self._calibLookups),
+            
+            Param("_calibTableStep", 1e-9,
+                  friendlyName = "Calibration table step",
+                  guiSiPrefix = True,
+                  guiSuffix = "m",
+                  guiStep = 1e-9,
+                  guiLimits = (1e-12, 100e-9)),
                       
             # Fitting        
             
@@ -110,6 +148,36 @@ class GaussianPsf(PsfBase):
                       
             Param("_fitScale", False,
                   friendlyName = "Fit scale"),
+            
+            # Two-stage fitting, coarse pass filters candidates for refinement
+            
+            Param("_twoStageFitting", False,
+                  friendlyName = "Two-stage fitting"),
+            
+            Param("_coarseFitTol", 1e-3,
+                  friendlyName = "Coarse fit tolerance"),
+            
+            # 0 - same window as in refinement
+            Param("_coarseFitPixels", 0,
+                  friendlyName = "Coarse fit pixels",
+                  guiStep = 1,
+                  guiLimits = (0, 10)),
+            
+            # Maximal number of iterations, fits stop at fit tolerances
+            Param("_mleIterations", 100,
+                  friendlyName = "MLE max iterations",
+                  guiStep = 1,
+                  guiLimits = (1, 1000)),
+            
+            Param("_mleNoiseModel", "poisson",
+                  friendlyName = "MLE noise model",
+                  guiType = "list",
+                  guiValues = self._mleNoiseModels),
+            
+            # Opt-in, the fits converge to slightly different optima than with
+            # finite differences, so some localizations change
+            Param("_analyticJacobian", False,
+                  friendlyName = "Analytic Jacobian"),
 
             Param("_initialSigma", 300e-9,
                   friendlyName = "Initial sigma",
@@ -136,6 +204,14 @@ class GaussianPsf(PsfBase):
                   guiStep = 1,
                   guiLimits = (0, 5)),
             
+            # Subtraction of localizations, 0 - whole frame
+            
+            Param("_subtractSigmas", 6.0,
+                  friendlyName = "Subtraction half-width",
+                  guiSuffix = " sigma",
+                  guiStep = 0.5,
+                  guiLimits = (0.0, 100.0)),
+            
             # Goodness/Error functions
             
             Param("_goodnessFunc", goodnessFuncsNames[0],
@@ -150,6 +226,7 @@ class GaussianPsf(PsfBase):
             ]
         
         PsfBase.__init__(self, params + paramsThis, **kwargs)
+        self.ResetTwoStageStats()
         self._Update()
 
     def SetParams(self, default = False, **kwargs):
@@ -158,10 +235,22 @@ class GaussianPsf(PsfBase):
             self._Update()
 
     def Calc(self, (xs, ys), amp, x0, y0, sigmaX, sigmaY, offset):
+        # Not rotated Gaussian on grid is evaluated in separable form
+        grid = None
+        if (self.sinPhi == 0.0 or sigmaX == sigmaY) and np.size(xs) >= SEPARABLE_MIN_PIXELS:
+            grid = GetGridAxes((xs, ys))
+        if grid is not None:
+            return Gaussian2DSeparable(grid, amp, x0, y0, sigmaX, sigmaY, offset)
         return Gaussian2D((xs, ys), amp, x0, y0, sigmaX, sigmaY, offset, self.cosPhi, self.sinPhi)
         
     def CalcWithoutOffset(self, (xs, ys), amp, x0, y0, sigmaX, sigmaY, _):
-        return Gaussian2D((xs, ys), amp, x0, y0, sigmaX, sigmaY, 0.0, self.cosPhi, self.sinPhi)
+        return self.Calc((xs, ys), amp, x0, y0, sigmaX, sigmaY, 0.0)
+    
+    def GetSupportHalfWidth(self, amp, x0, y0, sigmaX, sigmaY, offset):
+        if self._subtractSigmas <= 0.0:
+            return None
+        # Independent of phi, as the larger sigma is used in both directions
+        return self._subtractSigmas * max(abs(sigmaX), abs(sigmaY))
 
     def Fit(self, frame, initialCoord, fitPixels, fitMode = "z", initialMaxDist = np.inf, \
             initialGuess = None, fitShiftPixels = (0, 0), fitShiftIteration = 0):
@@ -175,7 +264,7 @@ class GaussianPsf(PsfBase):
             fitCenterPixels = frame.CropCoord((initialPixels[0] + fitShiftPixels[0], \
                                                initialPixels[1] + fitShiftPixels[1]))
         _, coordsFlatten, dataFlatten = frame.GetAround(fitCenterPixels, fitPixels, flatten = True)
-        iAmp = frame._data[fitCenterPixels]
+        iAmp = float(frame._data[fitCenterPixels])
 
         # Do fitting
         try:
@@ -192,7 +281,120 @@ class GaussianPsf(PsfBase):
         except RuntimeError:
             traceback.print_exc()
             return None
-            
+        
+        return self._MakeLoc(frame, initialCoord, fitPixels, fitMode, initialMaxDist, \
+                             fitCenterPixels, fitParamValues, fitStds, residual, \
+                             fitShiftIteration)
+    
+    def FitBatch(self, frame, initialCoords, fitPixels, fitMode = "z", initialMaxDist = np.inf, \
+                 acceptFunc = None):
+        """Fits all initial coords of a detection pass. With batched libraries
+        ("numpyBatchLM", "numpyMLE") the equally sized fit windows are fitted
+        simultaneously, the windows cropped by the frame edge and other
+        libraries are fitted one by one by Fit.
+        
+        In two-stage mode (and if acceptFunc is given) all candidates are
+        first fitted with loose tolerances in a smaller window. Only the
+        candidates accepted by acceptFunc are refined by the full fit, started
+        from the coarse parameters.
+        
+        Args:
+            acceptFunc (function, optional): acceptFunc(loc) returns False for
+                locations rejected by the localizer
+        
+        Returns:
+            list of MoleculeLoc (None if fitting failed or rejected in the
+            coarse pass) in the order of initialCoords
+        
+        """
+        if not self._twoStageFitting or acceptFunc is None:
+            return self._FitBatch(frame, initialCoords, fitPixels, fitMode, initialMaxDist)
+        
+        # Coarse pass
+        t0 = time.time()
+        fitExtraParams = self.fitExtraParams
+        self.fitExtraParams = dict(fitExtraParams, xtol = self._coarseFitTol, \
+                                   ftol = self._coarseFitTol, gtol = self._coarseFitTol)
+        coarseFitPixels = fitPixels if self._coarseFitPixels <= 0 else \
+            min(self._coarseFitPixels, fitPixels)
+        try:
+            coarseLocs = self._FitBatch(frame, initialCoords, coarseFitPixels, fitMode, initialMaxDist)
+        finally:
+            self.fitExtraParams = fitExtraParams
+        refineIndices = [i for i, loc in enumerate(coarseLocs) if loc is not None and acceptFunc(loc)]
+        
+        # Refinement of accepted candidates
+        t1 = time.time()
+        res = [None] * len(initialCoords)
+        initialGuesses = [self.GetInitialGuess(coarseLocs[i], fitMode) for i in refineIndices]
+        refinedLocs = self._FitBatch(frame, [initialCoords[i] for i in refineIndices], fitPixels, \
+                                     fitMode, initialMaxDist, initialGuesses = initialGuesses)
+        for i, loc in zip(refineIndices, refinedLocs):
+            res[i] = loc
+        t2 = time.time()
+        
+        # Statistics
+        stats = self.twoStageStats
+        stats["coarseFits"] += len(initialCoords)
+        stats["refinedFits"] += len(refineIndices)
+        stats["coarseTime"] += t1 - t0
+        stats["refineTime"] += t2 - t1
+        self.logger.info("Two-stage fit: %d coarse fits (%.1f ms), %d refined (%.1f ms), %d avoided" % \
+                         (len(initialCoords), 1e3 * (t1 - t0), len(refineIndices), 1e3 * (t2 - t1), \
+                          len(initialCoords) - len(refineIndices)))
+        return res
+    
+    def ResetTwoStageStats(self):
+        """Resets the accumulated counts (coarseFits, refinedFits) and timings
+        (coarseTime, refineTime in seconds) of two-stage fitting in
+        twoStageStats.
+        
+        """
+        self.twoStageStats = {"coarseFits": 0, "refinedFits": 0, "coarseTime": 0.0, "refineTime": 0.0}
+    
+    def _FitBatch(self, frame, initialCoords, fitPixels, fitMode, initialMaxDist, initialGuesses = None):
+        if initialGuesses is None:
+            initialGuesses = [None] * len(initialCoords)
+        
+        if self._fittingLibrary not in BATCH_LIBRARIES:
+            return [self.Fit(frame, initialCoord, fitPixels, fitMode = fitMode, \
+                             initialMaxDist = initialMaxDist, initialGuess = initialGuess) \
+                    for initialCoord, initialGuess in zip(initialCoords, initialGuesses)]
+        
+        res = [None] * len(initialCoords)
+        fitCenterPixels = [frame.GetCoordsPixels(initialCoord) for initialCoord in initialCoords]
+        inside, coords, data = frame.GetAroundBatch(fitCenterPixels, fitPixels)
+        for i in np.flatnonzero(~inside):
+            res[i] = self.Fit(frame, initialCoords[i], fitPixels, fitMode = fitMode, \
+                              initialMaxDist = initialMaxDist, initialGuess = initialGuesses[i])
+        
+        batchIndices = np.flatnonzero(inside)
+        if len(batchIndices) == 0:
+            return res
+        
+        # Fit all windows at once
+        centersX, centersY = np.array(fitCenterPixels, dtype = int)[batchIndices].T
+        iAmps = frame._data[centersX, centersY].astype(float)
+        initialCoordsBatch = np.array(initialCoords, dtype = float)[batchIndices]
+        initials = None
+        if initialGuesses[0] is not None:
+            initials = np.array(initialGuesses, dtype = float)[batchIndices]
+        if fitMode == "sigma":
+            fitRes = self._DoFittingSigmaBatch(iAmps, initialCoordsBatch, coords, data, \
+                                               initials, **self.fitExtraParams)
+        elif fitMode == "z":
+            fitRes = self._DoFittingZBatch(iAmps, initialCoordsBatch, coords, data, \
+                                           fitPixels, initials, **self.fitExtraParams)
+        else:
+            raise NotImplementedError()
+
+        for i, fitParamValues, fitStds, residual in zip(batchIndices, *fitRes):
+            res[i] = self._MakeLoc(frame, initialCoords[i], fitPixels, fitMode, initialMaxDist, \
+                                   fitCenterPixels[i], fitParamValues, fitStds, residual, 0)
+        return res
+    
+    def _MakeLoc(self, frame, initialCoord, fitPixels, fitMode, initialMaxDist, \
+                 fitCenterPixels, fitParamValues, fitStds, residual, fitShiftIteration):
         # Extract params
         amp, x0, y0, z0, sigmaX, sigmaY, offset = fitParamValues
         stdAmp, stdX0, stdY0, stdZ0, stdSigmaX, stdSigmaY, stdOffset = fitStds
@@ -267,7 +469,7 @@ class GaussianPsf(PsfBase):
         res.errorValue = self.errorFunc(res)
         return res
     
-    def SetAxialCalibPoints(self, points, useStds = False):
+    def SetAxialCalibPoints(self, points, useStds = False, zRange = None):
         self.logger.info("SetAxialCalibPoints %d" % (len(points)))
         
         if len(points) < 1:
@@ -275,21 +477,37 @@ class GaussianPsf(PsfBase):
             self._calibDx, self._calibDy = None, None
             self._hasCalibrationData = False
             return
+        
+        tableKwargs = {"useStds": useStds, "zRange": zRange, "tableStep": self._calibTableStep, \
+                       "tableInterpolation": self._calibLookup}
             
         self._calibSigmaX = AxialCalibParam(points, lambda loc: loc.sigmaX, \
-                                            self._sIntSigmaX, useStds = useStds)
+                                            self._sIntSigmaX, **tableKwargs)
         
         self._calibSigmaY = AxialCalibParam(points, lambda loc: loc.sigmaY, \
-                                            self._sIntSigmaY, useStds = useStds)
+                                            self._sIntSigmaY, **tableKwargs)
         
         self._calibDx = AxialCalibParam(points, lambda loc: loc.startPositionOffset[0],
-                                        self._sIntDx, useStds = useStds)
+                                        self._sIntDx, **tableKwargs)
         
         self._calibDy = AxialCalibParam(points, lambda loc: loc.startPositionOffset[1],
-                                        self._sIntDy, useStds = useStds)
+                                        self._sIntDy, **tableKwargs)
         
         self._hasCalibrationData = True
         
+    def GetAxialCalibration(self):
+        if not self.hasCalibrationData:
+            return None
+        return (self._calibSigmaX, self._calibSigmaY, self._calibDx, self._calibDy)
+    
+    def SetAxialCalibration(self, calibration):
+        if calibration is None:
+            self.SetAxialCalibPoints([])
+            return
+        self._calibSigmaX, self._calibSigmaY, self._calibDx, self._calibDy = calibration
+        self._hasCalibrationData = True
+        self.UpdateCalibInterpolation()
+        
     def UpdateCalibInterpolation(self):
         if not self.hasCalibrationData:
             return
@@ -298,6 +516,9 @@ class GaussianPsf(PsfBase):
         self._calibSigmaY.SetSmoothing(self._sIntSigmaY)
         self._calibDx.SetSmoothing(self._sIntDx)
         self._calibDy.SetSmoothing(self._sIntDy)
+        
+        for calibParam in (self._calibSigmaX, self._calibSigmaY, self._calibDx, self._calibDy):
+            calibParam.SetLookupTable(self._calibTableStep, self._calibLookup)
 
     @property
     def wobbleCalibParamValues(self):
@@ -341,16 +562,19 @@ class GaussianPsf(PsfBase):
         # Differnet libraries
         if self._fittingLibrary == "scipyLeastsq":
             if self._symmetric:
-                fitRes = Fit2DGaussianSigmaLeastSq(coords, data, initial, **kwargs)
+                fitRes = Fit2DGaussianSigmaLeastSq(coords, data, initial, \
+                    analyticJacobian = self._analyticJacobian, **kwargs)
             else:
-                fitRes = Fit3DGaussianSigmaLeastSq(coords, data, initial, self.cosPhi, self.sinPhi, **kwargs)
+                fitRes = Fit3DGaussianSigmaLeastSq(coords, data, initial, self.cosPhi, self.sinPhi, \
+                    analyticJacobian = self._analyticJacobian, **kwargs)
             fitParamValues, fitStds, residual = fitRes
                 
         elif self._fittingLibrary == "scipyCurveFit":
             if self._symmetric:
                 raise NotImplementedError()
             else:
-                fitRes = Fit3DGaussianSigmaCurveFit(coords, data, initial, self.cosPhi, self.sinPhi, **kwargs)
+                fitRes = Fit3DGaussianSigmaCurveFit(coords, data, initial, self.cosPhi, self.sinPhi, \
+                    analyticJacobian = self._analyticJacobian, **kwargs)
             fitParamValues, fitStds, residual = fitRes
         elif self._fittingLibrary == "GaussianFitter":
             method = kwargs.pop("method", "lm")
@@ -361,11 +585,15 @@ class GaussianPsf(PsfBase):
                 fitRes = GaussianFitter.Fit2dGaussSigmaSym(coords[0], coords[1], data, initialNew, **kwargs)
                 fitParamValues, pcov, residual = fitRes
                 fitParamValues = DuplicateSigma(fitParamValues)
-                fitStds = DuplicateSigma(np.sqrt(np.diag(pcov)))
+                fitStds = DuplicateSigma(np.sqrt(np.abs(np.diag(pcov))))
             else:
                 fitRes = GaussianFitter.Fit2dGaussSigma(coords[0], coords[1], data, initial, phi = self._phi, **kwargs)
                 fitParamValues, pcov, residual = fitRes
-                fitStds = np.sqrt(np.diag(pcov))
+                fitStds = np.sqrt(np.abs(np.diag(pcov)))
+        elif self._fittingLibrary in BATCH_LIBRARIES:
+            fitRes = self._FitSigmaBatch((coords[0][np.newaxis], coords[1][np.newaxis]), \
+                                         data[np.newaxis], [initial], **kwargs)
+            fitParamValues, fitStds, residual = [v[0] for v in fitRes]
         else:
             raise NotImplementedError()
         
@@ -392,20 +620,24 @@ class GaussianPsf(PsfBase):
                 
         sigmaXFunc = lambda z: self._calibSigmaX.GetInterpolatedValue(z, fitPixels)
         sigmaYFunc = lambda z: self._calibSigmaY.GetInterpolatedValue(z, fitPixels)
+        sigmaXDerFunc, sigmaYDerFunc = self._GetSigmaDerFuncs(fitPixels)
         
         if self._fittingLibrary == "scipyLeastsq":
             if self._symmetric:
-                fitRes = Fit2DGaussianZLeastSq(coords, data, initial, sigmaXFunc, **kwargs)
+                fitRes = Fit2DGaussianZLeastSq(coords, data, initial, sigmaXFunc, \
+                    sigmaDerFunc = sigmaXDerFunc, **kwargs)
             else:
                 fitRes = Fit3DGaussianZLeastSq(coords, data, initial, self.cosPhi, \
-                    self.sinPhi, sigmaXFunc, sigmaYFunc, **kwargs)
+                    self.sinPhi, sigmaXFunc, sigmaYFunc, sigmaXDerFunc = sigmaXDerFunc, \
+                    sigmaYDerFunc = sigmaYDerFunc, **kwargs)
             fitParamValues, fitStds, residual = fitRes
         elif self._fittingLibrary == "scipyCurveFit":
             if self._symmetric:
                 raise NotImplementedError()
             else:
                 fitRes = Fit3DGaussianZCurveFit(coords, data, initial, self.cosPhi, \
-                    self.sinPhi, sigmaXFunc, sigmaYFunc, **kwargs)
+                    self.sinPhi, sigmaXFunc, sigmaYFunc, sigmaXDerFunc = sigmaXDerFunc, \
+                    sigmaYDerFunc = sigmaYDerFunc, **kwargs)
             fitParamValues, fitStds, residual = fitRes
         elif self._fittingLibrary == "GaussianFitter":
             method = kwargs.pop("method", "lm")
@@ -420,7 +652,11 @@ class GaussianPsf(PsfBase):
                 fitRes = GaussianFitter.Fit2dGaussZ(coords[0], coords[1], data, \
                     initial, tckSigmaX, tckSigmaY, phi = self._phi, **kwargs)
             fitParamValues, pcov, residual = fitRes
-            fitStds = np.sqrt(np.diag(pcov))
+            fitStds = np.sqrt(np.abs(np.diag(pcov)))
+        elif self._fittingLibrary in BATCH_LIBRARIES:
+            fitRes = self._FitZBatch((coords[0][np.newaxis], coords[1][np.newaxis]), \
+                                     data[np.newaxis], [initial], fitPixels, **kwargs)
+            fitParamValues, fitStds, residual = [v[0] for v in fitRes]
         else:
             raise NotImplementedError()
         
@@ -432,6 +668,96 @@ class GaussianPsf(PsfBase):
         return (amp, x0, y0, z0, sigmaXFunc(z0), sigmaYFunc(z0), offset), \
             (stdAmp, stdX0, stdY0, stdZ0, None, None, stdOffset), \
             residual
+    
+    def _DoFittingSigmaBatch(self, iAmps, initialCoords, coords, data, initials, **kwargs):
+        # Initial
+        nrOfFits = len(iAmps)
+        if initials is None:
+            initials = np.column_stack((iAmps, 
+                                        initialCoords[:, 0], 
+                                        initialCoords[:, 1], 
+                                        np.full(nrOfFits, self._initialSigma), 
+                                        np.full(nrOfFits, self._initialSigma), 
+                                        np.full(nrOfFits, self._initialOffset)))
+        
+        fitParamValues, fitStds, residuals = self._FitSigmaBatch(coords, data, initials, **kwargs)
+        
+        # Return params (as _DoFittingSigma for every fit)
+        amp, x0, y0, sigmaX, sigmaY, offset = fitParamValues.T
+        stdAmp, stdX0, stdY0, stdSigmaX, stdSigmaY, stdOffset = fitStds.T
+        nones = [None] * nrOfFits
+        return zip(amp, x0, y0, nones, sigmaX, sigmaY, offset), \
+            zip(stdAmp, stdX0, stdY0, nones, stdSigmaX, stdSigmaY, stdOffset), \
+            residuals
+    
+    def _DoFittingZBatch(self, iAmps, initialCoords, coords, data, fitPixels, initials, **kwargs):
+        # Initial
+        nrOfFits = len(iAmps)
+        if initials is None:
+            initials = np.column_stack((iAmps, 
+                                        initialCoords[:, 0], 
+                                        initialCoords[:, 1], 
+                                        np.full(nrOfFits, self._initialZ0), 
+                                        np.full(nrOfFits, self._initialOffset)))
+        
+        fitParamValues, fitStds, residuals = self._FitZBatch(coords, data, initials, fitPixels, **kwargs)
+        
+        # Return params (as _DoFittingZ for every fit)
+        amp, x0, y0, z0, offset = fitParamValues.T
+        stdAmp, stdX0, stdY0, stdZ0, stdOffset = fitStds.T
+        sigmaX = self._calibSigmaX.GetInterpolatedValue(z0, fitPixels)
+        sigmaY = self._calibSigmaY.GetInterpolatedValue(z0, fitPixels)
+        nones = [None] * nrOfFits
+        return zip(amp, x0, y0, z0, sigmaX, sigmaY, offset), \
+            zip(stdAmp, stdX0, stdY0, stdZ0, nones, nones, stdOffset), \
+            residuals
+    
+    def _FitSigmaBatch(self, coords, data, initials, **kwargs):
+        kwargs = self._GetBatchKwargs(**kwargs)
+        if self._symmetric:
+            return Fit2DGaussianSigmaBatch(coords, data, initials, \
+                analyticJacobian = self._analyticJacobian, **kwargs)
+        else:
+            return Fit3DGaussianSigmaBatch(coords, data, initials, self.cosPhi, self.sinPhi, \
+                analyticJacobian = self._analyticJacobian, **kwargs)
+        
+    def _FitZBatch(self, coords, data, initials, fitPixels, **kwargs):
+        kwargs = self._GetBatchKwargs(**kwargs)
+        sigmaXFunc = lambda z: self._calibSigmaX.GetInterpolatedValue(z, fitPixels)
+        sigmaYFunc = lambda z: self._calibSigmaY.GetInterpolatedValue(z, fitPixels)
+        sigmaXDerFunc, sigmaYDerFunc = self._GetSigmaDerFuncs(fitPixels)
+        if self._symmetric:
+            return Fit2DGaussianZBatch(coords, data, initials, sigmaXFunc, \
+                                       sigmaDerFunc = sigmaXDerFunc, **kwargs)
+        else:
+            return Fit3DGaussianZBatch(coords, data, initials, self.cosPhi, self.sinPhi, \
+                                       sigmaXFunc, sigmaYFunc, sigmaXDerFunc = sigmaXDerFunc, \
+                                       sigmaYDerFunc = sigmaYDerFunc, **kwargs)
+    
+    def GetInitialGuess(self, loc, fitMode):
+        # Fit params of loc as initial guess (for Fit and _FitBatch)
+        amp, x0, y0, sigmaX, sigmaY, offset = loc.bestFitParams
+        if fitMode == "sigma":
+            return (amp, x0, y0, sigmaX, sigmaY, offset)
+        elif fitMode == "z":
+            return (amp, x0, y0, loc.z, offset)
+        else:
+            raise NotImplementedError()
+    
+    def _GetBatchKwargs(self, **kwargs):
+        kwargs.pop("x_scale", None)
+        if self._fittingLibrary == "numpyMLE":
+            kwargs.update({"mle": True, "iterations": self._mleIterations, \
+                           "noiseModel": self._mleNoiseModel})
+        return kwargs
+    
+    def _GetSigmaDerFuncs(self, fitPixels):
+        # Derivatives of sigma(z) for analytic Jacobians, None for finite differences
+        if not self._analyticJacobian:
+            return None, None
+        sigmaXDerFunc = lambda z: self._calibSigmaX.GetInterpolatedValue(z, fitPixels, der = 1)
+        sigmaYDerFunc = lambda z: self._calibSigmaY.GetInterpolatedValue(z, fitPixels, der = 1)
+        return sigmaXDerFunc, sigmaYDerFunc
             
     
 #===============================================================================
@@ -445,80 +771,226 @@ def RemoveSigma(array):
 def DuplicateSigma(array):
     return (array[0], array[1], array[2], array[3], array[3], array[4])
 
-def Fit2DGaussianSigmaLeastSq(coords, data, initial, **kwargs):        
+def Fit2DGaussianSigmaLeastSq(coords, data, initial, analyticJacobian = False, **kwargs):        
+    grid = GetGridAxes(coords, flattened = True)
     def FitSigmaFunc(params):
         amp, x0, y0, sigma, offset = params
-        calculated = Gaussian2DSym(coords, amp, x0, y0, sigma, offset)
+        calculated = Gaussian2DWindow(coords, grid, amp, x0, y0, sigma, sigma, offset, 1.0, 0.0)
         r = data - calculated
         return r
     
+    def FitSigmaJacobian(params):
+        return -Gaussian2DSymJacobian(coords, *params)
+    
     initialNew = RemoveSigma(initial)
-    fitParamValues, fitStds, residual = FitLeastsqScipy(FitSigmaFunc, initialNew, **kwargs)
+    fitParamValues, fitStds, residual = FitLeastsqScipy(FitSigmaFunc, initialNew, \
+        Dfun = FitSigmaJacobian if analyticJacobian else None, **kwargs)
     return DuplicateSigma(fitParamValues), DuplicateSigma(fitStds), residual
 
-def Fit2DGaussianZLeastSq(coords, data, initial, sigmaFunc, **kwargs):   
+def Fit2DGaussianZLeastSq(coords, data, initial, sigmaFunc, sigmaDerFunc = None, **kwargs):   
+    grid = GetGridAxes(coords, flattened = True)
     def FitZFunc(params):
         amp, x0, y0, z0, offset = params
         sigma = sigmaFunc(z0)
-        calculated = Gaussian2DSym(coords, amp, x0, y0, sigma, offset)
+        calculated = Gaussian2DWindow(coords, grid, amp, x0, y0, sigma, sigma, offset, 1.0, 0.0)
         r = data - calculated
         return r
     
-    fitParamValues, fitStds, residual = FitLeastsqScipy(FitZFunc, initial, **kwargs)
+    def FitZJacobian(params):
+        amp, x0, y0, z0, offset = params
+        return -Gaussian2DSymZJacobian(coords, amp, x0, y0, z0, offset, sigmaFunc, sigmaDerFunc)
+    
+    fitParamValues, fitStds, residual = FitLeastsqScipy(FitZFunc, initial, \
+        Dfun = FitZJacobian if sigmaDerFunc is not None else None, **kwargs)
     return fitParamValues, fitStds, residual
 
-def Fit3DGaussianSigmaCurveFit(coords, data, initial, cosPhi, sinPhi, **kwargs):        
+def Fit3DGaussianSigmaCurveFit(coords, data, initial, cosPhi, sinPhi, analyticJacobian = False, **kwargs):        
+    grid = GetGridAxes(coords, flattened = True) if sinPhi == 0.0 else None
     def Func(coords, amp, x0, y0, sigmaX, sigmaY, offset):
-        calculated = Gaussian2D(coords, amp, x0, y0, sigmaX, sigmaY, offset, cosPhi, sinPhi)
+        calculated = Gaussian2DWindow(coords, grid, amp, x0, y0, sigmaX, sigmaY, offset, cosPhi, sinPhi)
         return calculated
     
+    def Jacobian(coords, amp, x0, y0, sigmaX, sigmaY, offset):
+        return Gaussian2DJacobian(coords, amp, x0, y0, sigmaX, sigmaY, offset, cosPhi, sinPhi)
+    
     if kwargs["method"] == "lm":
         kwargs["diag"] = kwargs.pop("x_scale", None)
     
-    fitParamValues, pcov = optimize.curve_fit(Func, coords, data, initial, **kwargs)
-    fitStds = np.sqrt(np.diag(pcov))
+    fitParamValues, pcov = optimize.curve_fit(Func, coords, data, initial, \
+        jac = Jacobian if analyticJacobian else None, **kwargs)
+    fitStds = np.sqrt(np.abs(np.diag(pcov)))
     residual = data - Func(coords, *fitParamValues)
     return fitParamValues, fitStds, residual
 
-def Fit3DGaussianZCurveFit(coords, data, initial, cosPhi, sinPhi, sigmaXFunc, sigmaYFunc, **kwargs):        
+def Fit3DGaussianZCurveFit(coords, data, initial, cosPhi, sinPhi, sigmaXFunc, sigmaYFunc, \
+                           sigmaXDerFunc = None, sigmaYDerFunc = None, **kwargs):        
+    grid = GetGridAxes(coords, flattened = True) if sinPhi == 0.0 else None
     def Func(coords, amp, x0, y0, z0, offset):
         sigmaX = sigmaXFunc(z0)
         sigmaY = sigmaYFunc(z0)
-        calculated = Gaussian2D(coords, amp, x0, y0, sigmaX, sigmaY, offset, cosPhi, sinPhi)
+        calculated = Gaussian2DWindow(coords, grid, amp, x0, y0, sigmaX, sigmaY, offset, cosPhi, sinPhi)
         return calculated
     
+    def Jacobian(coords, amp, x0, y0, z0, offset):
+        return Gaussian2DZJacobian(coords, amp, x0, y0, z0, offset, cosPhi, sinPhi, \
+                                   sigmaXFunc, sigmaYFunc, sigmaXDerFunc, sigmaYDerFunc)
+    
     if kwargs["method"] == "lm":
         kwargs["diag"] = kwargs.pop("x_scale", None)
         
-    fitParamValues, pcov = optimize.curve_fit(Func, coords, data, initial, **kwargs)
-    fitStds = np.sqrt(np.diag(pcov))
+    fitParamValues, pcov = optimize.curve_fit(Func, coords, data, initial, \
+        jac = Jacobian if sigmaXDerFunc is not None else None, **kwargs)
+    fitStds = np.sqrt(np.abs(np.diag(pcov)))
     residual = data - Func(coords, *fitParamValues)
     return fitParamValues, fitStds, residual
 
 
 # Scipy.leastsq 3D
 
-def Fit3DGaussianSigmaLeastSq(coords, data, initial, cosPhi, sinPhi, **kwargs):        
+def Fit3DGaussianSigmaLeastSq(coords, data, initial, cosPhi, sinPhi, analyticJacobian = False, **kwargs):        
+    grid = GetGridAxes(coords, flattened = True) if sinPhi == 0.0 else None
     def FitSigmaFunc(params):
         amp, x0, y0, sigmaX, sigmaY, offset = params
-        calculated = Gaussian2D(coords, amp, x0, y0, sigmaX, sigmaY, offset, cosPhi, sinPhi)
+        calculated = Gaussian2DWindow(coords, grid, amp, x0, y0, sigmaX, sigmaY, offset, cosPhi, sinPhi)
         r = data - calculated
         return r
     
-    fitParamValues, fitStds, residual = FitLeastsqScipy(FitSigmaFunc, initial, **kwargs)
+    def FitSigmaJacobian(params):
+        amp, x0, y0, sigmaX, sigmaY, offset = params
+        return -Gaussian2DJacobian(coords, amp, x0, y0, sigmaX, sigmaY, offset, cosPhi, sinPhi)
+    
+    fitParamValues, fitStds, residual = FitLeastsqScipy(FitSigmaFunc, initial, \
+        Dfun = FitSigmaJacobian if analyticJacobian else None, **kwargs)
     return fitParamValues, fitStds, residual
 
-def Fit3DGaussianZLeastSq(coords, data, initial, cosPhi, sinPhi, sigmaXFunc, sigmaYFunc, **kwargs):   
+def Fit3DGaussianZLeastSq(coords, data, initial, cosPhi, sinPhi, sigmaXFunc, sigmaYFunc, \
+                          sigmaXDerFunc = None, sigmaYDerFunc = None, **kwargs):   
+    grid = GetGridAxes(coords, flattened = True) if sinPhi == 0.0 else None
     def FitZFunc(params):
         amp, x0, y0, z0, offset = params
         sigmaX = sigmaXFunc(z0)
         sigmaY = sigmaYFunc(z0)
-        calculated = Gaussian2D(coords, amp, x0, y0, sigmaX, sigmaY, offset, cosPhi, sinPhi)
+        calculated = Gaussian2DWindow(coords, grid, amp, x0, y0, sigmaX, sigmaY, offset, cosPhi, sinPhi)
         r = data - calculated
         return r
     
-    fitParamValues, fitStds, residual = FitLeastsqScipy(FitZFunc, initial, **kwargs)
+    def FitZJacobian(params):
+        amp, x0, y0, z0, offset = params
+        return -Gaussian2DZJacobian(coords, amp, x0, y0, z0, offset, cosPhi, sinPhi, \
+                                    sigmaXFunc, sigmaYFunc, sigmaXDerFunc, sigmaYDerFunc)
+    
+    fitParamValues, fitStds, residual = FitLeastsqScipy(FitZFunc, initial, \
+        Dfun = FitZJacobian if sigmaXDerFunc is not None else None, **kwargs)
     return fitParamValues, fitStds, residual
+
+# Batched NumPy LM/MLE, coords and data are stacked (N, nrOfPixels) arrays of
+# equally sized fit windows, initials (N, nrOfParams)
+
+def _GridIndices(grid, indices):
+    return None if grid is None else (grid[0][indices], grid[1][indices])
+
+def FitBatch(errfunc, initials, data, Dfun = None, mle = False, **kwargs):
+    if mle:
+        return FitPoissonMLEBatch(errfunc, initials, data, Dfun = Dfun, **kwargs)
+    return FitLeastsqBatch(errfunc, initials, Dfun = Dfun, **kwargs)
+
+def Fit2DGaussianSigmaBatch(coords, data, initials, analyticJacobian = False, **kwargs):
+    xs, ys = coords
+    grid = GetGridAxes(coords, flattened = True)
+    def FitSigmaFunc(params, indices):
+        amp, x0, y0, sigma, offset = params.T[:, :, np.newaxis]
+        calculated = Gaussian2DWindow((xs[indices], ys[indices]), _GridIndices(grid, indices), \
+                                      amp, x0, y0, sigma, sigma, offset, 1.0, 0.0)
+        r = data[indices] - calculated
+        return r
+    
+    def FitSigmaJacobian(params, indices):
+        amp, x0, y0, sigma, offset = params.T[:, :, np.newaxis]
+        return -Gaussian2DSymJacobian((xs[indices], ys[indices]), amp, x0, y0, sigma, offset)
+    
+    initialsNew = np.column_stack(RemoveSigma(np.asarray(initials, dtype = float).T))
+    fitParamValues, fitStds, residuals = FitBatch(FitSigmaFunc, initialsNew, data, \
+        Dfun = FitSigmaJacobian if analyticJacobian else None, **kwargs)
+    return np.column_stack(DuplicateSigma(fitParamValues.T)), \
+        np.column_stack(DuplicateSigma(fitStds.T)), residuals
+
+def Fit2DGaussianZBatch(coords, data, initials, sigmaFunc, sigmaDerFunc = None, **kwargs):
+    xs, ys = coords
+    grid = GetGridAxes(coords, flattened = True)
+    def FitZFunc(params, indices):
+        amp, x0, y0, z0, offset = params.T[:, :, np.newaxis]
+        sigma = sigmaFunc(z0)[:, np.newaxis]
+        calculated = Gaussian2DWindow((xs[indices], ys[indices]), _GridIndices(grid, indices), \
+                                      amp, x0, y0, sigma, sigma, offset, 1.0, 0.0)
+        r = data[indices] - calculated
+        return r
+    
+    def FitZJacobian(params, indices):
+        amp, x0, y0, z0, offset = params.T[:, :, np.newaxis]
+        return -Gaussian2DSymZJacobian((xs[indices], ys[indices]), amp, x0, y0, z0, offset, \
+                                       sigmaFunc, sigmaDerFunc)
+    
+    return FitBatch(FitZFunc, initials, data, \
+        Dfun = FitZJacobian if sigmaDerFunc is not None else None, **kwargs)
+
+def Fit3DGaussianSigmaBatch(coords, data, initials, cosPhi, sinPhi, analyticJacobian = False, **kwargs):
+    xs, ys = coords
+    grid = GetGridAxes(coords, flattened = True) if sinPhi == 0.0 else None
+    def FitSigmaFunc(params, indices):
+        amp, x0, y0, sigmaX, sigmaY, offset = params.T[:, :, np.newaxis]
+        calculated = Gaussian2DWindow((xs[indices], ys[indices]), _GridIndices(grid, indices), \
+                                      amp, x0, y0, sigmaX, sigmaY, offset, cosPhi, sinPhi)
+        r = data[indices] - calculated
+        return r
+    
+    def FitSigmaJacobian(params, indices):
+        amp, x0, y0, sigmaX, sigmaY, offset = params.T[:, :, np.newaxis]
+        return -Gaussian2DJacobian((xs[indices], ys[indices]), amp, x0, y0, sigmaX, sigmaY, \
+                                   offset, cosPhi, sinPhi)
+    
+    return FitBatch(FitSigmaFunc, initials, data, \
+        Dfun = FitSigmaJacobian if analyticJacobian else None, **kwargs)
+
+def Fit3DGaussianZBatch(coords, data, initials, cosPhi, sinPhi, sigmaXFunc, sigmaYFunc, \
+                        sigmaXDerFunc = None, sigmaYDerFunc = None, **kwargs):
+    xs, ys = coords
+    grid = GetGridAxes(coords, flattened = True) if sinPhi == 0.0 else None
+    def FitZFunc(params, indices):
+        amp, x0, y0, z0, offset = params.T[:, :, np.newaxis]
+        sigmaX = sigmaXFunc(z0)[:, np.newaxis]
+        sigmaY = sigmaYFunc(z0)[:, np.newaxis]
+        calculated = Gaussian2DWindow((xs[indices], ys[indices]), _GridIndices(grid, indices), \
+                                      amp, x0, y0, sigmaX, sigmaY, offset, cosPhi, sinPhi)
+        r = data[indices] - calculated
+        return r
+    
+    def FitZJacobian(params, indices):
+        amp, x0, y0, z0, offset = params.T[:, :, np.newaxis]
+        return -Gaussian2DZJacobian((xs[indices], ys[indices]), amp, x0, y0, z0, offset, \
+                                    cosPhi, sinPhi, sigmaXFunc, sigmaYFunc, sigmaXDerFunc, \
+                                    sigmaYDerFunc)
+    
+    return FitBatch(FitZFunc, initials, data, \
+        Dfun = FitZJacobian if sigmaXDerFunc is not None else None, **kwargs)
+
+# Jacobians of z-mode models, sigma(z) by chain rule through the calibration
+# spline derivative
+
+def Gaussian2DSymZJacobian(coords, amp, x0, y0, z0, offset, sigmaFunc, sigmaDerFunc):
+    sigma = np.reshape(sigmaFunc(z0), np.shape(z0))
+    res = Gaussian2DSymJacobian(coords, amp, x0, y0, sigma, offset)
+    res[..., 3] *= np.reshape(sigmaDerFunc(z0), np.shape(z0))
+    return res
+
+def Gaussian2DZJacobian(coords, amp, x0, y0, z0, offset, cosPhi, sinPhi, sigmaXFunc, \
+                        sigmaYFunc, sigmaXDerFunc, sigmaYDerFunc):
+    sigmaX = np.reshape(sigmaXFunc(z0), np.shape(z0))
+    sigmaY = np.reshape(sigmaYFunc(z0), np.shape(z0))
+    jacobianSigma = Gaussian2DJacobian(coords, amp, x0, y0, sigmaX, sigmaY, offset, cosPhi, sinPhi)
+    res = jacobianSigma[..., [0, 1, 2, 3, 5]]
+    res[..., 3] = jacobianSigma[..., 3] * np.reshape(sigmaXDerFunc(z0), np.shape(z0)) + \
+        jacobianSigma[..., 4] * np.reshape(sigmaYDerFunc(z0), np.shape(z0))
+    return res
       
 if __name__ == "__main__":
     pass
@@ -84,7 +84,7 @@ class BackgroundSubractor(PreprocessorBase):
         
         xc, yc = frame.coords
         interp = interpolate.RectBivariateSpline(coordsMatX[:, 0], coordsMatY[0, :], percentileMat, s = self._smoothing)
-        interpolatedBg = interp.ev(xc, yc)
+        interpolatedBg = interp.ev(xc, yc).astype(frame.data.dtype)
 
         # Result
         frame.data -= interpolatedBg
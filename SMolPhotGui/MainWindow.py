@@ -98,17 +98,23 @@ class MainWindow(QtGui.QMainWindow):
         
     def _LoadFrameSeries(self, filename, preload = False):
         try:
+            # Opt-in binary cache of converted frames next to the metafile
+            # (Config -> Cache converted frames, QSettings key "sidecarCache")
+            sidecarCache = self.ui.actionSidecarCache.isChecked()
+            
             print "Loading frame series..."
             self._fseries = FrameSeries.FromMetafile(filename, \
                                                      self._preprocessors, \
                                                      series = "sequence",
-                                                     maxFrameOverRide = None)
+                                                     maxFrameOverRide = None,
+                                                     sidecarCache = sidecarCache)
             print "Loading frame series done."
             
             print "Loading axial calibration..."
             self._axialFseries = FrameSeries.FromMetafile(filename, \
                                                           self._preprocessors, \
-                                                          series = "axial calibration")
+                                                          series = "axial calibration",
+                                                          sidecarCache = sidecarCache)
             print "Loading axial calibration done."
             
             # Optimize
@@ -251,6 +257,13 @@ class MainWindow(QtGui.QMainWindow):
         self.ui.actionLoadConfFromFile.triggered.connect(self._LoadConfFromFile)
         self.ui.actionSaveConfToFile.triggered.connect(self._SaveConfToFile)
         
+        self.ui.actionSidecarCache.setChecked(self.settings.value("sidecarCache", False).toBool())
+        self.ui.actionSidecarCache.toggled.connect(self._SidecarCacheToggled)
+        
+    def _SidecarCacheToggled(self, checked):
+        # Used when frame series is opened next time
+        self.settings.setValue("sidecarCache", checked)
+        
     def _OpenFrameSeries(self):
         directory = ""
         if self._fseries is None and self._preloadFrameSeries is not None:
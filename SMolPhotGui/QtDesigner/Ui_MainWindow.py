@@ -84,12 +84,17 @@ class Ui_MainWindow(object):
         icon4.addPixmap(QtGui.QPixmap(_fromUtf8(":/48x48/48x48/Stock Index Up_48x48.png")), QtGui.QIcon.Normal, QtGui.QIcon.Off)
         self.actionSaveConfToFile.setIcon(icon4)
         self.actionSaveConfToFile.setObjectName(_fromUtf8("actionSaveConfToFile"))
+        self.actionSidecarCache = QtGui.QAction(MainWindow)
+        self.actionSidecarCache.setCheckable(True)
+        self.actionSidecarCache.setObjectName(_fromUtf8("actionSidecarCache"))
         self.menuFile.addAction(self.actionOpen)
         self.menuFile.addAction(self.actionSave)
         self.menuFile.addAction(self.actionExit)
         self.menuConfig.addSeparator()
         self.menuConfig.addAction(self.actionLoadConfFromFile)
         self.menuConfig.addAction(self.actionSaveConfToFile)
+        self.menuConfig.addSeparator()
+        self.menuConfig.addAction(self.actionSidecarCache)
         self.menubar.addAction(self.menuFile.menuAction())
         self.menubar.addAction(self.menuConfig.menuAction())
         self.toolBar.addAction(self.actionOpen)
@@ -112,6 +117,8 @@ class Ui_MainWindow(object):
         self.actionExit.setText(_translate("MainWindow", "Exit", None))
         self.actionLoadConfFromFile.setText(_translate("MainWindow", "Load config", None))
         self.actionSaveConfToFile.setText(_translate("MainWindow", "Save config", None))
+        self.actionSidecarCache.setText(_translate("MainWindow", "Cache converted frames", None))
+        self.actionSidecarCache.setToolTip(_translate("MainWindow", "Keep a binary cache of converted frames next to the dataset metafile (used when opening the dataset next time)", None))
 
 from pyqtgraph.parametertree import ParameterTree
 import resource_rc
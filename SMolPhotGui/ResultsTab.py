@@ -5,6 +5,7 @@ import pyqtgraph as pg
 import cProfile, pstats
 
 from os import path
+from contextlib import closing
 from time import time
 from scipy import stats
 from getpass import getuser
@@ -587,31 +588,32 @@ class _ProcessFramesThread(QtCore.QThread):
                 fitMode = "z" if psf.hasCalibrationData else "sigma"
                 hasGroundTruth = self.main._fseries.HasGroundTruth()
                 
-                for frameNr in range(self.frameFrom, self.frameTo):
-                    if self.stopped:
-                        return
+                # Frames are prefetched in background, closing stops it
+                with closing(self.main._fseries.IterPreprocessedFrames(self.frameFrom, \
+                                                                       self.frameTo)) as frames:
+                    for frame in frames:
+                        if self.stopped:
+                            return
+                        frameNr = frame.nr
                     
-                    # Get frame
-                    frame = self.main._fseries.GetPreprocessedFrame(frameNr)
+                        # Find molecules
+                        profile.enable()
+                        locsNew = localizer.FindMolecules(frame, psf, axialCalibrator, fitMode = fitMode)
+                        profile.disable()
                     
-                    # Find molecules
-                    profile.enable()
-                    locsNew = localizer.FindMolecules(frame, psf, axialCalibrator, fitMode = fitMode)
-                    profile.disable()
-                    
-                    # Add found locations
-                    self._mutex.lock()
-                    self.locs += locsNew
-                    self._mutex.unlock()
-                    
-                    # Ground-truth
-                    if hasGroundTruth:
+                        # Add found locations
                         self._mutex.lock()
-                        self.stats.AddLocations(locsNew)
+                        self.locs += locsNew
                         self._mutex.unlock()
+                    
+                        # Ground-truth
+                        if hasGroundTruth:
+                            self._mutex.lock()
+                            self.stats.AddLocations(locsNew)
+                            self._mutex.unlock()
 
-                    # Update process
-                    self.progress = float(frameNr - self.frameFrom) / (self.frameTo - self.frameFrom - 1)   
+                        # Update process
+                        self.progress = float(frameNr - self.frameFrom) / (self.frameTo - self.frameFrom - 1)   
                 
                 pstats.Stats(profile).sort_stats("cumtime").print_stats(50)
             except Exception, ex:
@@ -0,0 +1,112 @@
+"""Benchmarks Gaussian PSF fitting libraries (fits per second): SciPy
+leastsq, the compiled GaussianFitter extension (if available) and its pure
+NumPy implementation, called per window and with all windows stacked. All
+four GaussianFitter functions are benchmarked on synthetic fit windows.
+
+"""
+
+import sys
+import math
+import time
+import numpy as np
+from scipy import interpolate
+from SMolPhot.PSFs import _GaussianPsf as G
+from SMolPhot.PSFs import _GaussianFitterNumPy as GaussianFitterNumPy
+from SMolPhot.PSFs._Common import Gaussian2D, splevFast
+
+try:
+    import GaussianFitter as GaussianFitterNative
+except ImportError:
+    GaussianFitterNative = None
+
+def CreateDataset(nrOfFits, phi, fitPixels = 3, pixelSize = 100e-9):
+    rng = np.random.RandomState(0)
+
+    # Astigmatic calibration curves sigma(z)
+    zs = np.linspace(-600e-9, 600e-9, 25)
+    tckSigmaX = interpolate.splrep(zs, 130e-9 + 0.1 * zs + 1.5e5 * zs ** 2.0)
+    tckSigmaY = interpolate.splrep(zs, 130e-9 - 0.1 * zs + 1.5e5 * zs ** 2.0)
+
+    # Fit windows
+    dX, dY = [d.ravel() for d in np.mgrid[-fitPixels:fitPixels + 1, -fitPixels:fitPixels + 1]]
+    coords = (pixelSize * (10.5 + dX), pixelSize * (10.5 + dY))
+    windows = []
+    for _ in range(nrOfFits):
+        amp, offset = rng.uniform(200.0, 2000.0), rng.uniform(0.0, 20.0)
+        x0, y0 = pixelSize * 10.5 + rng.uniform(-50e-9, 50e-9, 2)
+        z0 = rng.uniform(-400e-9, 400e-9)
+        sigmaX, sigmaY = splevFast(np.array([z0]), tckSigmaX)[0], splevFast(np.array([z0]), tckSigmaY)[0]
+        expected = Gaussian2D(coords, amp, x0, y0, sigmaX, sigmaY, offset, math.cos(phi), math.sin(phi))
+        data = rng.poisson(np.maximum(expected, 0.0)).astype(float)
+        windows.append((data, [data.max(), pixelSize * 10.5, pixelSize * 10.5]))
+    return coords, windows, tckSigmaX, tckSigmaY
+
+def Benchmark(fitFunc, windows):
+    t0 = time.time()
+    costs = []
+    for data, initialXY in windows:
+        _, __, residual = fitFunc(data, initialXY)
+        costs.append((residual ** 2.0).sum())
+    return len(windows) / (time.time() - t0), np.array(costs)
+
+def BenchmarkStacked(fitFunc, windows):
+    data = np.array([d for d, _ in windows])
+    initialsXY = [iXY for _, iXY in windows]
+    t0 = time.time()
+    _, __, residuals = fitFunc(data, initialsXY)
+    return len(windows) / (time.time() - t0), (residuals ** 2.0).sum(axis = 1)
+
+if __name__ == '__main__':
+    nrOfFits = int(sys.argv[1]) if len(sys.argv) > 1 else 500
+    phi = 0.3
+    coords, windows, tckSigmaX, tckSigmaY = CreateDataset(nrOfFits, phi)
+    kwargs = {"xtol": 1.49e-8, "ftol": 1.49e-8, "gtol": 1.49e-8}
+    xs, ys = coords
+    xsStacked, ysStacked = np.tile(xs, (nrOfFits, 1)), np.tile(ys, (nrOfFits, 1))
+
+    sigmaXFunc = lambda z: splevFast(z, tckSigmaX)
+    sigmaYFunc = lambda z: splevFast(z, tckSigmaY)
+    sigmaXDerFunc = lambda z: splevFast(z, tckSigmaX, der = 1)
+    sigmaYDerFunc = lambda z: splevFast(z, tckSigmaY, der = 1)
+
+    # (name, initial params from initial XY, SciPy function, GaussianFitter function)
+    fitFuncs = [
+        ("Fit2dGaussSigma", lambda iXY: iXY + [150e-9, 150e-9, 0.0],
+         lambda d, i: G.Fit3DGaussianSigmaLeastSq(coords, d, i, math.cos(phi), math.sin(phi), \
+            analyticJacobian = True, **kwargs),
+         lambda lib, xs, ys, d, i: lib.Fit2dGaussSigma(xs, ys, d, i, phi = phi, **kwargs)),
+        ("Fit2dGaussSigmaSym", lambda iXY: iXY + [150e-9, 0.0],
+         lambda d, i: G.FitLeastsqScipy(lambda p: d - G.Gaussian2DSym(coords, *p), i, \
+            Dfun = lambda p: -G.Gaussian2DSymJacobian(coords, *p), **kwargs),
+         lambda lib, xs, ys, d, i: lib.Fit2dGaussSigmaSym(xs, ys, d, i, **kwargs)),
+        ("Fit2dGaussZ", lambda iXY: iXY + [0.0, 0.0],
+         lambda d, i: G.Fit3DGaussianZLeastSq(coords, d, i, math.cos(phi), math.sin(phi), \
+            sigmaXFunc, sigmaYFunc, sigmaXDerFunc, sigmaYDerFunc, **kwargs),
+         lambda lib, xs, ys, d, i: lib.Fit2dGaussZ(xs, ys, d, i, tckSigmaX, tckSigmaY, \
+            phi = phi, **kwargs)),
+        ("Fit2dGaussZSym", lambda iXY: iXY + [0.0, 0.0],
+         lambda d, i: G.Fit2DGaussianZLeastSq(coords, d, i, sigmaXFunc, sigmaXDerFunc, **kwargs),
+         lambda lib, xs, ys, d, i: lib.Fit2dGaussZSym(xs, ys, d, i, tckSigmaX, **kwargs)),
+        ]
+
+    print "%d fits of %d pixels" % (nrOfFits, len(xs))
+    if GaussianFitterNative is None:
+        print "GaussianFitter extension not available"
+    print "%-20s %-16s %12s %8s %14s" % ("Function", "Library", "Fits/s", "Speedup", "Max cost ratio")
+    for name, Initial, scipyFunc, fitterFunc in fitFuncs:
+        libraries = [("SciPy leastsq", Benchmark, lambda d, iXY: scipyFunc(d, Initial(iXY)))]
+        if GaussianFitterNative is not None:
+            libraries.append(("Fortran", Benchmark, lambda d, iXY: \
+                fitterFunc(GaussianFitterNative, xs, ys, d, Initial(iXY))))
+        libraries.append(("NumPy", Benchmark, lambda d, iXY: \
+            fitterFunc(GaussianFitterNumPy, xs, ys, d, Initial(iXY))))
+        libraries.append(("NumPy stacked", BenchmarkStacked, lambda d, iXYs: \
+            fitterFunc(GaussianFitterNumPy, xsStacked, ysStacked, d, map(Initial, iXYs))))
+
+        rateScipy, costsScipy = None, None
+        for libraryName, benchmarkFunc, fitFunc in libraries:
+            rate, costs = benchmarkFunc(fitFunc, windows)
+            if rateScipy is None:
+                rateScipy, costsScipy = rate, costs
+            print "%-20s %-16s %12.0f %7.2fx %14.6f" % (name, libraryName, rate, rate / rateScipy, \
+                (costs / costsScipy).max())
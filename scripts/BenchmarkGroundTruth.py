@@ -0,0 +1,112 @@
+"""Benchmarks ground-truth processing of FrameSeries (border filtering, frame
+map and molecule numbering) against the former per-activation Python loops on
+a synthetic dataset and checks that the outputs are identical.
+
+"""
+
+import sys
+import time
+import shutil
+import logging
+import tempfile
+import numpy as np
+import SMolPhot
+from os import path
+from PIL import Image
+from collections import defaultdict
+
+def SetGroundTruthLoops(fseries, nrs, frameNrs, xs, ys, zs, indensities):
+    # Reference implementation with per-activation loops (previous version,
+    # molecules numbered by the coordinates of kept activations)
+    groundTruthToKeep = []
+    frame = fseries.GetOriginalFrame(0)
+    sizeX, sizeY = frame.sizeX, frame.sizeY
+    for i in range(len(frameNrs)):
+        x, y = 1e-9 * xs[i], 1e-9 * ys[i]
+        if min(x, y) < fseries._excludedBorderWidth or \
+            x + fseries._excludedBorderWidth > sizeX or \
+            y + fseries._excludedBorderWidth > sizeY:
+            continue
+        groundTruthToKeep.append(i)
+    groundTruthToKeep = np.array(groundTruthToKeep)
+
+    actFrameNr = frameNrs[groundTruthToKeep].astype(int) - 1
+    actFrameMap = defaultdict(list)
+    for i in np.arange(len(actFrameNr)):
+        actFrameMap[actFrameNr[i]].append(i)
+    for k, v in actFrameMap.iteritems():
+        actFrameMap[k] = np.array(v, dtype = int)
+
+    dictActMolIdsTmp = dict()
+    curMolIdTmp = 0
+    actMolId = np.zeros_like(actFrameNr, dtype = int)
+    for i in np.arange(len(actFrameNr)):
+        coord = (xs[groundTruthToKeep[i]], ys[groundTruthToKeep[i]], zs[groundTruthToKeep[i]])
+        if coord in dictActMolIdsTmp:
+            actMolId[i] = dictActMolIdsTmp[coord]
+        else:
+            actMolId[i] = curMolIdTmp
+            dictActMolIdsTmp[coord] = curMolIdTmp
+            curMolIdTmp += 1
+
+    return {"_actNr": nrs[groundTruthToKeep].astype(int),
+            "_actFrameNr": actFrameNr,
+            "_actCoordsArray": 1e-9 * np.array([xs, ys, zs])[:, groundTruthToKeep].T,
+            "_actIs": indensities[groundTruthToKeep],
+            "_actMolId": actMolId}, actFrameMap
+
+def CreateDataset(dataDir, nrOfActivations, nrOfFrames = 1000, nrOfMolecules = None, \
+                  pixels = 64, pixelSize = 100e-9):
+    nrOfMolecules = nrOfActivations // 4 if nrOfMolecules is None else nrOfMolecules
+    rng = np.random.RandomState(0)
+
+    # Every molecule is active in several frames
+    molCoords = np.column_stack((rng.uniform(0.0, 1e9 * pixels * pixelSize, (nrOfMolecules, 2)), \
+                                 rng.uniform(-500.0, 500.0, nrOfMolecules)))
+    molIds = rng.randint(0, nrOfMolecules, nrOfActivations)
+    frameNrs = np.sort(rng.randint(1, nrOfFrames + 1, nrOfActivations))
+    intensities = rng.uniform(1000.0, 5000.0, nrOfActivations)
+    table = np.column_stack((np.arange(1, nrOfActivations + 1), frameNrs, \
+                             molCoords[molIds], intensities))
+    np.savetxt(path.join(dataDir, "activations.csv"), table, delimiter = ",", \
+               fmt = ["%d", "%d", "%.6f", "%.6f", "%.6f", "%.6f"], \
+               header = "Ground-truth,frame,xnano,ynano,znano,intensity", comments = "")
+
+    Image.fromarray(np.full((pixels, pixels), 100, dtype = np.uint16)).save(path.join(dataDir, "frame.tif"))
+    return SMolPhot.FrameSeries(pixelSize, stackFile = path.join(dataDir, "frame.tif"), \
+                                activationsFile = path.join(dataDir, "activations.csv"), \
+                                name = "benchmark", wl = 660e-9, totalGain = 1.0, \
+                                adcBaseline = 100.0)
+
+if __name__ == '__main__':
+    logging.basicConfig(level = logging.ERROR)
+    nrOfActivations = int(sys.argv[1]) if len(sys.argv) > 1 else 1000000
+
+    dataDir = tempfile.mkdtemp()
+    try:
+        fseries = CreateDataset(dataDir, nrOfActivations)
+
+        t0 = time.time()
+        activations = np.loadtxt(fseries.activationsFile, delimiter = ",", unpack = True, \
+                                 skiprows = 1)
+        t1 = time.time()
+        reference, referenceFrameMap = SetGroundTruthLoops(fseries, *activations)
+        t2 = time.time()
+        fseries._SetGroundTruth(*activations)
+        t3 = time.time()
+
+        # Check
+        for name, value in reference.iteritems():
+            if not np.array_equal(getattr(fseries, name), value):
+                raise RuntimeError("Mismatch in %s" % (name))
+        for frameNr, indices in referenceFrameMap.iteritems():
+            if not np.array_equal(fseries._actFrameMap[frameNr], indices):
+                raise RuntimeError("Mismatch in frame map (frame %d)" % (frameNr))
+
+        print "Activations: %d (%d kept)" % (nrOfActivations, len(fseries._actNr))
+        print "loadtxt:     %.2f s" % (t1 - t0)
+        print "Loops:       %.3f s" % (t2 - t1)
+        print "Vectorized:  %.3f s (%.1fx faster)" % (t3 - t2, (t2 - t1) / (t3 - t2))
+        print "Outputs identical"
+    finally:
+        shutil.rmtree(dataDir)
@@ -0,0 +1,95 @@
+"""Benchmarks Gaussian PSF fitting with finite difference and analytic
+Jacobians (fits per second) for all scipy fitting functions in sigma and z
+mode on synthetic fit windows.
+
+"""
+
+import sys
+import time
+import numpy as np
+from scipy import interpolate
+from SMolPhot.PSFs import _GaussianPsf as G
+from SMolPhot.PSFs._Common import Gaussian2D, splevFast
+
+def CreateDataset(nrOfFits, fitPixels = 3, pixelSize = 100e-9):
+    rng = np.random.RandomState(0)
+
+    # Astigmatic calibration curves sigma(z)
+    zs = np.linspace(-600e-9, 600e-9, 25)
+    tckSigmaX = interpolate.splrep(zs, 130e-9 + 0.1 * zs + 1.5e5 * zs ** 2.0)
+    tckSigmaY = interpolate.splrep(zs, 130e-9 - 0.1 * zs + 1.5e5 * zs ** 2.0)
+
+    # Fit windows
+    dX, dY = [d.ravel() for d in np.mgrid[-fitPixels:fitPixels + 1, -fitPixels:fitPixels + 1]]
+    coords = (pixelSize * (10.5 + dX), pixelSize * (10.5 + dY))
+    windows = []
+    for _ in range(nrOfFits):
+        amp, offset = rng.uniform(200.0, 2000.0), rng.uniform(0.0, 20.0)
+        x0, y0 = pixelSize * 10.5 + rng.uniform(-50e-9, 50e-9, 2)
+        z0 = rng.uniform(-400e-9, 400e-9)
+        sigmaX, sigmaY = splevFast(np.array([z0]), tckSigmaX)[0], splevFast(np.array([z0]), tckSigmaY)[0]
+        expected = Gaussian2D(coords, amp, x0, y0, sigmaX, sigmaY, offset, 1.0, 0.0)
+        data = rng.poisson(np.maximum(expected, 0.0)).astype(float)
+        windows.append((data, [data.max(), pixelSize * 10.5, pixelSize * 10.5]))
+    return coords, windows, tckSigmaX, tckSigmaY
+
+def Benchmark(fitFunc, windows, analytic):
+    t0 = time.time()
+    costs = []
+    for data, initialXY in windows:
+        _, __, residual = fitFunc(data, initialXY, analytic)
+        costs.append((residual ** 2.0).sum())
+    return len(windows) / (time.time() - t0), np.array(costs)
+
+def BenchmarkBatch(fitFunc, windows, analytic):
+    data = np.array([d for d, _ in windows])
+    initialsXY = [iXY for _, iXY in windows]
+    t0 = time.time()
+    _, __, residuals = fitFunc(data, initialsXY, analytic)
+    return len(windows) / (time.time() - t0), (residuals ** 2.0).sum(axis = 1)
+
+if __name__ == '__main__':
+    nrOfFits = int(sys.argv[1]) if len(sys.argv) > 1 else 500
+    coords, windows, tckSigmaX, tckSigmaY = CreateDataset(nrOfFits)
+    kwargs = {"method": "lm", "xtol": 1.49e-8, "ftol": 1.49e-8, "gtol": 1.49e-8}
+
+    sigmaXFunc = lambda z: splevFast(z, tckSigmaX)
+    sigmaYFunc = lambda z: splevFast(z, tckSigmaY)
+    sigmaXDerFunc = lambda z: splevFast(z, tckSigmaX, der = 1)
+    sigmaYDerFunc = lambda z: splevFast(z, tckSigmaY, der = 1)
+    DerFuncs = lambda analytic: (sigmaXDerFunc, sigmaYDerFunc) if analytic else (None, None)
+
+    sigmaInitial = lambda iXY: iXY + [150e-9, 150e-9, 0.0]
+    zInitial = lambda iXY: iXY + [0.0, 0.0]
+
+    fitFuncs = [
+        ("leastsq sigma", lambda d, iXY, a: G.Fit3DGaussianSigmaLeastSq(coords, d, sigmaInitial(iXY), \
+            1.0, 0.0, analyticJacobian = a, **kwargs)),
+        ("leastsq sigma sym", lambda d, iXY, a: G.Fit2DGaussianSigmaLeastSq(coords, d, sigmaInitial(iXY), \
+            analyticJacobian = a, **kwargs)),
+        ("leastsq z", lambda d, iXY, a: G.Fit3DGaussianZLeastSq(coords, d, zInitial(iXY), 1.0, 0.0, \
+            sigmaXFunc, sigmaYFunc, *DerFuncs(a), **kwargs)),
+        ("leastsq z sym", lambda d, iXY, a: G.Fit2DGaussianZLeastSq(coords, d, zInitial(iXY), \
+            sigmaXFunc, DerFuncs(a)[0], **kwargs)),
+        ("curve_fit sigma", lambda d, iXY, a: G.Fit3DGaussianSigmaCurveFit(coords, d, sigmaInitial(iXY), \
+            1.0, 0.0, analyticJacobian = a, **kwargs)),
+        ("curve_fit z", lambda d, iXY, a: G.Fit3DGaussianZCurveFit(coords, d, zInitial(iXY), 1.0, 0.0, \
+            sigmaXFunc, sigmaYFunc, *DerFuncs(a), **kwargs)),
+        ]
+    
+    coordsBatch = (np.tile(coords[0], (nrOfFits, 1)), np.tile(coords[1], (nrOfFits, 1)))
+    fitFuncsBatch = [
+        ("batch sigma", lambda d, iXYs, a: G.Fit3DGaussianSigmaBatch(coordsBatch, d, \
+            map(sigmaInitial, iXYs), 1.0, 0.0, analyticJacobian = a, **kwargs)),
+        ("batch z", lambda d, iXYs, a: G.Fit3DGaussianZBatch(coordsBatch, d, map(zInitial, iXYs), \
+            1.0, 0.0, sigmaXFunc, sigmaYFunc, *DerFuncs(a), **kwargs)),
+        ]
+
+    print "%d fits of %d pixels" % (nrOfFits, len(coords[0]))
+    print "%-20s %12s %12s %8s %14s" % ("Function", "FD fits/s", "Analytic", "Speedup", "Max cost ratio")
+    for name, fitFunc, benchmarkFunc in [f + (Benchmark,) for f in fitFuncs] + \
+        [f + (BenchmarkBatch,) for f in fitFuncsBatch]:
+        rateFD, costsFD = benchmarkFunc(fitFunc, windows, False)
+        rateAnalytic, costsAnalytic = benchmarkFunc(fitFunc, windows, True)
+        print "%-20s %12.0f %12.0f %7.2fx %14.6f" % (name, rateFD, rateAnalytic, \
+            rateAnalytic / rateFD, (costsAnalytic / costsFD).max())
@@ -0,0 +1,84 @@
+"""Benchmarks CalcMinimumDistance and AddLocsWoDuplicates (KD-tree) against
+the former pairwise Python loops for increasing number of emitters per frame
+and checks that the outputs are identical.
+
+"""
+
+import sys
+import time
+import logging
+import numpy as np
+from SMolPhot.PSFs._Common import MoleculeLoc
+from SMolPhot.Localizers._Common import CalcMinimumDistance, AddLocsWoDuplicates
+
+def CalcMinimumDistanceLoops(locs):
+    # Reference implementation (previous version)
+    for i in range(len(locs)):
+        minDistXY = np.inf
+        for j in range(len(locs)):
+            if i == j:
+                continue
+            distXY = np.sqrt((locs[i].x - locs[j].x) ** 2.0 + (locs[i].y - locs[j].y) ** 2.0)
+            if distXY < minDistXY:
+                minDistXY = distXY
+        locs[i].minFitDistXY = min(10e-6, minDistXY)
+    return locs
+
+def AddLocsWoDuplicatesLoops(locs, locsToAdd, minSameIterationDistXY, minDistXY):
+    # Reference implementation (previous version)
+    distFunc = lambda loc1, loc2: np.sqrt((loc1.x - loc2.x) ** 2.0 + (loc1.y - loc2.y) ** 2.0)
+    duplicate = [False] * len(locsToAdd)
+    for i in range(len(locsToAdd) - 1, -1, -1):
+        for j in range(len(locs)):
+            if duplicate[i]:
+                break
+            if distFunc(locsToAdd[i], locs[j]) < minDistXY:
+                duplicate[i] = True
+        for j in range(i):
+            if duplicate[i]:
+                break
+            if distFunc(locsToAdd[i], locsToAdd[j]) < minSameIterationDistXY:
+                duplicate[i] = True
+    locsToAddNew = [loc for i, loc in enumerate(locsToAdd) if not duplicate[i]]
+    locs += locsToAddNew
+    return locs, locsToAddNew
+
+def CreateLocs(nrOfLocs, rng, size = 25.6e-6):
+    # Random locations, some of them closer than duplicate distance
+    coords = rng.uniform(0.0, size, (nrOfLocs, 2))
+    nrOfClose = nrOfLocs // 10
+    coords[:nrOfClose] = coords[-nrOfClose:] + rng.uniform(-100e-9, 100e-9, (nrOfClose, 2))
+    return [MoleculeLoc((x, y, 0.0)) for x, y in coords]
+
+def Timeit(func, *args):
+    t0 = time.time()
+    res = func(*args)
+    return time.time() - t0, res
+
+if __name__ == '__main__':
+    maxLocs = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    logger = logging.getLogger("BenchmarkLocsDistances")
+    rng = np.random.RandomState(0)
+    minSameIterationDistXY, minDistXY = 200e-9, 300e-9
+
+    print "%-8s %-22s %10s %10s %8s" % ("Locs", "Function", "Loops (s)", "KD-tree", "Speedup")
+    nrOfLocs = 250
+    while nrOfLocs <= maxLocs:
+        locs = CreateLocs(nrOfLocs, rng)
+        tLoops, _ = Timeit(CalcMinimumDistanceLoops, locs)
+        reference = [loc.minFitDistXY for loc in locs]
+        tTree, _ = Timeit(CalcMinimumDistance, locs)
+        if [loc.minFitDistXY for loc in locs] != reference:
+            raise RuntimeError("CalcMinimumDistance mismatch (%d locs)" % (nrOfLocs))
+        print "%-8d %-22s %10.4f %10.4f %7.1fx" % (nrOfLocs, "CalcMinimumDistance", tLoops, tTree, tLoops / tTree)
+
+        oldLocs, newLocs = locs[:nrOfLocs // 2], locs[nrOfLocs // 2:]
+        tLoops, (_, reference) = Timeit(AddLocsWoDuplicatesLoops, list(oldLocs), newLocs, \
+                                        minSameIterationDistXY, minDistXY)
+        tTree, (_, added) = Timeit(AddLocsWoDuplicates, list(oldLocs), newLocs, \
+                                   minSameIterationDistXY, minDistXY, logger)
+        if added != reference:
+            raise RuntimeError("AddLocsWoDuplicates mismatch (%d locs)" % (nrOfLocs))
+        print "%-8d %-22s %10.4f %10.4f %7.1fx" % (nrOfLocs, "AddLocsWoDuplicates", tLoops, tTree, tLoops / tTree)
+        nrOfLocs *= 2
+    print "Outputs identical"
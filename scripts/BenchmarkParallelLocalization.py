@@ -0,0 +1,36 @@
+"""Benchmarks frame-parallel localization of CommandLineSMolPhot (time and
+speedup for 1..N worker processes) and checks that the localizations are
+identical to the sequential run.
+
+Usage: BenchmarkParallelLocalization.py datasetMetafile confFile [maxWorkers [chunkSize]]
+
+"""
+
+import sys
+import time
+import logging
+import multiprocessing
+import SMolPhot
+
+if __name__ == '__main__':
+    logging.basicConfig(level = logging.ERROR)
+    datasetMetafile, confFile = sys.argv[1:3]
+    maxWorkers = int(sys.argv[3]) if len(sys.argv) > 3 else multiprocessing.cpu_count()
+    chunkSize = int(sys.argv[4]) if len(sys.argv) > 4 else None
+
+    smolphot = SMolPhot.Helpers.CommandLineSMolPhot(datasetMetafile, confFile)
+    smolphot.DoAxialCalibration()
+
+    print "%d frames, %d CPUs" % (len(smolphot._fseries), multiprocessing.cpu_count())
+    print "%-8s %10s %10s %8s %s" % ("Workers", "Locs", "Time (s)", "Speedup", "Check")
+    reference, timeSequential = None, None
+    for workers in range(1, maxWorkers + 1):
+        t0 = time.time()
+        locs = smolphot.LocalizeMolecules(workers = workers, chunkSize = chunkSize)
+        totalTime = time.time() - t0
+
+        coords = [(loc.frameNr, loc.x, loc.y, loc.z) for loc in locs]
+        if reference is None:
+            reference, timeSequential = coords, totalTime
+        print "%-8d %10d %10.2f %7.2fx %s" % (workers, len(locs), totalTime, timeSequential / totalTime, \
+            "identical" if coords == reference else "MISMATCH")
@@ -87,6 +87,8 @@ if __name__ == '__main__':
     extraInitParams["maxFrameOverRide"] = 1000000
     #extraInitParams["confOverride"] = [(("Localizers", "IterativeLocalizer", "_potentialLocMode"), "aboveTreshold")]
     # localMaxima, aboveTreshold
+    #extraInitParams["frameSeriesKwargs"] = {"frameDtype": "float32"}
+    #extraInitParams["sidecarCache"] = True
     
     extraRunParams = {}
     extraRunParams["postprocessingHistory"] = True